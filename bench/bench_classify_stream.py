@@ -0,0 +1,101 @@
+"""
+Time to first classified item: streamed vs. non-streamed tax classification.
+
+Runs the tax model call shape used by classify_tax against the local stub
+LLM server: once non-streamed (every item arrives with the full response)
+and once streamed through json_helper.ItemStreamParser.
+
+Usage:
+    python -m bench.bench_classify_stream [--items 5 20 40] [--ttft 0.3] [--tokens-per-second 300]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+from groq import AsyncGroq
+
+from bench.stub_llm_server import start_in_thread
+from src.json_helper import ItemStreamParser
+
+TAX_PROMPT_PATH = os.path.join(os.path.dirname(__file__), "..", "src", "tax_prompt.txt")
+
+
+def make_receipt(item_count):
+    return {
+        "merchant_name": "Bench Hypermarket",
+        "transaction_datetime": "2024-03-01T10:15:00",
+        "line_items": [
+            {"description": f"Item {i}", "quantity": 1, "original_unit_price": 5.0, "total_price": 5.0}
+            for i in range(item_count)
+        ],
+        "total_amount": 5.0 * item_count,
+    }
+
+
+async def non_streamed(client, messages):
+    start = time.perf_counter()
+    completion = await client.chat.completions.create(
+        model="llama-3.3-70b-versatile", response_format={"type": "json_object"},
+        messages=messages, max_completion_tokens=8192, stream=False,
+    )
+    json.loads(completion.choices[0].message.content)
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed
+
+
+async def streamed(client, messages):
+    start = time.perf_counter()
+    first_item = None
+    stream = await client.chat.completions.create(
+        model="llama-3.3-70b-versatile", messages=messages, max_completion_tokens=8192, stream=True,
+    )
+    parser = ItemStreamParser()
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            if parser.feed(chunk.choices[0].delta.content) and first_item is None:
+                first_item = time.perf_counter() - start
+    return first_item, time.perf_counter() - start
+
+
+async def run(args):
+    with open(TAX_PROMPT_PATH, "r") as f:
+        tax_prompt = f.read()
+
+    server = start_in_thread(args.port, ttft=args.ttft, tokens_per_second=args.tokens_per_second)
+    client = AsyncGroq(api_key="bench", base_url=f"http://127.0.0.1:{args.port}")
+    results = []
+    try:
+        for item_count in args.items:
+            messages = [{
+                "role": "user",
+                "content": [{"type": "text", "text": str(make_receipt(item_count)) + ";" + tax_prompt}],
+            }]
+            for name, call in (("non_streamed", non_streamed), ("streamed", streamed)):
+                runs = [await call(client, messages) for _ in range(args.repeat)]
+                results.append({
+                    "mode": name,
+                    "items": item_count,
+                    "first_item_ms": round(statistics.median(r[0] for r in runs) * 1000, 1),
+                    "total_ms": round(statistics.median(r[1] for r in runs) * 1000, 1),
+                })
+    finally:
+        server.should_exit = True
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, nargs="+", default=[5, 20, 40])
+    parser.add_argument("--ttft", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=300.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Bursts of identical requests (double taps, client retries) with and without
+single-flight coalescing of the model calls.
+
+Serves the app with the in-memory fakes from bench.fake_backends and Groq
+replaced by the stub LLM server. Each burst sends --duplicates identical
+/read-receipt-image/ or /classify-tax/ requests at once, for an image or
+receipt no earlier burst used, so the OCR and line tax caches can't answer
+them. Reports the model requests made and the burst latency, with
+LLM_SINGLE_FLIGHT on and off.
+
+Usage:
+    python -m bench.bench_coalescing [--bursts 20] [--duplicates 1 2 5] [--ttft 0.3] [--vision-ttft 1.0]
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+
+from bench import fake_backends
+from bench.bench_endpoints import State, make_image, make_receipt, percentile, serve_in_thread
+from bench.stub_llm_server import start_in_thread
+
+
+def llm_requests(metrics_helper) -> float:
+    return sum(metrics_helper.LLM_REQUESTS._values.values())
+
+
+async def burst(client, request, duplicates: int):
+    start = time.perf_counter()
+    responses = await asyncio.gather(*(client.request(**request) for _ in range(duplicates)))
+    elapsed = time.perf_counter() - start
+    return [response.status_code for response in responses], elapsed
+
+
+async def run_endpoint(client, build, bursts: int, duplicates: int, metrics_helper):
+    latencies = []
+    errors = 0
+    before = llm_requests(metrics_helper)
+    for n in range(bursts):
+        statuses, elapsed = await burst(client, build(n), duplicates)
+        errors += sum(status != 200 for status in statuses)
+        latencies.append(elapsed)
+    latencies.sort()
+    return {
+        "model_requests": int(llm_requests(metrics_helper) - before),
+        "requests": bursts * duplicates,
+        "errors": errors,
+        "burst_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 1),
+            "p95": round(percentile(latencies, 95) * 1000, 1),
+        },
+    }
+
+
+async def run(args, app_module, state):
+    from src import metrics_helper
+
+    scenarios = {
+        "read-receipt-image": lambda n: {
+            "method": "POST", "url": "/read-receipt-image/",
+            "files": {"file": ("receipt.jpg", state.unique_image(n), "image/jpeg")},
+        },
+        "classify-tax": lambda n: {
+            "method": "GET", "url": "/classify-tax/", "json": make_receipt(state.next()),
+        },
+    }
+    results = []
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=60) as client:
+        while (await client.get("/ready")).status_code != 200:
+            await asyncio.sleep(0.05)
+        for name, build in scenarios.items():
+            for duplicates in args.duplicates:
+                for enabled in (False, True):
+                    app_module.receipt_flight.enabled = enabled
+                    app_module.tax_flight.enabled = enabled
+                    result = await run_endpoint(client, build, args.bursts, duplicates, metrics_helper)
+                    results.append(dict({"endpoint": name, "duplicates": duplicates, "single_flight": enabled}, **result))
+                    print(json.dumps(results[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bursts", type=int, default=20)
+    parser.add_argument("--duplicates", type=int, nargs="+", default=[1, 2, 5])
+    parser.add_argument("--ttft", type=float, default=0.3, help="stub model seconds to first token")
+    parser.add_argument("--vision-ttft", type=float, default=1.0, help="stub vision model seconds to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=300.0)
+    parser.add_argument("--port", type=int, default=8094)
+    parser.add_argument("--llm-port", type=int, default=8095)
+    args = parser.parse_args()
+
+    os.environ.setdefault("JOB_DB_PATH", ":memory:")
+    os.environ["GROQ_API_KEY"] = "bench"
+    os.environ["GROQ_BASE_URL"] = f"http://127.0.0.1:{args.llm_port}"
+
+    from src import db_helper
+
+    fake_backends.install(db_helper)
+    from src import main as app_module
+
+    start_in_thread(args.llm_port, ttft=args.ttft, tokens_per_second=args.tokens_per_second, vision_ttft=args.vision_ttft)
+    serve_in_thread(app_module.app, args.port)
+    results = asyncio.run(run(args, app_module, State(1, make_image())))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
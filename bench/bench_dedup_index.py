@@ -0,0 +1,114 @@
+"""
+Duplicate receipt lookups against a large index: dedup_helper.DuplicateIndex
+(multi-index hashing over image hashes, dict over fingerprints) vs. a linear
+Hamming scan.
+
+Fills the index with --size receipts, then times find() for exact
+re-uploads (distance 0), near copies (a few bits flipped, fingerprint
+unknown), another user's copies (same fingerprint and image) and new
+receipts (misses). Receipt images look alike, so with
+--templates the hashes are drawn as noisy copies of a few hundred
+"layouts" rather than uniformly, which crowds the index's buckets.
+
+Usage:
+    python -m bench.bench_dedup_index [--size 1000000] [--queries 2000] [--templates 0]
+"""
+import argparse
+import json
+import random
+import resource
+import statistics
+import time
+
+from src.dedup_helper import HASH_BITS, DuplicateIndex, hamming
+
+
+def flip_bits(value: int, count: int, rng) -> int:
+    for bit in rng.sample(range(HASH_BITS), count):
+        value ^= 1 << bit
+    return value
+
+
+def make_hashes(size: int, templates: int, rng) -> list:
+    if not templates:
+        return [rng.getrandbits(HASH_BITS) for _ in range(size)]
+    layouts = [rng.getrandbits(HASH_BITS) for _ in range(templates)]
+    # Same layout, different content: mostly 8-20 bits apart
+    return [flip_bits(rng.choice(layouts), rng.randint(8, 20), rng) for _ in range(size)]
+
+
+def percentiles(samples: list) -> dict:
+    samples = sorted(samples)
+    return {
+        "p50_us": round(statistics.median(samples) * 1e6, 1),
+        "p99_us": round(samples[int(len(samples) * 0.99) - 1] * 1e6, 1),
+        "max_us": round(samples[-1] * 1e6, 1),
+    }
+
+
+def time_queries(index, queries):
+    timings = []
+    found = 0
+    for user_id, image_hash, fingerprint in queries:
+        start = time.perf_counter()
+        match = index.find(user_id, image_hash, fingerprint)
+        timings.append(time.perf_counter() - start)
+        found += match is not None
+    return dict(percentiles(timings), found=found, queries=len(queries))
+
+
+def linear_scan_us(hashes: list, value: int, max_distance: int, repeat: int = 3) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        [h for h in hashes if hamming(h, value) <= max_distance]
+        timings.append(time.perf_counter() - start)
+    return round(min(timings) * 1e6, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--templates", type=int, default=0, help="draw hashes around this many layouts (0: uniform)")
+    parser.add_argument("--max-distance", type=int, default=6)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    hashes = make_hashes(args.size, args.templates, rng)
+    fingerprints = [f"{rng.getrandbits(128):032x}" for _ in range(args.size)]
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    index = DuplicateIndex(max_distance=args.max_distance)
+    start = time.perf_counter()
+    users = [f"u{i % 50000}" for i in range(args.size)]
+    for i, image_hash in enumerate(hashes):
+        index.add(f"r{i}", users[i], image_hash, fingerprints[i])
+    build_s = time.perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    stored = rng.sample(range(args.size), args.queries)
+    results = {
+        "size": args.size,
+        "templates": args.templates,
+        "max_distance": args.max_distance,
+        "build_s": round(build_s, 1),
+        "index_rss_mb": round((rss_after - rss_before) / 1024, 1),
+        "exact_fingerprint": time_queries(index, [(users[i], hashes[i], fingerprints[i]) for i in stored]),
+        "exact_image": time_queries(index, [(users[i], hashes[i], None) for i in stored]),
+        "near_image": time_queries(
+            index, [(users[i], flip_bits(hashes[i], rng.randint(1, args.max_distance), rng), None) for i in stored]
+        ),
+        # Another user's copy of a stored receipt
+        "other_user": time_queries(index, [("someone-else", hashes[i], fingerprints[i]) for i in stored]),
+        "miss": time_queries(
+            index,
+            [(rng.choice(users), rng.getrandbits(HASH_BITS), f"{rng.getrandbits(128):032x}") for _ in range(args.queries)],
+        ),
+    }
+    results["linear_scan_us"] = linear_scan_us(hashes, hashes[stored[0]], args.max_distance)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
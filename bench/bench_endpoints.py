@@ -0,0 +1,489 @@
+"""
+Offline load test of every endpoint in src/main.py.
+
+Serves the real app with uvicorn, with its backends swapped for local fakes:
+Groq goes to bench.stub_llm_server, Firestore/GCS/Firebase Auth to the
+in-memory fakes in bench.fake_backends (or, with --firestore emulator, to
+the emulator at FIRESTORE_EMULATOR_HOST). Each endpoint is driven with
+--concurrency concurrent clients, reporting req/s, p50/p95/p99 latency,
+resident memory, and how many model calls and Firestore round trips it made.
+
+The isolation run checks that cheap requests stay fast while vision calls
+are in flight: /get-budgets-by-user latency idle vs. with
+--vision-inflight OCR requests outstanding.
+
+Results are saved as JSON (bench/results/<commit>.json by default); pass
+--compare <old.json> to print the change against an earlier run.
+
+Usage:
+    python -m bench.bench_endpoints [--requests 200] [--concurrency 16] [--endpoints get-budgets classify-tax]
+        [--ttft 0.3] [--vision-ttft 1.0] [--firestore-latency 0.01] [--compare bench/results/abc123.json]
+"""
+import argparse
+import asyncio
+import datetime
+import io
+import json
+import math
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import threading
+import time
+import uuid
+
+import httpx
+import uvicorn
+
+from bench import fake_backends
+from bench.stub_llm_server import start_in_thread
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+COMMON_ITEMS = ["Panadol 10s", "Gym membership", "Mineral water", "Children's storybook", "Broadband bill"]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))]
+
+
+def make_image():
+    """A phone-camera-sized JPEG, the shape of a typical receipt photo."""
+    from PIL import Image, ImageDraw
+
+    image = Image.new("RGB", (1200, 1600), "white")
+    draw = ImageDraw.Draw(image)
+    for row in range(40):
+        draw.text((60, 60 + row * 36), f"ITEM {row:02d}  ........  RM {row * 1.5:6.2f}", fill="black")
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def make_receipt(n: int, unique_items: int = 2) -> dict:
+    """
+    Receipt with a couple of line items everyone buys (cache and rule hits)
+    and a few unique to this request (model calls).
+    """
+    items = [COMMON_ITEMS[n % len(COMMON_ITEMS)]] + [f"Bench item {n}-{k}" for k in range(unique_items)]
+    day = datetime.date(2024, 1, 1) + datetime.timedelta(days=n % 365)
+    return {
+        "merchant_name": "Bench Hypermarket",
+        "transaction_datetime": f"{day.isoformat()}T10:15:00",
+        "line_items": [
+            {"description": item, "quantity": 1, "original_unit_price": 10.0, "total_price": 10.0}
+            for item in items
+        ],
+        "total_amount": 10.0 * len(items),
+        "currency_code": "MYR",
+        "expense_category": "Groceries",
+    }
+
+
+class State:
+    """Users, images and seeded ids shared by the request builders."""
+
+    def __init__(self, users: int, image: bytes):
+        self.users = [f"bench-user-{i}" for i in range(users)]
+        self.image = image
+        self.counter = 0
+        self.receipt_ids = {}
+        self.deletable = []
+        self.job_ids = {}
+
+    def next(self):
+        self.counter += 1
+        return self.counter
+
+    def user(self, n):
+        return self.users[n % len(self.users)]
+
+    def unique_image(self, n):
+        # Bytes after the JPEG end marker are ignored by decoders but change the OCR cache key
+        return self.image + f"bench-{n}-{uuid.uuid4().hex}".encode()
+
+    def unique_receipt(self, n):
+        # A merchant per request keeps receipts from being refused as duplicates of each other
+        return dict(make_receipt(n), merchant_name=f"Bench Hypermarket {uuid.uuid4().hex[:8]}")
+
+
+def endpoint_scenarios(state: State, batch_size: int):
+    """
+    (name, expected statuses, build) for every endpoint; build(n) returns the
+    httpx request arguments for the n-th request.
+    """
+    def image_file(n):
+        return {"file": (f"receipt-{n}.jpg", state.unique_image(n), "image/jpeg")}
+
+    def user_params(n, **params):
+        return dict(params, id_token=state.user(n))
+
+    def receipt_id(n):
+        ids = state.receipt_ids[state.user(n)]
+        return ids[n % len(ids)]
+
+    def batch_form(n):
+        return {"receipts": json.dumps([make_receipt(n * batch_size + k) for k in range(batch_size)])}
+
+    return [
+        ("root", {200}, lambda n: {"method": "GET", "url": "/"}),
+        ("ready", {200}, lambda n: {"method": "GET", "url": "/ready"}),
+        ("upload-reciept-image", {200}, lambda n: {
+            "method": "POST", "url": "/upload-reciept-image/", "files": image_file(n)}),
+        ("read-receipt-image", {200}, lambda n: {
+            "method": "POST", "url": "/read-receipt-image/", "files": image_file(n)}),
+        ("add-receipt", {200}, lambda n: {
+            "method": "POST", "url": "/add-receipt/", "files": image_file(n),
+            "params": user_params(n, receipt=json.dumps(state.unique_receipt(n)))}),
+        ("add-receipt-background", {202}, lambda n: {
+            "method": "POST", "url": "/add-receipt/", "files": image_file(n),
+            "params": user_params(n, receipt=json.dumps(state.unique_receipt(n)), background="true"),
+            "headers": {"Idempotency-Key": uuid.uuid4().hex}}),
+        # The stub vision model reads every image as the same receipt
+        ("scan-and-add-receipt", {200}, lambda n: {
+            "method": "POST", "url": "/scan-and-add-receipt/", "files": image_file(n),
+            "params": user_params(n, allow_duplicate="true")}),
+        ("add-receipts-batch", {200}, lambda n: {
+            "method": "POST", "url": "/add-receipts/batch", "data": batch_form(n), "params": user_params(n)}),
+        ("add-receipts-batch-stream", {200}, lambda n: {
+            "method": "POST", "url": "/add-receipts/batch", "data": batch_form(n),
+            "params": user_params(n, stream="true")}),
+        ("jobs", {200}, lambda n: {
+            "method": "GET", "url": f"/jobs/{state.job_ids[state.user(n)]}", "params": user_params(n)}),
+        ("job-events", {200}, lambda n: {
+            "method": "GET", "url": f"/jobs/{state.job_ids[state.user(n)]}/events", "params": user_params(n)}),
+        ("get-receipts-by-user", {200}, lambda n: {
+            "method": "GET", "url": "/get-receipts-by-user/", "params": user_params(n, limit=20)}),
+        ("get-receipts-by-user-ndjson", {200}, lambda n: {
+            "method": "GET", "url": "/get-receipts-by-user/", "params": user_params(n, format="ndjson")}),
+        # The archive downloads the image of every seeded receipt
+        ("export", {200}, lambda n: {"method": "GET", "url": "/export", "params": user_params(n)}),
+        ("get-username", {200}, lambda n: {
+            "method": "GET", "url": "/user/get-username/", "params": user_params(n)}),
+        ("get-achievements", {200}, lambda n: {
+            "method": "GET", "url": "/get-achievements-by-user", "params": user_params(n)}),
+        ("save-achievements", {200}, lambda n: {
+            "method": "POST", "url": "/save-achievements-by-user", "params": user_params(n),
+            "json": {"totalPoints": n, "progress": [
+                {"achievementId": "first_scan", "progress": 1.0, "isCompleted": True}]}}),
+        ("get-receipt-by-id", {200}, lambda n: {
+            "method": "GET", "url": "/get-receipt-by-id/", "params": {"receipt_id": receipt_id(n)}}),
+        ("cache-stats", {200}, lambda n: {"method": "GET", "url": "/cache-stats/"}),
+        ("metrics", {200}, lambda n: {"method": "GET", "url": "/metrics"}),
+        ("classify-tax", {200}, lambda n: {"method": "GET", "url": "/classify-tax/", "json": make_receipt(n)}),
+        ("classify-tax-stream", {200}, lambda n: {
+            "method": "POST", "url": "/classify-tax/stream", "json": make_receipt(n)}),
+        ("tax-summary", {200}, lambda n: {
+            "method": "GET", "url": "/tax-summary", "params": user_params(n, assessment_year="2024")}),
+        ("tax-summary-rebuild", {202}, lambda n: {
+            "method": "POST", "url": "/tax-summary/rebuild", "params": user_params(n)}),
+        ("get-budgets", {200}, lambda n: {
+            "method": "GET", "url": "/get-budgets-by-user", "params": user_params(n)}),
+        ("budget-status", {200}, lambda n: {
+            "method": "GET", "url": "/budget-status", "params": user_params(n, date="2024-03-15")}),
+        ("save-budgets", {200}, lambda n: {
+            "method": "POST", "url": "/save-budgets-by-user", "params": user_params(n),
+            "json": {"budgets": {"Groceries": {"limit": 800.0}}, "budgetPeriod": "monthly"}}),
+        ("delete-receipt-by-id", {200}, lambda n: {
+            "method": "DELETE", "url": "/delete-receipt-by-id",
+            "params": user_params(n, receipt_id=state.deletable.pop())}),
+    ]
+
+
+async def send(client, request):
+    """Send one request, reading streamed bodies to the end."""
+    start = time.perf_counter()
+    async with client.stream(**request) as response:
+        await response.aread()
+    return response.status_code, time.perf_counter() - start
+
+
+async def drive(client, build, requests: int, concurrency: int, expected: set):
+    latencies = []
+    statuses = {}
+    next_request = iter(range(requests))
+
+    async def worker():
+        for n in next_request:
+            try:
+                status, elapsed = await send(client, build(n))
+            except httpx.HTTPError as e:
+                status, elapsed = type(e).__name__, None
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if elapsed is not None and status in expected:
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - start
+    return latencies, statuses, wall
+
+
+def summarize(latencies, statuses, wall, requests):
+    latencies = sorted(latencies)
+
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+
+    return {
+        "requests": requests,
+        "ok": len(latencies),
+        "errors": requests - len(latencies),
+        "statuses": statuses,
+        "wall_s": round(wall, 3),
+        "req_per_s": round(len(latencies) / wall, 2) if wall else None,
+        "latency_ms": {
+            "mean": ms(statistics.fmean(latencies)) if latencies else None,
+            "p50": ms(percentile(latencies, 50)),
+            "p95": ms(percentile(latencies, 95)),
+            "p99": ms(percentile(latencies, 99)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+    }
+
+
+def serve_in_thread(app, port: int):
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+async def seed(db, state: State, receipts_per_user: int, deletable: int):
+    """Give every user receipts, budgets and achievements to read back."""
+    # A real blob so /export streams the images; deletable receipts keep a foreign URL
+    # so deleting them never removes it
+    image_url = await db.upload_to_bucket("receipts/bench-seed.jpg", io.BytesIO(state.image), "image/jpeg",
+                                          len(state.image))
+    for n, user_id in enumerate(state.users):
+        receipts = [(make_receipt(n * receipts_per_user + k), image_url)
+                    for k in range(receipts_per_user)]
+        state.receipt_ids[user_id] = await db.add_receipts_batch(receipts, user_id)
+        await db.save_user_budgets(user_id, {"budgets": {"Groceries": {"limit": 800.0}}, "budget_period": "monthly"})
+        await db.save_user_achievements(user_id, {"totalPoints": 0, "progress": []})
+    # Receipts for the delete endpoint to remove, owned by the users the requests authenticate as
+    for n in range(deletable):
+        user_id = state.user(n)
+        receipt_ids = await db.add_receipts_batch([(make_receipt(n), "https://bench.invalid/seed.jpg")], user_id)
+        state.deletable.insert(0, receipt_ids[0])
+
+
+async def seed_jobs(client, state: State):
+    """One finished background job per user for the job status endpoints."""
+    for n, user_id in enumerate(state.users):
+        response = await client.post(
+            "/add-receipt/", files={"file": ("seed.jpg", state.unique_image(n), "image/jpeg")},
+            params={"id_token": user_id, "receipt": json.dumps(state.unique_receipt(n)), "background": "true"},
+        )
+        state.job_ids[user_id] = response.json()["job_id"]
+    for user_id, job_id in state.job_ids.items():
+        while (await client.get(f"/jobs/{job_id}", params={"id_token": user_id})).json()["status"] not in (
+            "succeeded", "failed",
+        ):
+            await asyncio.sleep(0.05)
+
+
+async def isolation(client, state: State, requests: int, concurrency: int, vision_inflight: int):
+    """
+    Cheap-endpoint latency idle vs. while vision calls are outstanding, to
+    check slow model calls don't block the event loop.
+    """
+    def budgets(n):
+        return {"method": "GET", "url": "/get-budgets-by-user", "params": {"id_token": state.user(n)}}
+
+    idle = summarize(*await drive(client, budgets, requests, concurrency, {200}), requests)
+
+    stop = asyncio.Event()
+    vision_requests = 0
+
+    async def keep_vision_busy():
+        nonlocal vision_requests
+        while not stop.is_set():
+            n = state.next()
+            await send(client, {
+                "method": "POST", "url": "/read-receipt-image/",
+                "files": {"file": (f"busy-{n}.jpg", state.unique_image(n), "image/jpeg")},
+            })
+            vision_requests += 1
+
+    busy_tasks = [asyncio.create_task(keep_vision_busy()) for _ in range(vision_inflight)]
+    # Let the vision calls reach the model before measuring
+    await asyncio.sleep(0.5)
+    loaded = summarize(*await drive(client, budgets, requests, concurrency, {200}), requests)
+    stop.set()
+    await asyncio.gather(*busy_tasks, return_exceptions=True)
+
+    return {
+        "endpoint": "get-budgets",
+        "vision_inflight": vision_inflight,
+        "vision_requests_completed": vision_requests,
+        "idle": idle,
+        "with_vision_inflight": loaded,
+        "p99_ratio": round(loaded["latency_ms"]["p99"] / idle["latency_ms"]["p99"], 2)
+        if idle["latency_ms"]["p99"] and loaded["latency_ms"]["p99"] else None,
+    }
+
+
+async def run(args):
+    use_fake_firestore = args.firestore == "memory"
+    if not use_fake_firestore:
+        # The emulator still goes through a real Firebase app
+        fake_backends.ensure_placeholder_credentials()
+    os.environ.setdefault("JOB_DB_PATH", ":memory:")
+    # The app creates its Groq clients on first use, from the environment
+    os.environ["GROQ_API_KEY"] = "bench"
+    os.environ["GROQ_BASE_URL"] = f"http://127.0.0.1:{args.llm_port}"
+
+    from src import db_helper
+    from src import main
+
+    fakes = fake_backends.install(
+        db_helper,
+        firestore_latency=args.firestore_latency,
+        gcs_latency=args.gcs_latency,
+        auth_latency=args.auth_latency,
+        firestore=use_fake_firestore,
+    )
+
+    llm_server = start_in_thread(
+        args.llm_port, ttft=args.ttft, tokens_per_second=args.tokens_per_second, vision_ttft=args.vision_ttft,
+    )
+
+    state = State(args.users, make_image())
+    names = args.endpoints
+    deletable = args.requests if not names or "delete-receipt-by-id" in names else 0
+    await seed(db_helper, state, args.seed_receipts, deletable)
+
+    app_server = serve_in_thread(main.app, args.port)
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "endpoints": [],
+    }
+    limits = httpx.Limits(max_connections=args.concurrency + args.vision_inflight + 4)
+    try:
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{args.port}", limits=limits, timeout=args.timeout,
+        ) as client:
+            while (await client.get("/ready")).status_code != 200:
+                await asyncio.sleep(0.05)
+            await seed_jobs(client, state)
+            for name, expected, build in endpoint_scenarios(state, args.batch_size):
+                if names and name not in names:
+                    continue
+                llm_calls = llm_server.app.state.requests
+                round_trips = fakes.firestore.round_trips if fakes.firestore else None
+                offset = state.counter
+                state.counter += args.requests
+                latencies, statuses, wall = await drive(
+                    client, lambda n: build(offset + n), args.requests, args.concurrency, expected,
+                )
+                result = {"endpoint": name, **summarize(latencies, statuses, wall, args.requests)}
+                result["llm_calls"] = llm_server.app.state.requests - llm_calls
+                if fakes.firestore:
+                    result["firestore_round_trips"] = fakes.firestore.round_trips - round_trips
+                result["rss_mb"] = round(rss_mb(), 1)
+                results["endpoints"].append(result)
+                print(f"{name:28} {result['req_per_s'] or 0:9.1f} req/s  p50 {result['latency_ms']['p50']}"
+                      f"  p95 {result['latency_ms']['p95']}  p99 {result['latency_ms']['p99']} ms"
+                      f"  errors {result['errors']}", flush=True)
+
+            if not args.no_isolation:
+                results["isolation"] = await isolation(
+                    client, state, args.requests, args.concurrency, args.vision_inflight,
+                )
+    finally:
+        app_server.should_exit = True
+        llm_server.should_exit = True
+
+    results["peak_rss_mb"] = round(peak_rss_mb(), 1)
+    return results
+
+
+def compare(old: dict, new: dict):
+    """Print req/s and p95 changes per endpoint between two result files."""
+    old_endpoints = {result["endpoint"]: result for result in old["endpoints"]}
+    print(f"\n{'endpoint':28} {'req/s ' + old['commit'] + ' -> ' + new['commit']:>32} {'p95 ms':>28}")
+    for result in new["endpoints"]:
+        before = old_endpoints.get(result["endpoint"])
+        if before is None or not before["req_per_s"] or not result["req_per_s"]:
+            continue
+        p95_before, p95_after = before["latency_ms"]["p95"], result["latency_ms"]["p95"]
+        print(
+            f"{result['endpoint']:28} {before['req_per_s']:9.1f} -> {result['req_per_s']:9.1f}"
+            f" ({(result['req_per_s'] / before['req_per_s'] - 1) * 100:+6.1f}%)"
+            f" {p95_before:9.1f} -> {p95_after:9.1f} ({(p95_after / p95_before - 1) * 100:+6.1f}%)"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--endpoints", nargs="*", help="only these scenarios (default: all)")
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--seed-receipts", type=int, default=50, help="receipts seeded per user")
+    parser.add_argument("--batch-size", type=int, default=10, help="receipts per /add-receipts/batch request")
+    parser.add_argument("--ttft", type=float, default=0.3, help="stub model seconds to first token")
+    parser.add_argument("--vision-ttft", type=float, default=1.0, help="stub vision model seconds to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=300.0)
+    parser.add_argument("--firestore", choices=("memory", "emulator"), default="memory",
+                        help="in-memory fake, or the emulator at FIRESTORE_EMULATOR_HOST")
+    parser.add_argument("--firestore-latency", type=float, default=0.01, help="seconds per fake Firestore round trip")
+    parser.add_argument("--gcs-latency", type=float, default=0.05, help="seconds per fake GCS call")
+    parser.add_argument("--auth-latency", type=float, default=0.02, help="seconds per ID token verification")
+    parser.add_argument("--vision-inflight", type=int, default=16, help="OCR requests outstanding in the isolation run")
+    parser.add_argument("--no-isolation", action="store_true")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--llm-port", type=int, default=8091)
+    parser.add_argument("--output", help="results file (default: bench/results/<commit>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    if "isolation" in results:
+        print(json.dumps(results["isolation"], indent=2))
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
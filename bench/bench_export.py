@@ -0,0 +1,97 @@
+"""
+/export at growing receipt counts: archive throughput and the server's peak
+Python memory while streaming it.
+
+Serves the app with the in-memory fakes from bench.fake_backends, seeds one
+user with --receipts receipts, each with a --image-kb image in the fake
+bucket, and downloads the archive, discarding it as it arrives. Peak memory
+is traced from just before the request, so it covers building and sending
+the archive, not the seeded data. --concurrency runs each count with those
+EXPORT_CONCURRENCY values (1 downloads images one at a time).
+
+Usage:
+    python -m bench.bench_export [--receipts 100 1000 5000] [--image-kb 300] [--gcs-latency 0.02]
+"""
+import argparse
+import asyncio
+import json
+import time
+import tracemalloc
+import zlib
+
+import httpx
+
+from bench import fake_backends
+from bench.bench_endpoints import make_receipt, serve_in_thread
+
+USER_ID = "bench-export-user"
+
+
+def seed(fakes, receipts: int, image_bytes: int):
+    fakes.firestore.docs.clear()
+    fakes.bucket.blobs.clear()
+    for n in range(receipts):
+        blob_name = f"receipts/bench-{n}.jpg"
+        fakes.bucket.blobs[blob_name] = image_bytes
+        fakes.firestore.docs[f"receipts/bench{n:08d}"] = dict(
+            make_receipt(n),
+            user_id=USER_ID,
+            image_url=f"https://storage.googleapis.com/{fakes.bucket.name}/{blob_name}",
+            tax_summary={"total_tax_saved": 10.0, "exempt_items_count": 2, "taxable_items_count": 1, "taxable_items": []},
+        )
+
+
+async def download(port: int):
+    """Stream the archive; returns (bytes, crc32) without keeping it."""
+    size = 0
+    crc = 0
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=None) as client:
+        async with client.stream("GET", "/export", params={"id_token": USER_ID}) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                crc = zlib.crc32(chunk, crc)
+    return size, crc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--receipts", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--image-kb", type=int, default=300)
+    parser.add_argument("--gcs-latency", type=float, default=0.02)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--port", type=int, default=8093)
+    args = parser.parse_args()
+
+    from src import db_helper
+
+    fakes = fake_backends.install(db_helper, gcs_latency=args.gcs_latency)
+    from src import main as app_module
+
+    serve_in_thread(app_module.app, args.port)
+
+    results = []
+    for receipts in args.receipts:
+        seed(fakes, receipts, args.image_kb * 1024)
+        for concurrency in args.concurrency:
+            app_module.EXPORT_CONCURRENCY = concurrency
+            tracemalloc.start()
+            start = time.perf_counter()
+            size, _ = asyncio.run(download(args.port))
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results.append({
+                "receipts": receipts,
+                "concurrency": concurrency,
+                "archive_mb": round(size / 2 ** 20, 1),
+                "seconds": round(elapsed, 2),
+                "mb_per_s": round(size / 2 ** 20 / elapsed, 1),
+                "peak_traced_mb": round(peak / 2 ** 20, 1),
+            })
+            print(json.dumps(results[-1]))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
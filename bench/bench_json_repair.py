@@ -0,0 +1,179 @@
+"""
+Tax model responses that aren't clean JSON: the old cleanup (strip a ```json
+fence, add a brace at either end, else the whole classification is redone)
+vs. json_helper.recover_items plus a follow-up request for only the line
+items the response didn't cover.
+
+Reports, over a corpus of malformed responses, how many could be used at
+all, how many line items were recovered, and the tokens wasted: completion
+tokens thrown away plus the estimated prompt tokens of the requests made
+again.
+
+The default corpus is built from the labelled answers of
+bench/data/tax_eval.jsonl, rendered as the model does and broken the ways
+responses break in practice: fenced, wrapped in prose, with a trailing
+comma, and cut off at max_completion_tokens at several points. Real
+responses logged by the API ("Malformed tax response: {...}" on the
+tolaktax logger) can be replayed with --recorded, one logged JSON object
+per line.
+
+Usage:
+    python -m bench.bench_json_repair [--recorded malformed.jsonl]
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+
+from src.json_helper import recover_items
+from src.tax_helper import TaxPromptBuilder, compact_receipt
+
+TAX_PROMPT_PATH = os.path.join(os.path.dirname(__file__), "..", "src", "tax_prompt.txt")
+EVAL_PATH = os.path.join(os.path.dirname(__file__), "data", "tax_eval.jsonl")
+
+# Rough size of one model token, as in the stub LLM server
+CHARS_PER_TOKEN = 4
+
+# Fractions of the response kept when it is cut off
+TRUNCATE_AT = (0.3, 0.55, 0.8, 0.95)
+
+
+def legacy_parse(response_content):
+    """The cleanup classify_tax used before recover_items."""
+    try:
+        return json.loads(response_content)
+    except json.JSONDecodeError:
+        pass
+    cleaned_content = response_content.strip()
+    if cleaned_content.startswith("```json"):
+        match = re.search(r"```json\s*([\s\S]*?)\s*```", cleaned_content)
+        if match:
+            cleaned_content = match.group(1)
+    if not cleaned_content.startswith("{"):
+        cleaned_content = "{" + cleaned_content
+    if not cleaned_content.endswith("}"):
+        cleaned_content = cleaned_content + "}"
+    return json.loads(cleaned_content)
+
+
+def synthetic_corpus(path):
+    """Malformed variants of the labelled answers of an evaluation set."""
+    with open(path, "r") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    corpus = []
+    for record in records:
+        items = [dict(line_tax, index=i) for i, line_tax in enumerate(record["tax_classification"]["items"])]
+        answer = json.dumps({"items": items}, indent=1)
+        variants = {
+            "fenced": f"```json\n{answer}\n```",
+            "prose": f"Here is the classification:\n{answer}\nLet me know if you need anything else.",
+            "trailing_comma": answer.replace("}\n ]", "},\n ]"),
+        }
+        for fraction in TRUNCATE_AT:
+            variants[f"truncated_{int(fraction * 100)}"] = answer[:int(len(answer) * fraction)]
+        for shape, response in variants.items():
+            corpus.append({
+                "shape": shape,
+                "line_items": len(items),
+                "receipt": record["receipt"],
+                "response": response,
+            })
+    return corpus
+
+
+def recorded_corpus(path):
+    with open(path, "r") as f:
+        return [dict(json.loads(line), shape="recorded") for line in f if line.strip()]
+
+
+def prompt_tokens(builder, receipt, indexes):
+    """Estimated prompt tokens of a tax request for the line items at `indexes`."""
+    if receipt is None or not indexes:
+        return 0
+    subset = dict(receipt, line_items=[receipt["line_items"][i] for i in indexes])
+    return len(compact_receipt(receipt, indexes) + ";" + builder.build(subset)) // CHARS_PER_TOKEN
+
+
+def unused_tail(response, items, complete):
+    """Characters of a response not covered by its recovered items."""
+    if complete:
+        return 0
+    if not items:
+        return len(response)
+    # Items are flat objects, so the last "}" closes the last complete one
+    return len(response) - response.rfind("}") - 1
+
+
+def run(corpus, builder):
+    legacy = {"usable": 0, "items": 0, "wasted_completion": 0, "re_request_prompt": 0}
+    repaired = {"usable": 0, "items": 0, "wasted_completion": 0, "re_request_prompt": 0}
+    expected = 0
+    by_shape = {}
+
+    for case in corpus:
+        response, count, receipt = case["response"], case["line_items"], case.get("receipt")
+        expected += count
+        all_indexes = list(range(count))
+
+        try:
+            parsed = legacy_parse(response)
+            legacy_items = parsed.get("items", []) if isinstance(parsed, dict) else []
+        except json.JSONDecodeError:
+            legacy_items = None
+        if legacy_items is None:
+            # The client gets a 500 and classifies the whole receipt again
+            legacy["wasted_completion"] += len(response) // CHARS_PER_TOKEN
+            legacy["re_request_prompt"] += prompt_tokens(builder, receipt, all_indexes)
+        else:
+            legacy["usable"] += 1
+            legacy["items"] += min(len(legacy_items), count)
+
+        items, complete = recover_items(response)
+        recovered = min(len(items), count)
+        repaired["usable"] += bool(items)
+        repaired["items"] += recovered
+        repaired["wasted_completion"] += unused_tail(response, items, complete) // CHARS_PER_TOKEN
+        # Only the items the response didn't cover are asked for again
+        repaired["re_request_prompt"] += prompt_tokens(builder, receipt, all_indexes[recovered:])
+
+        shape = by_shape.setdefault(case["shape"], {"cases": 0, "legacy_usable": 0, "repaired_usable": 0})
+        shape["cases"] += 1
+        shape["legacy_usable"] += legacy_items is not None
+        shape["repaired_usable"] += bool(items)
+
+    def summary(totals):
+        return {
+            "parse_success_rate": round(totals["usable"] / len(corpus), 3),
+            "item_recovery_rate": round(totals["items"] / expected, 3) if expected else None,
+            "wasted_completion_tokens": totals["wasted_completion"],
+            "re_request_prompt_tokens_estimated": totals["re_request_prompt"],
+        }
+
+    return {
+        "responses": len(corpus),
+        "line_items": expected,
+        "legacy": summary(legacy),
+        "repaired": summary(repaired),
+        "by_shape": by_shape,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recorded", help="JSON lines of logged malformed responses")
+    parser.add_argument("--eval", default=EVAL_PATH, help="evaluation set the default corpus is built from")
+    args = parser.parse_args()
+
+    with open(TAX_PROMPT_PATH, "r") as f:
+        builder = TaxPromptBuilder(f.read())
+    corpus = recorded_corpus(args.recorded) if args.recorded else synthetic_corpus(args.eval)
+    results = run(corpus, builder)
+    results["response_tokens_mean"] = round(
+        statistics.fmean(len(case["response"]) // CHARS_PER_TOKEN for case in corpus), 1
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Cold start of the API: import time of src.main, and how long a fresh
+process takes to answer its first request, its first authenticated
+request, and to report /ready.
+
+Each run starts a new interpreter serving the app with the offline fakes
+from bench.fake_backends (no credentials or network needed), so the numbers
+cover interpreter start, imports, client setup and warm-up.
+
+Usage:
+    python -m bench.bench_startup [--repeat 5] [--port 8092]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+IMPORT_SNIPPET = (
+    "import time; start = time.perf_counter(); import src.main; print(time.perf_counter() - start)"
+)
+
+
+def bench_env():
+    env = dict(os.environ)
+    # Importing must not need credentials; client setup happens later
+    for name in ("FIREBASE_SERVICE_ACCOUNT_KEY", "GOOGLE_SERVICE_ACCOUNT_KEY"):
+        env.pop(name, None)
+    env["GROQ_API_KEY"] = "bench"
+    env.setdefault("JOB_DB_PATH", ":memory:")
+    return env
+
+
+def import_seconds():
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET], env=bench_env(), capture_output=True, text=True, check=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def wait_for(client, url, start, timeout, **params):
+    """Poll until the URL answers 200; seconds since start."""
+    while time.perf_counter() - start < timeout:
+        try:
+            if client.get(url, params=params).status_code == 200:
+                return time.perf_counter() - start
+        except httpx.TransportError:
+            pass
+        time.sleep(0.005)
+    raise TimeoutError(f"{url} not ready after {timeout}s")
+
+
+def cold_start(port: int, timeout: float):
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "bench.bench_startup", "--serve", "--port", str(port)],
+        env=bench_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=timeout) as client:
+            first_response = wait_for(client, "/", start, timeout)
+            # Sent straight away, so it usually races the warm-up and creates clients on first use
+            first_authenticated = wait_for(client, "/get-budgets-by-user", start, timeout, id_token="bench-user")
+            ready = wait_for(client, "/ready", start, timeout)
+    finally:
+        process.terminate()
+        process.wait()
+    return {
+        "first_response_s": first_response,
+        "first_authenticated_s": first_authenticated,
+        "ready_s": ready,
+    }
+
+
+def serve(port: int):
+    from bench import fake_backends
+    from src import db_helper
+
+    fake_backends.install(db_helper)
+    db_helper.get_db().docs["users/bench-user/settings/budgets"] = {"budgets": {}}
+
+    import uvicorn
+    from src import main
+
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8092)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.port)
+        return
+
+    imports = [import_seconds() for _ in range(args.repeat)]
+    starts = [cold_start(args.port, args.timeout) for _ in range(args.repeat)]
+    results = {"import_ms": round(statistics.median(imports) * 1000, 1)}
+    for key in starts[0]:
+        results[key[:-2] + "_ms"] = round(statistics.median(run[key] for run in starts) * 1000, 1)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Long receipts: tax classification latency by line item count, as one
+request or split into concurrent chunks.
+
+Runs classify_missing_line_taxes against the stub LLM server for receipts of
+--sizes line items (none the keyword rules or the cache would answer) in
+three configurations:
+
+    fixed_1024  one request with the old fixed max_completion_tokens=1024;
+                long receipts are cut off and their remaining items
+                re-requested
+    single      one request with max_completion_tokens sized from the items
+    chunked     chunks of --chunk-items, --chunk-concurrency at a time
+
+and checks that every configuration gives the same TaxSummary. Only the 70B
+model is used unless --small-model is given, so routing doesn't mix in.
+
+Usage:
+    python -m bench.bench_tax_chunking [--sizes 5 10 20 40 80] [--chunk-items 10] [--ttft 0.5] [--tokens-per-second 280]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+from bench import fake_backends
+from bench.stub_llm_server import start_in_thread
+
+
+def make_receipt(size: int) -> dict:
+    return {
+        "merchant_name": "Bench Hypermarket",
+        "transaction_datetime": "2024-03-01T10:15:00",
+        "line_items": [
+            {"description": f"Bench item {i}", "quantity": 1, "original_unit_price": 10.0, "total_price": 10.0}
+            for i in range(size)
+        ],
+        "total_amount": 10.0 * size,
+        "currency_code": "MYR",
+    }
+
+
+def model_requests(metrics_helper) -> int:
+    return int(sum(metrics_helper.LLM_REQUESTS._values.values()))
+
+
+def cut_off_responses(metrics_helper) -> int:
+    return int(sum(count for (_, outcome), count in metrics_helper.LLM_RESPONSES._values.items() if outcome != "valid"))
+
+
+async def classify(app_module, size: int):
+    from src import db_helper, metrics_helper
+
+    receipt = app_module.Receipt(**make_receipt(size)).model_dump()
+    missing = list(range(size))
+    requests, cut_off = model_requests(metrics_helper), cut_off_responses(metrics_helper)
+    start = time.perf_counter()
+    line_taxes, _ = await app_module.classify_missing_line_taxes(receipt, missing)
+    elapsed = time.perf_counter() - start
+    items = [line_taxes.get(i) for i in missing]
+    summary = db_helper.enrich_receipt_tax_info(receipt, {"items": items})["tax_summary"]
+    return {
+        "seconds": elapsed,
+        "model_requests": model_requests(metrics_helper) - requests,
+        "cut_off_responses": cut_off_responses(metrics_helper) - cut_off,
+        "unclassified": size - len(line_taxes),
+        "summary": summary,
+    }
+
+
+async def run(app_module, configs: dict, sizes: list, repeat: int) -> list:
+    results = []
+    for size in sizes:
+        row = {"line_items": size}
+        summaries = []
+        for name, (router, chunk_items) in configs.items():
+            app_module.tax_router = router
+            app_module.TAX_CHUNK_ITEMS = chunk_items
+            runs = [await classify(app_module, size) for _ in range(repeat)]
+            summaries.extend(run["summary"] for run in runs)
+            row[name] = {
+                "seconds": round(statistics.median(run["seconds"] for run in runs), 3),
+                "model_requests": runs[0]["model_requests"],
+                "cut_off_responses": runs[0]["cut_off_responses"],
+                "unclassified": runs[0]["unclassified"],
+            }
+        row["identical_summaries"] = all(summary == summaries[0] for summary in summaries)
+        results.append(row)
+        print(json.dumps(row))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5, 10, 20, 40, 80])
+    parser.add_argument("--chunk-items", type=int, default=10)
+    parser.add_argument("--chunk-concurrency", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--ttft", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=280.0)
+    parser.add_argument("--small-model", default="", help="route short chunks to this model too")
+    parser.add_argument("--llm-port", type=int, default=8099)
+    args = parser.parse_args()
+
+    os.environ.setdefault("JOB_DB_PATH", ":memory:")
+    os.environ["GROQ_API_KEY"] = "bench"
+    os.environ["GROQ_BASE_URL"] = f"http://127.0.0.1:{args.llm_port}"
+    from src import db_helper
+
+    fake_backends.install(db_helper)
+    from src import main as app_module
+    from src import tax_helper
+
+    start_in_thread(args.llm_port, ttft=args.ttft, tokens_per_second=args.tokens_per_second)
+    app_module.tax_flight.enabled = False
+    models = [model for model in (args.small_model, app_module.TAX_MODEL) if model]
+    configs = {
+        "fixed_1024": (tax_helper.TaxModelRouter(
+            models, app_module.tax_rules, tokens_per_item=0, base_tokens=1024, max_tokens=1024), 0),
+        "single": (tax_helper.TaxModelRouter(models, app_module.tax_rules), 0),
+        "chunked": (tax_helper.TaxModelRouter(models, app_module.tax_rules), args.chunk_items),
+    }
+    app_module.TAX_CHUNK_CONCURRENCY = args.chunk_concurrency
+
+    results = asyncio.run(run(app_module, configs, args.sizes, args.repeat))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Receipt payload sent to the tax model: str() of the full model_dump() vs.
+the compact encoding (tax_helper.compact_receipt).
+
+For every receipt of a sample corpus, reports the payload size in estimated
+tokens and the time to encode it. With --live both payloads are sent to the
+tax model (with the same prompt) and the reported prompt tokens and request
+latency are compared (needs GROQ_API_KEY).
+
+The corpus uses the recorded-output format of bench_tax_rules; by default
+the receipts of bench/data/tax_eval.jsonl.
+
+Usage:
+    python -m bench.bench_tax_payload [--recorded bench/data/tax_eval.jsonl] [--repeat 2000] [--live]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+from src.classes.Reciept import Receipt
+from src.tax_helper import compact_receipt
+
+TAX_PROMPT_PATH = os.path.join(os.path.dirname(__file__), "..", "src", "tax_prompt.txt")
+EVAL_PATH = os.path.join(os.path.dirname(__file__), "data", "tax_eval.jsonl")
+TAX_MODEL = "llama-3.3-70b-versatile"
+
+# Rough size of one model token, as in the stub LLM server
+CHARS_PER_TOKEN = 4
+
+ENCODINGS = {
+    "repr": lambda receipt: str(receipt),
+    "compact": compact_receipt,
+}
+
+
+def load_receipts(path):
+    with open(path, "r") as f:
+        # Round-trip through the model so every optional field is present, as in classify_tax
+        return [Receipt(**json.loads(line)["receipt"]).model_dump() for line in f if line.strip()]
+
+
+def encode_us(encode, receipts, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for receipt in receipts:
+            encode(receipt)
+    return (time.perf_counter() - start) / (repeat * len(receipts)) * 1e6
+
+
+async def live(receipts, tax_prompt):
+    from groq import AsyncGroq
+
+    client = AsyncGroq()
+    results = {}
+    for name, encode in ENCODINGS.items():
+        latencies = []
+        prompt_tokens = []
+        for receipt in receipts:
+            start = time.perf_counter()
+            completion = await client.chat.completions.create(
+                model=TAX_MODEL,
+                response_format={"type": "json_object"},
+                messages=[{"role": "user", "content": [{"type": "text", "text": encode(receipt) + ";" + tax_prompt}]}],
+                temperature=0,
+                max_completion_tokens=1024,
+            )
+            latencies.append(time.perf_counter() - start)
+            prompt_tokens.append(completion.usage.prompt_tokens)
+        results[name] = {
+            "prompt_tokens_mean": round(statistics.fmean(prompt_tokens), 1),
+            "latency_ms_median": round(statistics.median(latencies) * 1000, 1),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recorded", default=EVAL_PATH, help="JSON lines corpus of receipts")
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--live", action="store_true", help="also time real tax model calls (calls Groq)")
+    args = parser.parse_args()
+
+    receipts = load_receipts(args.recorded)
+    results = {"receipts": len(receipts)}
+    for name, encode in ENCODINGS.items():
+        tokens = [len(encode(receipt)) // CHARS_PER_TOKEN for receipt in receipts]
+        results[name] = {
+            "payload_tokens_estimated_mean": round(statistics.fmean(tokens), 1),
+            "payload_tokens_estimated_total": sum(tokens),
+            "encode_us": round(encode_us(encode, receipts, args.repeat), 2),
+        }
+    results["payload_token_reduction"] = round(
+        1 - results["compact"]["payload_tokens_estimated_total"] / results["repr"]["payload_tokens_estimated_total"], 3
+    )
+
+    if args.live:
+        with open(TAX_PROMPT_PATH, "r") as f:
+            results["live"] = asyncio.run(live(receipts, f.read()))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Tax prompt size and accuracy: full prompt vs. relevant-category retrieval.
+
+For every receipt of an evaluation set, builds the tax classification
+prompt both ways and reports prompt tokens per request and, for items the
+set labels eligible, how often retrieval kept their category's definition.
+With --live the tax model is called with both prompts and their answers
+are scored against the labels (needs GROQ_API_KEY).
+
+The evaluation set uses the recorded-output format of bench_tax_rules:
+    {"receipt": {...Receipt...}, "tax_classification": {"items": [...LineTax...]}}
+bench/data/tax_eval.jsonl is a small hand-labelled set.
+
+Usage:
+    python -m bench.bench_tax_prompt [--recorded bench/data/tax_eval.jsonl] [--max-categories 6] [--live]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+
+from src.tax_helper import TaxPromptBuilder, relief_category
+
+TAX_PROMPT_PATH = os.path.join(os.path.dirname(__file__), "..", "src", "tax_prompt.txt")
+EVAL_PATH = os.path.join(os.path.dirname(__file__), "data", "tax_eval.jsonl")
+TAX_MODEL = "llama-3.3-70b-versatile"
+
+# Rough size of one model token, as in the stub LLM server
+CHARS_PER_TOKEN = 4
+
+
+def load_eval(path):
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def expected_class(line_tax: dict):
+    return relief_category(line_tax.get("tax_class")) if line_tax.get("tax_eligible") else None
+
+
+async def classify(client, receipt: dict, tax_prompt: str):
+    completion = await client.chat.completions.create(
+        model=TAX_MODEL,
+        response_format={"type": "json_object"},
+        messages=[{"role": "user", "content": [{"type": "text", "text": str(receipt) + ";" + tax_prompt}]}],
+        temperature=0,
+        max_completion_tokens=1024,
+    )
+    return json.loads(completion.choices[0].message.content).get("items", []), completion.usage.prompt_tokens
+
+
+async def live_accuracy(records, prompts):
+    """Score the model's answers with each prompt variant against the labels."""
+    from groq import AsyncGroq
+
+    client = AsyncGroq()
+    results = {}
+    for name, build in prompts.items():
+        correct = total = 0
+        prompt_tokens = []
+        for record in records:
+            items, tokens = await classify(client, record["receipt"], build(record["receipt"]))
+            prompt_tokens.append(tokens)
+            for i, line_tax in enumerate(record["tax_classification"]["items"]):
+                answer = items[i] if i < len(items) and isinstance(items[i], dict) else {}
+                correct += expected_class(answer) == expected_class(line_tax)
+                total += 1
+        results[name] = {
+            "accuracy": round(correct / total, 3),
+            "prompt_tokens_mean": round(statistics.fmean(prompt_tokens), 1),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recorded", default=EVAL_PATH, help="JSON lines evaluation set")
+    parser.add_argument("--max-categories", type=int, default=6)
+    parser.add_argument("--live", action="store_true", help="also score the tax model's answers (calls Groq)")
+    args = parser.parse_args()
+
+    with open(TAX_PROMPT_PATH, "r") as f:
+        tax_prompt = f.read()
+    builder = TaxPromptBuilder(tax_prompt, max_categories=args.max_categories)
+    records = load_eval(args.recorded)
+
+    full_tokens = []
+    retrieved_tokens = []
+    selected_counts = []
+    kept = eligible = 0
+    for record in records:
+        receipt = record["receipt"]
+        full_tokens.append(len(str(receipt) + ";" + tax_prompt) // CHARS_PER_TOKEN)
+        retrieved_tokens.append(len(str(receipt) + ";" + builder.build(receipt)) // CHARS_PER_TOKEN)
+        selected = builder.relevant_categories(receipt)
+        selected_counts.append(len(selected))
+        for line_tax in record["tax_classification"]["items"]:
+            tax_class = expected_class(line_tax)
+            if tax_class is not None:
+                eligible += 1
+                kept += tax_class in selected
+
+    results = {
+        "receipts": len(records),
+        "prompt_tokens_estimated": {
+            "full_mean": round(statistics.fmean(full_tokens), 1),
+            "retrieved_mean": round(statistics.fmean(retrieved_tokens), 1),
+            "retrieved_min": min(retrieved_tokens),
+            "retrieved_max": max(retrieved_tokens),
+            "reduction": round(1 - sum(retrieved_tokens) / sum(full_tokens), 3),
+        },
+        "categories_per_prompt_mean": round(statistics.fmean(selected_counts), 2),
+        "eligible_items": eligible,
+        "retrieval_recall": round(kept / eligible, 3) if eligible else None,
+    }
+    if args.live:
+        results["live"] = asyncio.run(live_accuracy(records, {
+            "full": lambda receipt: tax_prompt,
+            "retrieved": builder.build,
+        }))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
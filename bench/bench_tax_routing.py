@@ -0,0 +1,177 @@
+"""
+Tax model routing: latency, model requests and completion tokens of
+classify_missing_line_taxes with the routing thresholds given, against the
+stub LLM server with a profile per model.
+
+Receipts are those of bench/data/tax_eval.jsonl plus larger ones made of
+their line items (--sizes), so the set mixes short, long and ambiguous
+receipts. Items the keyword rules classify confidently are left out, as
+prefill_line_taxes does; the line tax cache isn't used. Each configuration
+(every combination of --small-max-items, --max-ambiguous and
+--hedge-after) classifies every receipt --concurrency at a time, and
+"baseline" sends everything to the 70B model with the old fixed
+max_completion_tokens=1024. Long receipts are chunked as TAX_CHUNK_ITEMS
+says in every configuration.
+
+The default profiles make the 8B model fast with a slow tail, and the 70B
+model slower; pass --model-profile (as for bench.stub_llm_server) to match
+what production latencies look like.
+
+Usage:
+    python -m bench.bench_tax_routing [--small-max-items 4 8 16] [--hedge-after 1 2] [--budget 20]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import time
+
+from bench import fake_backends
+from bench.bench_endpoints import percentile
+from bench.stub_llm_server import parse_profile, start_in_thread
+
+EVAL_PATH = os.path.join(os.path.dirname(__file__), "data", "tax_eval.jsonl")
+
+SMALL_MODEL = "llama-3.1-8b-instant"
+LARGE_MODEL = "llama-3.3-70b-versatile"
+DEFAULT_PROFILES = {
+    SMALL_MODEL: "ttft=0.15,tokens_per_second=1200,slow_rate=0.05,slow_ttft=4",
+    LARGE_MODEL: "ttft=0.5,tokens_per_second=280,slow_rate=0.02,slow_ttft=6",
+}
+
+
+def make_receipts(path: str, sizes: list, per_size: int, rng) -> list:
+    with open(path, "r") as f:
+        receipts = [json.loads(line)["receipt"] for line in f if line.strip()]
+    pool = [item for receipt in receipts for item in receipt["line_items"]]
+    for size in sizes:
+        for _ in range(per_size):
+            receipts.append(dict(receipts[0], line_items=[rng.choice(pool) for _ in range(size)]))
+    return receipts
+
+
+def completion_tokens(metrics_helper) -> dict:
+    return {
+        model: tokens for (model, kind), tokens in metrics_helper.LLM_TOKENS._values.items() if kind == "completion"
+    }
+
+
+async def run_config(app_module, receipts: list, concurrency: int) -> dict:
+    from src import metrics_helper
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    unclassified = 0
+    items = 0
+
+    async def classify(receipt):
+        nonlocal unclassified, items
+        missing = [
+            i for i, item in enumerate(receipt["line_items"]) if app_module.tax_rules.classify_confident(item) is None
+        ]
+        if not missing:
+            return
+        async with semaphore:
+            start = time.perf_counter()
+            line_taxes, _ = await app_module.classify_missing_line_taxes(receipt, missing)
+            latencies.append(time.perf_counter() - start)
+        items += len(missing)
+        unclassified += len(missing) - len(line_taxes)
+
+    routes_before = dict(metrics_helper.TAX_ROUTES._values)
+    tokens_before = completion_tokens(metrics_helper)
+    start = time.perf_counter()
+    await asyncio.gather(*(classify(receipt) for receipt in receipts))
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    routes = {}
+    for (reason, model), count in metrics_helper.TAX_ROUTES._values.items():
+        count -= routes_before.get((reason, model), 0)
+        if count:
+            routes[f"{reason}:{model}"] = int(count)
+    tokens = {
+        model: int(count - tokens_before.get(model, 0)) for model, count in completion_tokens(metrics_helper).items()
+    }
+    return {
+        "classifications": len(latencies),
+        "items": items,
+        "unclassified_items": unclassified,
+        "wall_s": round(wall, 2),
+        "latency_ms": {
+            "mean": round(statistics.fmean(latencies) * 1000, 1),
+            "p50": round(percentile(latencies, 50) * 1000, 1),
+            "p95": round(percentile(latencies, 95) * 1000, 1),
+            "p99": round(percentile(latencies, 99) * 1000, 1),
+        },
+        "answered": routes,
+        "completion_tokens": {model: count for model, count in tokens.items() if count},
+    }
+
+
+async def run(app_module, configs: list, receipts: list, concurrency: int) -> list:
+    # One event loop for every configuration: the app's Groq client keeps its connections
+    from src import tax_helper
+
+    results = []
+    for name, router_args, hedge_after in configs:
+        router_args = dict(router_args)
+        app_module.tax_router = tax_helper.TaxModelRouter(router_args.pop("models"), app_module.tax_rules, **router_args)
+        app_module.TAX_HEDGE_AFTER_SECONDS = hedge_after
+        results.append(dict({"config": name}, **await run_config(app_module, receipts, concurrency)))
+        print(json.dumps(results[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--small-max-items", type=int, nargs="+", default=[4, 8, 16])
+    parser.add_argument("--max-ambiguous", type=int, nargs="+", default=[0])
+    parser.add_argument("--hedge-after", type=float, nargs="+", default=[1.0, 2.0])
+    parser.add_argument("--budget", type=float, default=20.0, help="TAX_LATENCY_BUDGET_SECONDS")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[6, 12, 25, 40], help="sizes of the larger receipts")
+    parser.add_argument("--per-size", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3, help="times each receipt is classified per configuration")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--model-profile", nargs=2, action="append", default=[], metavar=("MODEL", "PROFILE"))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--llm-port", type=int, default=8096)
+    args = parser.parse_args()
+
+    os.environ.setdefault("JOB_DB_PATH", ":memory:")
+    os.environ["GROQ_API_KEY"] = "bench"
+    os.environ["GROQ_BASE_URL"] = f"http://127.0.0.1:{args.llm_port}"
+    from src import db_helper
+
+    fake_backends.install(db_helper)
+    from src import main as app_module
+
+    profiles = dict(DEFAULT_PROFILES, **dict(args.model_profile))
+    start_in_thread(args.llm_port, model_profiles={model: parse_profile(text) for model, text in profiles.items()},
+                    seed=args.seed)
+    receipts = make_receipts(EVAL_PATH, args.sizes, args.per_size, random.Random(args.seed)) * args.repeat
+    # Every run asks the stub, whatever earlier runs asked
+    app_module.tax_flight.enabled = False
+    app_module.TAX_LATENCY_BUDGET_SECONDS = args.budget
+
+    configs = [("baseline", {"models": [LARGE_MODEL], "tokens_per_item": 0, "base_tokens": 1024, "max_tokens": 1024},
+                None)]
+    for small_max_items, max_ambiguous, hedge_after in itertools.product(
+        args.small_max_items, args.max_ambiguous, args.hedge_after
+    ):
+        configs.append((
+            f"small_max_items={small_max_items},max_ambiguous={max_ambiguous},hedge_after={hedge_after}",
+            {"models": [SMALL_MODEL, LARGE_MODEL], "small_max_items": small_max_items, "max_ambiguous": max_ambiguous},
+            hedge_after,
+        ))
+
+    results = {"receipts": len(receipts), "profiles": profiles, "budget_s": args.budget}
+    results["configs"] = asyncio.run(run(app_module, configs, receipts, args.concurrency))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
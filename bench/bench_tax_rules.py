@@ -0,0 +1,91 @@
+"""
+Offline benchmark for the keyword tax pre-classifier.
+
+Measures classification throughput and, given recorded model outputs, how
+often a confident rule match agrees with the tax model.
+
+Recorded outputs are JSON lines of the form
+    {"receipt": {...Receipt...}, "tax_classification": {"items": [...LineTax...]}}
+
+Usage:
+    python -m bench.bench_tax_rules [--recorded recorded_tax.jsonl] [--min-confidence 0.85]
+"""
+import argparse
+import json
+import os
+import time
+
+from src.tax_helper import RuleClassifier
+
+TAX_PROMPT_PATH = os.path.join(os.path.dirname(__file__), "..", "src", "tax_prompt.txt")
+
+
+def load_recorded(path):
+    """Return (item, line_tax) pairs from a recorded outputs file."""
+    pairs = []
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            items = record["receipt"].get("line_items", [])
+            line_taxes = record["tax_classification"].get("items", [])
+            pairs.extend(zip(items, line_taxes))
+    return pairs
+
+
+def keyword_items(classifier):
+    """Synthetic items, one per keyword, for throughput runs without recordings."""
+    return [
+        ({"description": f"{keyword} item", "total_price": 100.0}, None)
+        for keyword in classifier.keyword_categories
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recorded", help="JSON lines file of recorded tax model outputs")
+    parser.add_argument("--min-confidence", type=float, default=0.85)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    with open(TAX_PROMPT_PATH, "r") as f:
+        tax_prompt = f.read()
+
+    start = time.perf_counter()
+    classifier = RuleClassifier(tax_prompt, min_confidence=args.min_confidence)
+    build_ms = (time.perf_counter() - start) * 1000
+
+    pairs = load_recorded(args.recorded) if args.recorded else keyword_items(classifier)
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for item, _ in pairs:
+            classifier.classify(item)
+    elapsed = time.perf_counter() - start
+    classified = len(pairs) * args.repeat
+
+    results = {
+        "build_ms": round(build_ms, 3),
+        "items": len(pairs),
+        "items_per_second": round(classified / elapsed),
+        "us_per_item": round(elapsed / classified * 1e6, 3),
+    }
+
+    if args.recorded:
+        confident = agree = 0
+        for item, recorded in pairs:
+            line_tax = classifier.classify_confident(item)
+            if line_tax is None:
+                continue
+            confident += 1
+            if recorded.get("tax_eligible") and str(recorded.get("tax_class")) == line_tax["tax_class"]:
+                agree += 1
+        results["coverage"] = round(confident / len(pairs), 4) if pairs else 0.0
+        results["agreement"] = round(agree / confident, 4) if confident else 0.0
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Microbenchmark: Firebase ID token verification vs. a token cache hit.
+
+Verification is measured with google.auth.jwt.decode against a locally
+generated RS256 key and certificate, which is the signature check that
+firebase_admin.auth.verify_id_token performs once its public certificates
+are cached. A cache hit is the content_key hash plus a MemoryCache lookup.
+
+Usage:
+    python -m bench.bench_token_cache [--iterations 2000]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import time
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import crypt, jwt
+
+from src.cache_helper import MemoryCache, content_key
+
+
+def make_token():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "bench")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(1)
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    pem_key = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    ).decode()
+    signer = crypt.RSASigner.from_string(pem_key, key_id="bench")
+    issued_at = int(time.time())
+    payload = {
+        "iss": "https://securetoken.google.com/bench",
+        "aud": "bench",
+        "sub": "user",
+        "uid": "user",
+        "iat": issued_at,
+        "exp": issued_at + 3600,
+    }
+    token = jwt.encode(signer, payload).decode()
+    certs = {"bench": cert.public_bytes(serialization.Encoding.PEM).decode()}
+    return token, certs
+
+
+async def run(iterations):
+    token, certs = make_token()
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        jwt.decode(token, certs=certs, audience="bench", clock_skew_in_seconds=10)
+    verify_us = (time.perf_counter() - start) / iterations * 1e6
+
+    cache = MemoryCache("id_token", maxsize=10000)
+    await cache.set(content_key(token), "user", ttl=3600)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await cache.get(content_key(token))
+    hit_us = (time.perf_counter() - start) / iterations * 1e6
+
+    return {
+        "iterations": iterations,
+        "verify_us": round(verify_us, 2),
+        "cache_hit_us": round(hit_us, 2),
+        "speedup": round(verify_us / hit_us, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.iterations)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Local overhead of the receipt upload path, per MB of image.
+
+Compares the old temp-file upload (write the upload to disk, then upload from
+the path) with streaming the spooled upload file straight to the blob. The
+blob is a stand-in that drains the stream in GCS-sized chunks, so the numbers
+cover everything the API server does except the network transfer itself.
+
+Usage:
+    python -m bench.bench_upload [--sizes 1 4 12] [--repeat 20]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+CHUNK_SIZE = 4 * 1024 * 1024
+# Starlette spools uploads up to 1 MB in memory before rolling over to disk
+SPOOL_MAX_SIZE = 1024 * 1024
+
+
+class DrainingBlob:
+    """Consumes an upload in chunks the way a resumable session would."""
+
+    def upload_from_file(self, file_obj, size=None):
+        while file_obj.read(CHUNK_SIZE):
+            pass
+
+    def upload_from_filename(self, path):
+        with open(path, "rb") as f:
+            self.upload_from_file(f)
+
+
+def make_upload(payload):
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    spooled.write(payload)
+    spooled.seek(0)
+    return spooled
+
+
+def temp_file_upload(spooled, blob):
+    temp_file_path = f"temp_{os.getpid()}.jpg"
+    try:
+        with open(temp_file_path, "wb") as temp_file:
+            temp_file.write(spooled.read())
+        blob.upload_from_filename(temp_file_path)
+    finally:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+
+
+def streaming_upload(spooled, blob):
+    spooled.seek(0)
+    blob.upload_from_file(spooled)
+
+
+def measure(upload, payload, repeat):
+    blob = DrainingBlob()
+    elapsed = 0.0
+    peak = 0
+    for _ in range(repeat):
+        spooled = make_upload(payload)
+        tracemalloc.start()
+        start = time.perf_counter()
+        upload(spooled, blob)
+        elapsed += time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        spooled.close()
+    return elapsed / repeat, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 4, 12], help="image sizes in MB")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    results = []
+    for size_mb in args.sizes:
+        payload = os.urandom(size_mb * 1024 * 1024)
+        for name, upload in (("temp_file", temp_file_upload), ("streaming", streaming_upload)):
+            latency, peak = measure(upload, payload, args.repeat)
+            results.append({
+                "path": name,
+                "size_mb": size_mb,
+                "ms_per_mb": round(latency * 1000 / size_mb, 3),
+                "peak_mb": round(peak / (1024 * 1024), 2),
+            })
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+"""
+In-process stand-ins for Firestore, Cloud Storage and Firebase Auth, with
+configurable latency, so src.db_helper can run its real code paths offline.
+
+install() swaps them into src.db_helper before its clients are created:
+
+    from bench import fake_backends
+    from src import db_helper
+    fake_backends.install(db_helper, firestore_latency=0.01)
+
+FakeFirestore covers the slice of the async Firestore client the service
+uses: documents and subcollections, set (with merge and Increment
+transforms), delete, batches, transactions, and queries with equality and
+range filters, a single order_by, select, start_after and limit.
+"""
+import asyncio
+import base64
+import datetime
+import json
+import os
+import time
+import types
+import uuid
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1 import transforms
+
+
+def ensure_placeholder_credentials():
+    """
+    Fill in the service account environment src.db_helper reads when it
+    creates the real Firebase app (e.g. for the Firestore emulator) with a
+    throwaway key, when it isn't configured. Nothing ever authenticates with it.
+    """
+    if os.getenv("FIREBASE_SERVICE_ACCOUNT_KEY") and os.getenv("GOOGLE_SERVICE_ACCOUNT_KEY"):
+        return
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    service_account = {
+        "type": "service_account",
+        "project_id": "bench",
+        "private_key_id": "bench",
+        "private_key": key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ).decode(),
+        "client_email": "bench@bench.iam.gserviceaccount.com",
+        "client_id": "0",
+        "token_uri": "https://oauth2.googleapis.com/token",
+    }
+    # db_helper expects the str() of a base64 bytes literal, i.e. "b'...'"
+    encoded = str(base64.b64encode(json.dumps(service_account).encode()))
+    os.environ.setdefault("FIREBASE_SERVICE_ACCOUNT_KEY", encoded)
+    os.environ.setdefault("GOOGLE_SERVICE_ACCOUNT_KEY", encoded)
+    os.environ.setdefault("GOOGLE_BUCKET_NAME", "bench-receipts")
+    os.environ.setdefault("GROQ_API_KEY", "bench")
+
+
+# Firestore
+
+def _resolve(value, current):
+    if isinstance(value, transforms.Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if value is transforms.SERVER_TIMESTAMP:
+        return datetime.datetime.now(datetime.timezone.utc)
+    if value is transforms.DELETE_FIELD:
+        return None
+    if isinstance(value, dict):
+        return {key: _resolve(item, None) for key, item in value.items()}
+    return value
+
+
+def _merge(target: dict, data: dict):
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = _resolve(value, target.get(key))
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return json.loads(json.dumps(self._data, default=str)) if self._data is not None else None
+
+    def get(self, field):
+        value = self._data
+        for part in field.split("."):
+            value = value[part]
+        return value
+
+
+class FakeDocument:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        return FakeCollection(self._client, f"{self.path}/{name}")
+
+    async def get(self, transaction=None):
+        await self._client.wait()
+        return FakeSnapshot(self, self._client.docs.get(self.path))
+
+    async def set(self, data, merge=False):
+        await self._client.wait()
+        self._client.apply_set(self.path, data, merge)
+
+    async def delete(self):
+        await self._client.wait()
+        self._client.docs.pop(self.path, None)
+
+
+class FakeQuery:
+    _OPS = {
+        "==": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+    }
+
+    def __init__(self, client, path, filters=(), order=None, fields=None, cursor=None, limit_to=None):
+        self._client = client
+        self._path = path
+        self._filters = tuple(filters)
+        self._order = order
+        self._fields = fields
+        self._cursor = cursor
+        self._limit = limit_to
+
+    def _copy(self, **changes):
+        state = {
+            "filters": self._filters, "order": self._order, "fields": self._fields,
+            "cursor": self._cursor, "limit_to": self._limit,
+        }
+        state.update(changes)
+        return FakeQuery(self._client, self._path, **state)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, self._OPS[op], value),))
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._copy(order=(field, direction == "DESCENDING"))
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def start_after(self, snapshot):
+        return self._copy(cursor=snapshot.id)
+
+    def limit(self, count):
+        return self._copy(limit_to=count)
+
+    def _matches(self):
+        prefix = self._path + "/"
+        rows = []
+        for path, data in list(self._client.docs.items()):
+            if not path.startswith(prefix) or "/" in path[len(prefix):]:
+                continue
+            try:
+                if all(field in data and op(data[field], value) for field, op, value in self._filters):
+                    rows.append((path, data))
+            except TypeError:
+                continue
+        if self._order:
+            field, descending = self._order
+            rows = [row for row in rows if field in row[1]]
+            rows.sort(key=lambda row: (row[1][field], row[0]), reverse=descending)
+        if self._cursor is not None:
+            ids = [path.rsplit("/", 1)[-1] for path, _ in rows]
+            rows = rows[ids.index(self._cursor) + 1:] if self._cursor in ids else []
+        if self._limit:
+            rows = rows[:self._limit]
+        return rows
+
+    async def stream(self):
+        await self._client.wait()
+        for path, data in self._matches():
+            if self._fields is not None:
+                data = {field: data[field] for field in self._fields if field in data}
+            yield FakeSnapshot(FakeDocument(self._client, path), data)
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+
+    def document(self, document_id=None):
+        return FakeDocument(self._client, f"{self._path}/{document_id or uuid.uuid4().hex[:20]}")
+
+
+class FakeWriteBatch:
+    """Batched writes (and transaction writes) applied together on commit."""
+
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append((reference.path, data, merge))
+
+    def delete(self, reference):
+        self._writes.append((reference.path, None, False))
+
+    async def commit(self):
+        await self._client.wait()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for path, data, merge in self._writes:
+            if data is None:
+                self._client.docs.pop(path, None)
+            else:
+                self._client.apply_set(path, data, merge)
+        results = [types.SimpleNamespace(update_time=now) for _ in self._writes]
+        self._writes = []
+        return results
+
+
+class FakeFirestore:
+    """
+    In-memory async Firestore client. Every round trip (get, set, delete,
+    query, commit) waits `latency` seconds.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.docs = {}
+        self.round_trips = 0
+
+    async def wait(self):
+        self.round_trips += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def apply_set(self, path, data, merge):
+        if merge and path in self.docs:
+            _merge(self.docs[path], data)
+        else:
+            self.docs[path] = _resolve(data, None)
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self):
+        return FakeWriteBatch(self)
+
+
+def fake_async_transactional(func):
+    """Stand-in for async_transactional: run once, then commit the writes."""
+    async def run(transaction, *args, **kwargs):
+        result = await func(transaction, *args, **kwargs)
+        await transaction.commit()
+        return result
+    return run
+
+
+# Cloud Storage
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self._bucket = bucket
+        self.name = name
+
+    @property
+    def public_url(self):
+        return f"https://storage.googleapis.com/{self._bucket.name}/{self.name}"
+
+    def upload_from_file(self, file_obj, content_type=None, size=None, rewind=False):
+        if rewind:
+            file_obj.seek(0)
+        uploaded = 0
+        while True:
+            chunk = file_obj.read(self._bucket.chunk_size)
+            if not chunk:
+                break
+            uploaded += len(chunk)
+        time.sleep(self._bucket.latency)
+        self._bucket.blobs[self.name] = uploaded
+
+    def download_as_bytes(self):
+        time.sleep(self._bucket.latency)
+        if self.name not in self._bucket.blobs:
+            raise NotFound(f"No such object: {self._bucket.name}/{self.name}")
+        # Only sizes are kept; the content is filler of the uploaded length
+        return bytes(self._bucket.blobs[self.name])
+
+    def delete(self):
+        time.sleep(self._bucket.latency)
+        self._bucket.blobs.pop(self.name, None)
+
+
+class FakeBucket:
+    """
+    Bucket whose blobs drain uploads in chunks and record their size (and
+    download as that many filler bytes). Calls block for `latency` seconds,
+    like the SDK's, so they still go through db_helper's GCS thread pool.
+    """
+
+    def __init__(self, name: str = "bench-receipts", latency: float = 0.0, chunk_size: int = 4 * 1024 * 1024):
+        self.name = name
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.blobs = {}
+
+    def blob(self, blob_name, chunk_size=None):
+        return FakeBlob(self, blob_name)
+
+
+# Firebase Auth
+
+class FakeAuth:
+    """
+    Accepts any ID token; the token itself is the uid. Verification blocks
+    for `latency` seconds, like the Admin SDK's (which runs on a thread pool).
+    """
+
+    class UserNotFoundError(Exception):
+        pass
+
+    def __init__(self, latency: float = 0.0, token_lifetime: float = 3600):
+        self.latency = latency
+        self.token_lifetime = token_lifetime
+
+    def verify_id_token(self, id_token, app=None, clock_skew_seconds=0):
+        time.sleep(self.latency)
+        return {"uid": id_token, "exp": time.time() + self.token_lifetime}
+
+    def get_user(self, uid, app=None):
+        time.sleep(self.latency)
+        return types.SimpleNamespace(uid=uid, display_name=f"Bench {uid}", email=f"{uid}@bench.invalid")
+
+
+def install(db_module, firestore_latency: float = 0.0, gcs_latency: float = 0.0, auth_latency: float = 0.0,
+            firestore: bool = True):
+    """
+    Point db_helper at the fakes. With firestore=False the real Firestore
+    client is kept (e.g. talking to the emulator via FIRESTORE_EMULATOR_HOST).
+
+    Returns:
+        Namespace with the installed fakes (firestore is None when kept).
+    """
+    fakes = types.SimpleNamespace(
+        firestore=FakeFirestore(firestore_latency) if firestore else None,
+        bucket=FakeBucket(latency=gcs_latency),
+        auth=FakeAuth(latency=auth_latency),
+    )
+    if fakes.firestore is not None:
+        # Nothing needs the real Firebase app once Firestore and Auth are fake
+        db_module._firebase_app = object()
+        db_module._firestore_client = fakes.firestore
+        db_module.async_transactional = fake_async_transactional
+    db_module._receipt_bucket = fakes.bucket
+    db_module.auth = fakes.auth
+    return fakes
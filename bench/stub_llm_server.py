@@ -0,0 +1,226 @@
+"""
+Local stand-in for Groq's OpenAI-compatible chat completions API.
+
+Answers receipt OCR requests (messages with an image) with a fixed receipt
+and tax classification requests with one item per line item in the prompt,
+after a configurable time to first token and token rate. Supports both
+streamed (SSE) and non-streamed responses, and reports token usage.
+
+Models can be given their own profile (--model-profile MODEL key=value,...):
+ttft and tokens_per_second, a slow tail (slow_rate of requests wait
+slow_ttft before the first token), error_rate (503 over capacity) and
+drop_rate (each tax item left out of the answer with this probability).
+
+Point a client at it with base_url=http://127.0.0.1:<port> (Groq appends
+/openai/v1/chat/completions).
+
+Usage:
+    python -m bench.stub_llm_server [--port 8081] [--ttft 0.3] [--tokens-per-second 300]
+        [--model-profile llama-3.1-8b-instant ttft=0.1,tokens_per_second=1200,slow_rate=0.05,slow_ttft=3]
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Roughly how many characters one model token covers
+CHARS_PER_TOKEN = 4
+
+SAMPLE_RECEIPT = {
+    "merchant_name": "Stub Pharmacy",
+    "merchant_address": "1 Jalan Stub, Kuala Lumpur",
+    "transaction_datetime": "2024-03-01T10:15:00",
+    "line_items": [
+        {"description": "Panadol 10s", "quantity": 1, "original_unit_price": 12.5, "total_price": 12.5},
+        {"description": "Gym membership", "quantity": 1, "original_unit_price": 150.0, "total_price": 150.0},
+        {"description": "Mineral water", "quantity": 2, "original_unit_price": 1.2, "total_price": 2.4},
+    ],
+    "subtotal": 164.9,
+    "total_amount": 164.9,
+    "currency_code": "MYR",
+    "payment_method": "Cash",
+    "expense_category": "Health",
+}
+
+
+# A row of the compact receipt encoding: [index,"description",...]
+COMPACT_ROW_PATTERN = re.compile(r'\[(\d+),"')
+
+
+def line_item_indexes(prompt: str) -> list:
+    """Indexes of the line items in a tax prompt, whichever way the receipt was serialized."""
+    rows = [int(index) for index in COMPACT_ROW_PATTERN.findall(prompt)]
+    if rows:
+        return rows
+    return list(range(max(len(re.findall(r"""["']description["']""", prompt)), 1)))
+
+
+def count_line_items(prompt: str) -> int:
+    return len(line_item_indexes(prompt))
+
+
+def tax_items(indexes: list) -> dict:
+    return {
+        "items": [
+            {
+                "index": i,
+                "tax_eligible": i % 3 == 0,
+                "tax_class": "6" if i % 3 == 0 else "NA",
+                "tax_class_description": "Medical expenses" if i % 3 == 0 else "Not eligible",
+                "tax_amount": 10.0 if i % 3 == 0 else 0.0,
+            }
+            for i in indexes
+        ]
+    }
+
+
+PROFILE_KEYS = ("ttft", "tokens_per_second", "slow_rate", "slow_ttft", "error_rate", "drop_rate")
+
+
+def parse_profile(text: str) -> dict:
+    """'ttft=0.1,slow_rate=0.05' -> {"ttft": 0.1, "slow_rate": 0.05}"""
+    profile = {}
+    for pair in filter(None, text.split(",")):
+        key, _, value = pair.partition("=")
+        if key not in PROFILE_KEYS:
+            raise ValueError(f"Unknown model profile key: {key}")
+        profile[key] = float(value)
+    return profile
+
+
+def create_app(ttft: float = 0.3, tokens_per_second: float = 300.0, vision_ttft: float = None,
+               model_profiles: dict = None, seed: int = None):
+    app = FastAPI()
+    default_tokens_per_second = tokens_per_second
+    app.state.requests = 0
+    app.state.requests_by_model = {}
+    model_profiles = model_profiles or {}
+    rng = random.Random(seed)
+
+    @app.post("/openai/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.requests += 1
+        app.state.requests_by_model[body["model"]] = app.state.requests_by_model.get(body["model"], 0) + 1
+        profile = model_profiles.get(body["model"], {})
+        if rng.random() < profile.get("error_rate", 0.0):
+            return JSONResponse(
+                {"error": {"message": "Service over capacity", "type": "internal_server_error"}}, status_code=503
+            )
+        content = body["messages"][-1]["content"]
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        prompt = "".join(part.get("text", "") for part in parts if part.get("type") == "text")
+        is_vision = any(part.get("type") == "image_url" for part in parts)
+
+        if is_vision:
+            output = json.dumps(SAMPLE_RECEIPT)
+        else:
+            indexes = line_item_indexes(prompt)
+            drop_rate = profile.get("drop_rate", 0.0)
+            output = json.dumps(tax_items([i for i in indexes if rng.random() >= drop_rate]), indent=1)
+
+        max_tokens = body.get("max_completion_tokens") or body.get("max_tokens")
+        finish_reason = "stop"
+        if max_tokens and len(output) > max_tokens * CHARS_PER_TOKEN:
+            output = output[:max_tokens * CHARS_PER_TOKEN]
+            finish_reason = "length"
+
+        usage = {
+            "prompt_tokens": len(json.dumps(body["messages"])) // CHARS_PER_TOKEN,
+            "completion_tokens": len(output) // CHARS_PER_TOKEN,
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        first_token_delay = vision_ttft if is_vision and vision_ttft is not None else profile.get("ttft", ttft)
+        if rng.random() < profile.get("slow_rate", 0.0):
+            first_token_delay = profile.get("slow_ttft", first_token_delay)
+        tokens_per_second = profile.get("tokens_per_second", default_tokens_per_second)
+
+        if body.get("stream"):
+            async def chunks():
+                await asyncio.sleep(first_token_delay)
+                for start in range(0, len(output), CHARS_PER_TOKEN):
+                    chunk = {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": body["model"],
+                        "choices": [{
+                            "index": 0,
+                            "delta": {"role": "assistant", "content": output[start:start + CHARS_PER_TOKEN]},
+                            "finish_reason": None,
+                        }],
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                    await asyncio.sleep(1 / tokens_per_second)
+                final = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": body["model"],
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}],
+                    "x_groq": {"id": completion_id, "usage": usage},
+                }
+                yield f"data: {json.dumps(final)}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(chunks(), media_type="text/event-stream")
+
+        await asyncio.sleep(first_token_delay + usage["completion_tokens"] / tokens_per_second)
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": output},
+                "finish_reason": finish_reason,
+            }],
+            "usage": usage,
+        })
+
+    return app
+
+
+def start_in_thread(port: int, **kwargs):
+    """
+    Serve the stub on a background thread and return the uvicorn server once
+    it is accepting connections; set server.should_exit to stop it.
+    """
+    app = create_app(**kwargs)
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    server.app = app
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--ttft", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--vision-ttft", type=float, default=None, help="first-token delay for image requests")
+    parser.add_argument("--tokens-per-second", type=float, default=300.0)
+    parser.add_argument("--model-profile", nargs=2, action="append", default=[], metavar=("MODEL", "PROFILE"),
+                        help="per-model key=value,... overrides (%s)" % ", ".join(PROFILE_KEYS))
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    model_profiles = {model: parse_profile(profile) for model, profile in args.model_profile}
+    app = create_app(args.ttft, args.tokens_per_second, args.vision_ttft, model_profiles, args.seed)
+    uvicorn.run(app, host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""
+Backfill the per-user aggregate documents from existing receipts.
+
+Usage:
+    python -m src.backfill_aggregates [user_id ...]
+
+With no user IDs, every user that owns a receipt is rebuilt.
+"""
+import asyncio
+import sys
+
+from . import db_helper as db
+
+
+async def backfill(user_ids: list):
+    if not user_ids:
+        found = set()
+        async for receipt in db.get_receipt_collection().select(["user_id"]).stream():
+            user_id = receipt.to_dict().get("user_id")
+            if user_id:
+                found.add(user_id)
+        user_ids = sorted(found)
+
+    for user_id in user_ids:
+        receipt_count = await db.rebuild_user_aggregates(user_id)
+        print(f"Rebuilt aggregates for {user_id} from {receipt_count} receipts")
+
+
+if __name__ == "__main__":
+    asyncio.run(backfill(sys.argv[1:]))
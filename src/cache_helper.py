@@ -0,0 +1,228 @@
+from collections import OrderedDict
+import copy
+import hashlib
+import logging
+import time
+
+logger = logging.getLogger("tolaktax")
+
+
+def content_key(*parts) -> str:
+    """
+    Build a stable cache key from raw bytes and/or strings.
+
+    Parts are hashed in order with a separator so ("ab", "c") and ("a", "bc")
+    never collide.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(part)
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class MemoryCache:
+    """
+    In-process LRU cache with an optional per-entry TTL and a size bound.
+    Values are copied in and out, so callers can modify what they get back
+    (or what they stored) without changing the cached entry.
+    """
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return copy.deepcopy(value)
+
+    async def set(self, key: str, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else None
+        self._entries[key] = (copy.deepcopy(value), expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def delete(self, key: str):
+        self._entries.pop(key, None)
+
+    async def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": "memory",
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class FirestoreCache:
+    """
+    Cache stored as one document per key in a Firestore collection, so results
+    survive restarts and are shared between workers.
+
+    `collection` may be a function returning the collection, so the Firestore
+    client isn't created until the cache is first used. Firestore errors are
+    logged and count as a miss (or a skipped write), so an unavailable cache
+    doesn't fail the request using it.
+    """
+
+    def __init__(self, name: str, collection, ttl: float = None):
+        self.name = name
+        self._collection = collection
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def collection(self):
+        if callable(self._collection):
+            self._collection = self._collection()
+        return self._collection
+
+    async def get(self, key: str):
+        value, _ = await self.get_entry(key)
+        return value
+
+    async def get_entry(self, key: str):
+        """
+        Returns:
+            (value, expires_at) for a live entry, (None, None) otherwise.
+        """
+        try:
+            doc = await self.collection.document(key).get()
+        except Exception as e:
+            logger.warning("Cache %s: Firestore read failed, treating as a miss: %s", self.name, e)
+            self.misses += 1
+            return None, None
+        if not doc.exists:
+            self.misses += 1
+            return None, None
+
+        entry = doc.to_dict()
+        expires_at = entry.get("expires_at")
+        if expires_at is not None and expires_at <= time.time():
+            self.misses += 1
+            return None, None
+
+        self.hits += 1
+        return entry.get("value"), expires_at
+
+    async def set(self, key: str, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        try:
+            await self.collection.document(key).set({
+                "value": value,
+                "expires_at": time.time() + ttl if ttl else None,
+            })
+        except Exception as e:
+            logger.warning("Cache %s: Firestore write failed, not cached: %s", self.name, e)
+
+    async def delete(self, key: str):
+        await self.collection.document(key).delete()
+
+    async def clear(self):
+        async for doc in self.collection.stream():
+            await doc.reference.delete()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "backend": "firestore",
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class TieredCache:
+    """
+    Memory cache in front of a shared backing cache. Hits in the backing tier
+    are promoted into memory for no longer than they have left to live.
+    """
+
+    def __init__(self, name: str, memory: MemoryCache, backing):
+        self.name = name
+        self.memory = memory
+        self.backing = backing
+
+    async def get(self, key: str):
+        value = await self.memory.get(key)
+        if value is not None:
+            return value
+
+        value, expires_at = await self.backing.get_entry(key)
+        if value is not None:
+            ttl = None
+            if expires_at is not None:
+                ttl = expires_at - time.time()
+                if self.memory.ttl:
+                    ttl = min(ttl, self.memory.ttl)
+            if ttl is None or ttl > 0:
+                await self.memory.set(key, value, ttl)
+        return value
+
+    async def set(self, key: str, value, ttl: float = None):
+        await self.memory.set(key, value, ttl)
+        await self.backing.set(key, value, ttl)
+
+    async def delete(self, key: str):
+        await self.memory.delete(key)
+        await self.backing.delete(key)
+
+    async def clear(self):
+        await self.memory.clear()
+        await self.backing.clear()
+
+    def stats(self) -> dict:
+        return {
+            "backend": "tiered",
+            "memory": self.memory.stats(),
+            "backing": self.backing.stats(),
+        }
+
+
+def build_cache(name: str, backend: str = "memory", maxsize: int = 1024, ttl: float = None, collection=None):
+    """
+    Create a cache for the given backend name: "memory", "firestore" or
+    "tiered" (memory in front of Firestore). Firestore-backed caches need the
+    collection to store entries in, or a function returning it.
+    """
+    if backend == "memory":
+        return MemoryCache(name, maxsize=maxsize, ttl=ttl)
+    if backend == "firestore":
+        return FirestoreCache(name, collection, ttl=ttl)
+    if backend == "tiered":
+        return TieredCache(
+            name,
+            MemoryCache(name, maxsize=maxsize, ttl=ttl),
+            FirestoreCache(name, collection, ttl=ttl),
+        )
+    raise ValueError(f"Unknown cache backend: {backend}")
@@ -1,16 +1,28 @@
 import firebase_admin
-from firebase_admin import credentials, firestore, auth
+from firebase_admin import credentials, firestore, firestore_async, auth
 from dotenv import load_dotenv
 from .classes.Reciept import LineTax, TaxSummary
+from . import cache_helper
+from . import tax_helper
+from . import metrics_helper
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import datetime
+import functools
 import json
 import base64
-import re
+import logging
 import os
-from google.cloud import storage
+import threading
+import time
+import urllib.parse
+from google.cloud.firestore_v1.async_transaction import async_transactional
 
 
 
 load_dotenv()
+logger = logging.getLogger("tolaktax")
+
 def get_firebase_credentials():
     firebase_encoded_key = os.getenv("FIREBASE_SERVICE_ACCOUNT_KEY")
     firebase_encoded_key = str(firebase_encoded_key)[2:-1]
@@ -22,92 +34,487 @@ def get_google_credentials():
     return json.loads(base64.b64decode(google_encoded_key).decode('utf-8'))
 
 
-firebase_sak = get_firebase_credentials()
-google_sak = get_google_credentials()
-
+# Clients are created on first use (or by warm_up() at startup) instead of at
+# import, so importing this module needs no credentials and stays cheap.
+_clients_lock = threading.Lock()
+_firebase_app = None
+_firestore_client = None
+_receipt_bucket = None
 
-# Initialize Firebase with the service account key file
-cred = credentials.Certificate(firebase_sak)
-firebase_admin.initialize_app(cred)
-
-#Google Cloud Storage client
-google_bucket = storage.Client.from_service_account_info(google_sak)
+def get_firebase_app():
+    """
+    The Firebase app, initialized from the service account key on first use.
+    Firebase Auth calls go through it too.
+    """
+    global _firebase_app
+    if _firebase_app is None:
+        with _clients_lock:
+            if _firebase_app is None:
+                _firebase_app = firebase_admin.initialize_app(credentials.Certificate(get_firebase_credentials()))
+    return _firebase_app
+
+def get_db():
+    """
+    The shared async Firestore client.
+    """
+    global _firestore_client
+    if _firestore_client is None:
+        app = get_firebase_app()
+        with _clients_lock:
+            if _firestore_client is None:
+                _firestore_client = firestore_async.client(app)
+    return _firestore_client
+
+def get_receipt_bucket():
+    """
+    The receipts bucket. bucket() builds the handle without the metadata
+    round trip that get_bucket() makes on every call.
+    """
+    global _receipt_bucket
+    if _receipt_bucket is None:
+        with _clients_lock:
+            if _receipt_bucket is None:
+                # Imported here: the storage SDK alone adds ~0.3s to import time
+                from google.cloud import storage
+                google_bucket = storage.Client.from_service_account_info(get_google_credentials())
+                _receipt_bucket = google_bucket.bucket(os.getenv("GOOGLE_BUCKET_NAME"))
+    return _receipt_bucket
+
+async def warm_up():
+    """
+    Create every client and make one Firestore round trip, so the first
+    requests don't pay for credential parsing, client setup or connecting.
+    """
+    await asyncio.to_thread(get_receipt_bucket)
+    await asyncio.to_thread(get_firebase_app)
+    await get_db().collection("users").document("_warmup").get()
+
+# The GCS and Firebase Auth SDKs only ship blocking clients, so their calls run
+# on bounded thread pools (sized per backend) instead of on the event loop.
+gcs_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("GCS_MAX_WORKERS", "8")), thread_name_prefix="gcs"
+)
+auth_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("AUTH_MAX_WORKERS", "4")), thread_name_prefix="auth"
+)
+
+async def run_blocking(executor, func, *args, **kwargs):
+    """
+    Run a blocking SDK call on the given executor and await its result.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
 
-db = firestore.client()
+# Uploads larger than the multipart limit go through a resumable session in
+# chunks of this size (must be a multiple of 256 KiB).
+UPLOAD_CHUNK_SIZE = int(os.getenv("GCS_UPLOAD_CHUNK_SIZE", str(4 * 1024 * 1024)))
 
-def upload_to_bucket(blob_name, path_to_file, bucket_name):
-    """ Upload data to a bucket"""
-     
-    bucket = google_bucket.get_bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    blob.upload_from_filename(path_to_file)
+def _upload_to_bucket_sync(blob_name, file_obj, content_type=None, size=None):
+    blob = get_receipt_bucket().blob(blob_name, chunk_size=UPLOAD_CHUNK_SIZE)
+    blob.upload_from_file(file_obj, content_type=content_type, size=size, rewind=True)
     
     #returns a public url
     return blob.public_url
 
+@metrics_helper.timed("gcs:upload")
+async def upload_to_bucket(blob_name, file_obj, content_type=None, size=None):
+    """
+    Stream a file-like object (e.g. an UploadFile's spooled file) straight to
+    the receipts bucket without writing it to local disk first.
+    """
+    return await run_blocking(gcs_executor, _upload_to_bucket_sync, blob_name, file_obj, content_type, size)
+
+def _delete_from_bucket_sync(blob_name):
+    get_receipt_bucket().blob(blob_name).delete()
+
+@metrics_helper.timed("gcs:delete")
+async def delete_from_bucket(blob_name):
+    """ Delete a blob from the receipts bucket, ignoring failures"""
+    try:
+        await run_blocking(gcs_executor, _delete_from_bucket_sync, blob_name)
+    except Exception as e:
+        logger.warning("Error deleting blob %s: %s", blob_name, e)
+
+def blob_name_from_url(image_url: str):
+    """
+    Blob name of a receipts bucket public URL (as returned by
+    upload_to_bucket), or None for any other URL.
+    """
+    prefix = f"https://storage.googleapis.com/{get_receipt_bucket().name}/"
+    if not image_url or not image_url.startswith(prefix):
+        return None
+    return urllib.parse.unquote(image_url[len(prefix):])
+
+def _download_from_bucket_sync(blob_name):
+    return get_receipt_bucket().blob(blob_name).download_as_bytes()
+
+@metrics_helper.timed("gcs:download")
+async def download_from_bucket(blob_name):
+    """Read a blob of the receipts bucket into memory."""
+    return await run_blocking(gcs_executor, _download_from_bucket_sync, blob_name)
+
+
+# Verified ID tokens, keyed by token hash, kept until shortly before they expire
+TOKEN_CACHE_SKEW_SECONDS = int(os.getenv("TOKEN_CACHE_SKEW_SECONDS", "30"))
+token_cache = cache_helper.MemoryCache(
+    "id_token", maxsize=int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+)
+
+@metrics_helper.timed("auth:verify_id_token")
+async def get_uid_from_id_token(id_token):
+    cache_key = cache_helper.content_key(id_token)
+    uid = await token_cache.get(cache_key)
+    if uid is not None:
+        return uid
 
-def get_uid_from_id_token(id_token):
     try:
-        decoded_token = auth.verify_id_token(id_token,clock_skew_seconds=10)
+        decoded_token = await run_blocking(
+            auth_executor, auth.verify_id_token, id_token, app=get_firebase_app(), clock_skew_seconds=10
+        )
         uid = decoded_token['uid']
+        ttl = decoded_token.get('exp', 0) - time.time() - TOKEN_CACHE_SKEW_SECONDS
+        if ttl > 0:
+            await token_cache.set(cache_key, uid, ttl=ttl)
         return uid
     except Exception as e:
         print(f"Error verifying token: {e}")
         return None
 
-def get_receipt_by_id(receipt_id: str):
+@metrics_helper.timed("firestore:get_receipt")
+async def get_receipt_by_id(receipt_id: str):
     """
     Get a receipt by its ID.
     """
-    return db.collection("receipts").document(receipt_id).get()
+    return await get_db().collection("receipts").document(receipt_id).get()
 
 def get_receipt_collection():
     """
     Get the Firestore collection for receipts.
     """
-    return db.collection("receipts")
+    return get_db().collection("receipts")
+
+
+# Receipt rollups: per-user aggregate documents kept in step with the
+# receipts collection by applying signed deltas on every add and delete.
+
+def _assessment_year(receipt_data: dict) -> str:
+    return str(receipt_data.get("transaction_datetime") or "")[:4] or "unknown"
+
+def _tax_summary_ref(user_id: str, assessment_year: str):
+    return get_db().collection("users").document(user_id).collection("tax_summary").document(assessment_year)
+
+def _tax_summary_delta(receipt_data: dict, sign: int) -> dict:
+    """
+    Change a receipt makes to its assessment year's tax summary: claimed
+    amount and item count per relief category.
+    """
+    classes = {}
+    total_claimed = 0.0
+    for item in receipt_data.get("line_items") or []:
+        line_tax = item.get("line_tax")
+        if not line_tax or not line_tax.get("tax_eligible"):
+            continue
+        category = tax_helper.relief_category(line_tax.get("tax_class"))
+        if category is None:
+            continue
+        amount = sign * (line_tax.get("tax_amount") or 0.0)
+        entry = classes.setdefault(category, {"claimed": 0.0, "items": 0})
+        entry["claimed"] += amount
+        entry["items"] += sign
+        total_claimed += amount
+
+    return {
+        "assessment_year": _assessment_year(receipt_data),
+        "receipt_count": sign,
+        "total_claimed": total_claimed,
+        "classes": classes,
+    }
+
+# Budget periods spend is rolled up for; budgets without a period use monthly
+BUDGET_PERIODS = ("weekly", "monthly", "yearly")
+DEFAULT_BUDGET_PERIOD = "monthly"
+
+def budget_period_key(period: str, date: datetime.date) -> str:
+    """
+    Identifier of the budget period containing a date, e.g. "monthly_2024-05",
+    "weekly_2024-W18" or "yearly_2024".
+    """
+    if period == "weekly":
+        iso_year, iso_week, _ = date.isocalendar()
+        return f"weekly_{iso_year}-W{iso_week:02d}"
+    if period == "yearly":
+        return f"yearly_{date.year}"
+    return f"monthly_{date.year}-{date.month:02d}"
 
+def _spend_rollup_ref(user_id: str, period_key: str):
+    return get_db().collection("users").document(user_id).collection("spend_rollups").document(period_key)
 
-def add_receipt(receipt_data: dict, user_id: str,image_url: str):
+def _spend_rollups(receipt_data: dict, user_id: str, sign: int) -> list:
+    """
+    Spend per expense category added to every budget period the receipt
+    falls in.
+    """
+    try:
+        date = datetime.date.fromisoformat(str(receipt_data.get("transaction_datetime"))[:10])
+    except ValueError:
+        return []
+
+    category = receipt_data.get("expense_category") or "Uncategorized"
+    delta = {
+        "receipt_count": sign,
+        "total_spent": sign * (receipt_data.get("total_amount") or 0.0),
+        "categories": {
+            category: {"spent": sign * (receipt_data.get("total_amount") or 0.0), "receipts": sign},
+        },
+    }
+    return [
+        (_spend_rollup_ref(user_id, budget_period_key(period, date)), dict(delta, period=period))
+        for period in BUDGET_PERIODS
+    ]
+
+def _receipt_rollups(receipt_data: dict, user_id: str, sign: int) -> list:
+    """
+    Aggregate documents affected by adding (sign=1) or deleting (sign=-1)
+    a receipt, as (document reference, delta) pairs.
+    """
+    if not user_id:
+        return []
+    return [
+        (_tax_summary_ref(user_id, _assessment_year(receipt_data)), _tax_summary_delta(receipt_data, sign)),
+    ] + _spend_rollups(receipt_data, user_id, sign)
+
+def _merge_delta(target: dict, delta: dict):
+    for key, value in delta.items():
+        if isinstance(value, dict):
+            _merge_delta(target.setdefault(key, {}), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and key in target:
+            target[key] += value
+        else:
+            target[key] = value
+
+def _merge_rollups(pending: dict, rollups: list):
+    """
+    Fold rollups into `pending` ({path: (ref, delta)}) so each aggregate
+    document is written once per batch.
+    """
+    for ref, delta in rollups:
+        if ref.path in pending:
+            _merge_delta(pending[ref.path][1], delta)
+        else:
+            pending[ref.path] = (ref, json.loads(json.dumps(delta)))
+
+def _as_increments(delta: dict) -> dict:
+    return {
+        key: _as_increments(value) if isinstance(value, dict)
+        else firestore.Increment(value) if isinstance(value, (int, float)) and not isinstance(value, bool)
+        else value
+        for key, value in delta.items()
+    }
+
+def _write_rollups(writer, pending: dict):
+    """
+    Queue the aggregate updates on a batch or transaction as atomic
+    increments merged into the existing documents.
+    """
+    for ref, delta in pending.values():
+        data = _as_increments(delta)
+        data["lastUpdated"] = firestore.SERVER_TIMESTAMP
+        writer.set(ref, data, merge=True)
+
+
+@metrics_helper.timed("firestore:add_receipt")
+async def add_receipt(receipt_data: dict, user_id: str,image_url: str):
     """
     Add a new receipt to the Firestore collection and associate it with a user.
+
+    The user's aggregate documents are updated in the same atomic write.
     
     Args:
         receipt_data (dict): The receipt data to store
         user_id (str): The ID of the user who owns this receipt
     
     Returns:
-        The document reference of the newly created receipt
+        (update_time, document reference) of the newly created receipt
     """
     # Add the user_id to the receipt data
     receipt_data["user_id"] = user_id
     receipt_data["image_url"] = image_url
-    # Add the receipt to Firestore
-    doc_ref = db.collection("receipts").add(receipt_data)
+
+    doc_ref = get_db().collection("receipts").document()
+    pending = {}
+    _merge_rollups(pending, _receipt_rollups(receipt_data, user_id, 1))
+
+    batch = get_db().batch()
+    batch.set(doc_ref, receipt_data)
+    _write_rollups(batch, pending)
+    write_results = await batch.commit()
     
-    return doc_ref
+    return write_results[0].update_time, doc_ref
+
+# Firestore caps a batched write at 500 operations
+BATCH_WRITE_LIMIT = 500
 
-def get_user_receipts(user_id: str):
+@metrics_helper.timed("firestore:add_receipts_batch")
+async def add_receipts_batch(receipts: list, user_id: str):
     """
-    Get all receipts belonging to a specific user.
+    Add many receipts for a user using batched writes, updating the user's
+    aggregate documents in the same batches.
+    
+    Args:
+        receipts (list): (receipt_data, image_url) pairs to store
+        user_id (str): The ID of the user who owns these receipts
+    
+    Returns:
+        The new receipt IDs, in the same order as receipts
+    """
+    receipt_ids = []
+    batch = get_db().batch()
+    batch_receipts = 0
+    pending = {}
+
+    for receipt_data, image_url in receipts:
+        receipt_data["user_id"] = user_id
+        receipt_data["image_url"] = image_url
+        rollups = _receipt_rollups(receipt_data, user_id, 1)
+
+        new_rollup_docs = len({ref.path for ref, _ in rollups} - set(pending))
+        if batch_receipts and batch_receipts + 1 + len(pending) + new_rollup_docs > BATCH_WRITE_LIMIT:
+            _write_rollups(batch, pending)
+            await batch.commit()
+            batch = get_db().batch()
+            batch_receipts = 0
+            pending = {}
+
+        doc_ref = get_db().collection("receipts").document()
+        batch.set(doc_ref, receipt_data)
+        _merge_rollups(pending, rollups)
+        batch_receipts += 1
+        receipt_ids.append(doc_ref.id)
+
+    if batch_receipts:
+        _write_rollups(batch, pending)
+        await batch.commit()
+
+    return receipt_ids
+
+def _end_of_day(end_date: str) -> str:
+    """A date-only upper bound (YYYY-MM-DD) covers that whole day; anything else is used as given."""
+    try:
+        datetime.date.fromisoformat(end_date)
+    except ValueError:
+        return end_date
+    return f"{end_date}T23:59:59.999999"
+
+def _user_receipts_query(user_id: str, limit: int = None, start_after=None, start_date: str = None,
+                         end_date: str = None, fields: list = None):
+    query = (
+        get_db().collection("receipts")
+        .where("user_id", "==", user_id)
+        .order_by("transaction_datetime", direction=firestore.Query.DESCENDING)
+    )
+    # transaction_datetime is stored as an ISO 8601 string, so range filters
+    # compare lexicographically in date order
+    if start_date:
+        query = query.where("transaction_datetime", ">=", start_date)
+    if end_date:
+        query = query.where("transaction_datetime", "<=", _end_of_day(end_date))
+    if fields:
+        query = query.select(fields)
+    if start_after is not None:
+        query = query.start_after(start_after)
+    if limit:
+        query = query.limit(limit)
+    return query
+
+async def stream_user_receipts(user_id: str, limit: int = None, start_after: str = None,
+                               start_date: str = None, end_date: str = None, fields: list = None):
+    """
+    Stream a user's receipts, newest first.
     
     Args:
         user_id (str): The ID of the user whose receipts to retrieve
+        limit (int): Maximum number of receipts to return
+        start_after (str): Receipt ID to resume after (the last ID of the previous page)
+        start_date (str): Only receipts on or after this ISO 8601 datetime
+        end_date (str): Only receipts on or before this ISO 8601 datetime
+            (or date, which includes the whole day)
+        fields (list): Receipt fields to fetch; all fields when empty
         
-    Returns:
-        List of receipt documents
+    Yields:
+        Receipt dicts with their receipt_id
     """
-    receipts_ref = db.collection("receipts").where("user_id", "==", user_id).stream()
-    receipts_list = []
-    for receipt in receipts_ref:
+    cursor = None
+    if start_after:
+        cursor = await get_db().collection("receipts").document(start_after).get()
+        if not cursor.exists or cursor.get("user_id") != user_id:
+            raise ValueError(f"Invalid start_after cursor: {start_after}")
+
+    query = _user_receipts_query(user_id, limit, cursor, start_date, end_date, fields)
+    async for receipt in query.stream():
         receipt_data = receipt.to_dict()
         receipt_data['receipt_id'] = receipt.id 
-        receipts_list.append(receipt_data)
+        yield receipt_data
+
+async def page_user_receipts(user_id: str, page_size: int = 200, start_date: str = None, end_date: str = None,
+                             fields: list = None):
+    """
+    Stream all of a user's receipts, newest first, one query per page of
+    `page_size` so no single query stays open for the whole traversal.
+
+    Yields:
+        Receipt dicts with their receipt_id
+    """
+    start_after = None
+    while True:
+        page = await get_user_receipts(user_id, page_size, start_after, start_date, end_date, fields)
+        for receipt_data in page:
+            yield receipt_data
+        if len(page) < page_size:
+            return
+        start_after = page[-1]["receipt_id"]
+
+@metrics_helper.timed("firestore:get_user_receipts")
+async def get_user_receipts(user_id: str, limit: int = None, start_after: str = None,
+                            start_date: str = None, end_date: str = None, fields: list = None):
+    """
+    Get receipts belonging to a specific user, newest first.
+    
+    Args:
+        user_id (str): The ID of the user whose receipts to retrieve
+        limit, start_after, start_date, end_date, fields: see stream_user_receipts
         
-    return receipts_list
+    Returns:
+        List of receipt documents
+    """
+    return [
+        receipt_data
+        async for receipt_data in stream_user_receipts(user_id, limit, start_after, start_date, end_date, fields)
+    ]
+
 
+async def stream_receipt_fingerprints(user_id: str = None, fingerprint: str = None):
+    """
+    Stream the duplicate-detection fields of the stored receipts of a user,
+    or of every user's receipts with the given fingerprint, fetching only
+    those fields.
 
-def get_user(user_id: str):
+    Yields:
+        (receipt_id, user_id, image_hash, receipt_fingerprint); image_hash is
+        the hex string stored with the receipt, and either may be None.
+    """
+    query = get_db().collection("receipts")
+    if user_id is not None:
+        query = query.where("user_id", "==", user_id)
+    if fingerprint is not None:
+        query = query.where("receipt_fingerprint", "==", fingerprint)
+    query = query.select(["user_id", "image_hash", "receipt_fingerprint"])
+    async for receipt in query.stream():
+        receipt_data = receipt.to_dict()
+        yield receipt.id, receipt_data.get("user_id"), receipt_data.get("image_hash"), receipt_data.get("receipt_fingerprint")
+
+
+@metrics_helper.timed("firestore:get_user")
+async def get_user(user_id: str):
     """
     Get user details from Firebase Authentication.
     
@@ -118,28 +525,33 @@ def get_user(user_id: str):
         User record or None if not found
     """
     try:
-        return auth.get_user(user_id)
+        return await run_blocking(auth_executor, auth.get_user, user_id, app=get_firebase_app())
     except auth.UserNotFoundError:
         return None
     except Exception as e:
         print(f"Error getting user: {e}")
         return None
 
+@metrics_helper.timed("enrich_receipt_tax_info")
 def enrich_receipt_tax_info(receipt_data: dict,tax_classification: dict = None):
     """
     Parse tax information into line items.
     
     Args:
         receipt_data (dict): The receipt data containing tax information
+        tax_classification (dict): Tax model output; its 'items' are matched
+            to line items by their "index", or by position when they have none
         
     Returns:
         List of line items with tax information
     """
 
     try:
+        classified_items = tax_classification.get('items') if isinstance(tax_classification, dict) else None
+        line_taxes = tax_helper.items_by_index(classified_items or [], range(len(receipt_data["line_items"])))
         for i, item in enumerate(receipt_data["line_items"]):
-            if tax_classification and 'items' in tax_classification and i < len(tax_classification['items']):
-                item["line_tax"] = LineTax(**tax_classification['items'][i]).model_dump()
+            if line_taxes.get(i) is not None:
+                item["line_tax"] = LineTax(**line_taxes[i]).model_dump()
             else:
                 item["line_tax"] = None 
             
@@ -172,25 +584,9 @@ def enrich_receipt_tax_info(receipt_data: dict,tax_classification: dict = None):
         return receipt_data
             
         
-def clean_bad_json_response(response_content):
-    """
-    Extract and clean JSON from LLM response that might include markdown formatting
-    or incomplete JSON.
-    """
-    cleaned_content = response_content.strip()
-    if cleaned_content.startswith("```json"):
-        match = re.search(r"```json\s*([\s\S]*?)\s*```", cleaned_content)
-        if match:
-            cleaned_content = match.group(1)
-
-    if not cleaned_content.startswith("{"):
-        cleaned_content = "{" + cleaned_content
-    if not cleaned_content.endswith("}"):
-        cleaned_content = cleaned_content + "}"
-
-    return json.loads(cleaned_content)
 # achievement functions
-def get_user_achievements(user_id: str):
+@metrics_helper.timed("firestore:get_achievements")
+async def get_user_achievements(user_id: str):
     """
     Gets the achievement progress document for a specific user.
     
@@ -201,15 +597,16 @@ def get_user_achievements(user_id: str):
         The achievement data as a dictionary if it exists, otherwise None.
     """
     # The path to the specific document holding all achievement data
-    doc_ref = db.collection("users").document(user_id).collection("achievements").document("progress")
-    doc = doc_ref.get()
+    doc_ref = get_db().collection("users").document(user_id).collection("achievements").document("progress")
+    doc = await doc_ref.get()
     
     if doc.exists:
         return doc.to_dict()
     else:
         return None
 
-def save_user_achievements(user_id: str, achievements_data: dict):
+@metrics_helper.timed("firestore:save_achievements")
+async def save_user_achievements(user_id: str, achievements_data: dict):
     """
     Saves or overwrites the achievement progress document for a specific user.
     
@@ -218,14 +615,15 @@ def save_user_achievements(user_id: str, achievements_data: dict):
         achievements_data (dict): A dictionary containing the achievement data to save.
     """
     
-    doc_ref = db.collection("users").document(user_id).collection("achievements").document("progress")
+    doc_ref = get_db().collection("users").document(user_id).collection("achievements").document("progress")
     
     achievements_data['lastUpdated'] = firestore.SERVER_TIMESTAMP
     
     # .set() will create the document if it doesn't exist, or overwrite it if it does.
-    doc_ref.set(achievements_data)
+    await doc_ref.set(achievements_data)
 
-def get_user_budgets(user_id: str):
+@metrics_helper.timed("firestore:get_budgets")
+async def get_user_budgets(user_id: str):
     """
     Fetch the budget data for a specific user.
     
@@ -235,15 +633,16 @@ def get_user_budgets(user_id: str):
     Returns:
         dict: The user's budget settings or None if not found.
     """
-    doc_ref = db.collection("users").document(user_id).collection("settings").document("budgets")
-    doc = doc_ref.get()
+    doc_ref = get_db().collection("users").document(user_id).collection("settings").document("budgets")
+    doc = await doc_ref.get()
 
     if doc.exists:
         return doc.to_dict()
     else:
         return None
     
-def save_user_budgets(user_id: str, budgets_data: dict):
+@metrics_helper.timed("firestore:save_budgets")
+async def save_user_budgets(user_id: str, budgets_data: dict):
     """
     Save or update the budget settings for a specific user.
     
@@ -251,21 +650,25 @@ def save_user_budgets(user_id: str, budgets_data: dict):
         user_id (str): The ID of the user.
         budgets_data (dict): The full budget data (per category).
     """
-    doc_ref = db.collection("users").document(user_id).collection("settings").document("budgets")
+    doc_ref = get_db().collection("users").document(user_id).collection("settings").document("budgets")
 
     data_with_timestamp = budgets_data.copy()
     data_with_timestamp['lastUpdated'] = firestore.SERVER_TIMESTAMP
 
     try:
-        doc_ref.set(data_with_timestamp, merge=True)
-        print(f"Firestore save_user_budgets: Successfully saved for user {user_id}")
+        await doc_ref.set(data_with_timestamp, merge=True)
+        logger.debug("Firestore save_user_budgets: Successfully saved for user %s", user_id)
     except Exception as e:
         print(f"Firestore save_user_budgets: Error saving for user {user_id}: {str(e)}")
         raise e
     
-def delete_receipt(receipt_id: str):
+@metrics_helper.timed("firestore:delete_receipt")
+async def delete_receipt(receipt_id: str):
     """
     Deletes a receipt from Firestore by its ID.
+
+    Runs in a transaction that also reverses the receipt's contribution to
+    its owner's aggregate documents.
     
     Args:
         receipt_id (str): The ID of the receipt document to delete.
@@ -273,9 +676,80 @@ def delete_receipt(receipt_id: str):
     Returns:
         None
     """
+    @async_transactional
+    async def delete_in_transaction(transaction, receipt_ref):
+        snapshot = await receipt_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return
+        receipt_data = snapshot.to_dict()
+        transaction.delete(receipt_ref)
+        pending = {}
+        _merge_rollups(pending, _receipt_rollups(receipt_data, receipt_data.get("user_id"), -1))
+        _write_rollups(transaction, pending)
+
     try:
-        db.collection("receipts").document(receipt_id).delete()
-        print(f"Successfully deleted receipt with ID: {receipt_id}")
+        await delete_in_transaction(get_db().transaction(), get_db().collection("receipts").document(receipt_id))
+        logger.debug("Successfully deleted receipt with ID: %s", receipt_id)
     except Exception as e:
         print(f"Error deleting receipt {receipt_id}: {e}")
-        raise e
\ No newline at end of file
+        raise e
+
+
+@metrics_helper.timed("firestore:get_tax_summary")
+async def get_tax_summary(user_id: str, assessment_year: str):
+    """
+    Get a user's tax relief aggregate for one assessment year.
+
+    Returns:
+        The aggregate document as a dictionary, or None if the user has no
+        receipts for that year.
+    """
+    doc = await _tax_summary_ref(user_id, assessment_year).get()
+    return doc.to_dict() if doc.exists else None
+
+
+@metrics_helper.timed("firestore:get_spend_rollup")
+async def get_spend_rollup(user_id: str, period_key: str):
+    """
+    Get a user's spend per expense category for one budget period.
+
+    Returns:
+        The rollup document as a dictionary, or None if nothing was spent.
+    """
+    doc = await _spend_rollup_ref(user_id, period_key).get()
+    return doc.to_dict() if doc.exists else None
+
+
+AGGREGATE_COLLECTIONS = ("tax_summary", "spend_rollups")
+
+@metrics_helper.timed("firestore:rebuild_aggregates")
+async def rebuild_user_aggregates(user_id: str):
+    """
+    Recompute a user's aggregate documents from their receipts, for backfill
+    or repair. Aggregates for periods with no receipts left are removed.
+
+    Returns:
+        The number of receipts counted.
+    """
+    totals = {}
+    receipt_count = 0
+    async for receipt_data in stream_user_receipts(user_id):
+        _merge_rollups(totals, _receipt_rollups(receipt_data, user_id, 1))
+        receipt_count += 1
+
+    stale_refs = []
+    for collection in AGGREGATE_COLLECTIONS:
+        async for doc in get_db().collection("users").document(user_id).collection(collection).stream():
+            if doc.reference.path not in totals:
+                stale_refs.append(doc.reference)
+    writes = [(ref, None) for ref in stale_refs] + list(totals.values())
+    for start in range(0, len(writes), BATCH_WRITE_LIMIT):
+        batch = get_db().batch()
+        for ref, data in writes[start:start + BATCH_WRITE_LIMIT]:
+            if data is None:
+                batch.delete(ref)
+            else:
+                batch.set(ref, dict(data, lastUpdated=firestore.SERVER_TIMESTAMP))
+        await batch.commit()
+
+    return receipt_count
@@ -0,0 +1,283 @@
+from array import array
+from datetime import datetime
+from itertools import combinations
+import re
+import sys
+
+from . import cache_helper
+
+
+HASH_BITS = 64
+# Bucket bits per table of an empty HammingIndex; grown as hashes are added
+MIN_BUCKET_BITS = 10
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def receipt_fingerprint(receipt_data: dict):
+    """
+    Fingerprint of the fields that identify a physical receipt: merchant,
+    transaction time (to the minute) and total. Formatting differences
+    between two reads of the same receipt (case, punctuation, seconds,
+    trailing zeros) don't change it.
+
+    Returns:
+        A hex digest, or None when any of the fields is missing.
+    """
+    merchant = re.sub(r"[\W_]+", "", str(receipt_data.get("merchant_name") or "")).lower()
+    total = receipt_data.get("total_amount")
+    transaction_datetime = receipt_data.get("transaction_datetime")
+    if not merchant or total is None or not transaction_datetime:
+        return None
+    try:
+        transaction_datetime = datetime.fromisoformat(str(transaction_datetime)).strftime("%Y-%m-%dT%H:%M")
+    except ValueError:
+        transaction_datetime = str(transaction_datetime)
+    return cache_helper.content_key(merchant, transaction_datetime, f"{float(total):.2f}")[:32]
+
+
+class HammingIndex:
+    """
+    Multi-index hash table over 64-bit hashes for Hamming-radius search.
+
+    Each hash is split into `chunks` substrings, each indexed in its own
+    table. Two hashes within distance r = chunks * q + a (a < chunks) agree
+    to within q bits on one of the first a + 1 substrings or within q - 1
+    bits on one of the others, so a search only probes those neighbourhoods
+    and checks the few candidates found instead of scanning every hash.
+
+    Tables are bucket-head arrays with a linked list of entries per bucket,
+    so the index costs a few bytes per hash rather than a Python object.
+    Buckets are keyed on the top bits of each substring, about two buckets
+    per hash (the tables double as hashes are added), and removed entries
+    are unlinked and reused once they outnumber the live ones.
+    """
+
+    def __init__(self, chunks: int = 3, bits: int = HASH_BITS):
+        self.chunks = chunks
+        widths = [bits // chunks] * chunks
+        for i in range(bits % chunks):
+            widths[i] += 1
+        self.widths = widths
+        self._shifts = [sum(widths[:i]) for i in range(chunks)]
+        self._bucket_bits = 0
+        self._heads = None
+        self._next = [array("I", [0]) for _ in range(chunks)]
+        # Entry 0 is the end-of-bucket marker
+        self._hashes = array("Q", [0])
+        self._items = [None]
+        self._free = []
+        self._probes = {}
+        self._size = 0
+        self._removed = 0
+
+    def __len__(self):
+        return self._size
+
+    def _substrings(self, value: int):
+        return [(value >> shift) & ((1 << width) - 1) for shift, width in zip(self._shifts, self.widths)]
+
+    def _bucket_shifts(self) -> list:
+        return [width - min(width, self._bucket_bits) for width in self.widths]
+
+    def _probe_masks(self, width: int, radius: int, shift: int) -> list:
+        # Substrings within `radius` bits, as bucket masks: (s ^ m) >> shift == (s >> shift) ^ (m >> shift)
+        masks = self._probes.get((width, radius, shift))
+        if masks is None:
+            masks = sorted({
+                sum(1 << bit for bit in bits) >> shift
+                for r in range(radius + 1)
+                for bits in combinations(range(width), r)
+            })
+            self._probes[(width, radius, shift)] = masks
+        return masks
+
+    def _link(self, entry: int):
+        substrings = self._substrings(self._hashes[entry])
+        for heads, next_entries, substring, shift in zip(self._heads, self._next, substrings, self._bucket_shifts()):
+            bucket = substring >> shift
+            next_entries[entry] = heads[bucket]
+            heads[bucket] = entry
+
+    def _rebuild(self, bucket_bits: int):
+        """Relink every live entry into tables of `bucket_bits`, freeing removed entries for reuse."""
+        self._bucket_bits = bucket_bits
+        self._heads = [
+            array("I", [0]) * (1 << (width - shift)) for width, shift in zip(self.widths, self._bucket_shifts())
+        ]
+        self._next = [array("I", [0]) * len(self._hashes) for _ in self.widths]
+        self._free = []
+        for entry in range(1, len(self._hashes)):
+            if self._items[entry] is None:
+                self._free.append(entry)
+            else:
+                self._link(entry)
+        self._removed = 0
+
+    def add(self, value: int, item) -> int:
+        """
+        Index `item` under the hash `value`.
+
+        Returns:
+            The entry id, for remove().
+        """
+        if self._heads is None:
+            self._rebuild(MIN_BUCKET_BITS)
+        elif self._size >= 1 << (self._bucket_bits - 1) and self._bucket_bits < max(self.widths):
+            self._rebuild(self._bucket_bits + 1)
+        if self._free:
+            entry = self._free.pop()
+            self._hashes[entry] = value
+            self._items[entry] = item
+        else:
+            entry = len(self._hashes)
+            self._hashes.append(value)
+            self._items.append(item)
+            for next_entries in self._next:
+                next_entries.append(0)
+        self._link(entry)
+        self._size += 1
+        return entry
+
+    def remove(self, entry: int):
+        """Drop an entry; later searches skip it."""
+        if self._items[entry] is not None:
+            self._items[entry] = None
+            self._size -= 1
+            self._removed += 1
+            if self._removed > max(self._size, 1 << MIN_BUCKET_BITS):
+                self._rebuild(self._bucket_bits)
+
+    def search(self, value: int, max_distance: int) -> list:
+        """
+        Returns:
+            (distance, item) for every entry within max_distance of `value`,
+            closest first.
+        """
+        if self._heads is None:
+            return []
+        q, a = divmod(max_distance, self.chunks)
+        found = {}
+        shifts = self._bucket_shifts()
+        for table, substring in enumerate(self._substrings(value)):
+            radius = q if table <= a else q - 1
+            if radius < 0:
+                continue
+            heads, next_entries = self._heads[table], self._next[table]
+            bucket = substring >> shifts[table]
+            for mask in self._probe_masks(self.widths[table], radius, shifts[table]):
+                entry = heads[bucket ^ mask]
+                while entry:
+                    if entry not in found and self._items[entry] is not None:
+                        distance = hamming(self._hashes[entry], value)
+                        if distance <= max_distance:
+                            found[entry] = distance
+                    entry = next_entries[entry]
+        return sorted(
+            ((distance, self._items[entry]) for entry, distance in found.items()), key=lambda match: match[0]
+        )
+
+
+class DuplicateIndex:
+    """
+    In-process index of stored receipts for duplicate detection, by image
+    hash (near matches) and by field fingerprint (exact matches).
+
+    A receipt is a likely duplicate of one the same user stored when their
+    fingerprints are equal, or when their image hashes are within
+    `max_distance` bits and the fingerprints don't contradict it (receipts
+    printed from the same template can look alike but differ in time or
+    total). Another user's receipt only counts when both hold: equal
+    fingerprints alone are common across users (two customers paying the
+    same total at the same chain in the same minute).
+    """
+
+    def __init__(self, max_distance: int = 6):
+        self.max_distance = max_distance
+        self.images = HammingIndex()
+        # Keyed by fingerprint and user (see _user_key): the receipt, or a
+        # list of them when several share the key
+        self.fingerprints = {}
+        # receipt_id: ((receipt_id, user_id, fingerprint), image entry)
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, receipt_id):
+        return receipt_id in self._entries
+
+    @staticmethod
+    def _fingerprint_key(fingerprint: str):
+        # 64 bits of the digest keep a million fingerprints collision-free at a fraction of the memory
+        return int(fingerprint[:16], 16) if fingerprint else None
+
+    @staticmethod
+    def _user_key(fingerprint: int, user_id) -> int:
+        # Mixing in the user keeps fingerprint lookups per user without a tuple per entry
+        return fingerprint ^ (hash(user_id) & 0xFFFFFFFFFFFFFFFF)
+
+    def add(self, receipt_id: str, user_id: str, image_hash: int = None, fingerprint: str = None):
+        self.remove(receipt_id)
+        fingerprint = self._fingerprint_key(fingerprint)
+        # Many receipts share an owner
+        receipt = (receipt_id, sys.intern(user_id) if user_id else user_id, fingerprint)
+        image_entry = self.images.add(image_hash, receipt) if image_hash is not None else None
+        if fingerprint is not None:
+            key = self._user_key(fingerprint, receipt[1])
+            stored = self.fingerprints.get(key)
+            if stored is None:
+                self.fingerprints[key] = receipt
+            elif isinstance(stored, list):
+                stored.append(receipt)
+            else:
+                self.fingerprints[key] = [stored, receipt]
+        self._entries[receipt_id] = (receipt, image_entry)
+
+    def remove(self, receipt_id: str):
+        entry = self._entries.pop(receipt_id, None)
+        if entry is None:
+            return
+        receipt, image_entry = entry
+        if image_entry is not None:
+            self.images.remove(image_entry)
+        fingerprint = receipt[2]
+        if fingerprint is not None:
+            key = self._user_key(fingerprint, receipt[1])
+            stored = self.fingerprints.get(key)
+            if stored is receipt:
+                del self.fingerprints[key]
+            elif isinstance(stored, list):
+                stored[:] = [other for other in stored if other is not receipt]
+                if len(stored) == 1:
+                    self.fingerprints[key] = stored[0]
+
+    def find(self, user_id: str, image_hash: int = None, fingerprint: str = None):
+        """
+        Returns:
+            The stored receipt a receipt `user_id` is adding likely
+            duplicates, as {"receipt_id", "user_id", "match": "fields" |
+            "image" | "fields_and_image", "distance"}, or None.
+        """
+        fingerprint = self._fingerprint_key(fingerprint)
+        if fingerprint is not None:
+            stored = self.fingerprints.get(self._user_key(fingerprint, user_id))
+            for receipt in stored if isinstance(stored, list) else [stored] if stored is not None else []:
+                # Keys of other users and fingerprints can collide
+                if receipt[1] == user_id and receipt[2] == fingerprint:
+                    return {"receipt_id": receipt[0], "user_id": receipt[1], "match": "fields", "distance": None}
+        if image_hash is None:
+            return None
+        for distance, (receipt_id, stored_user_id, stored_fingerprint) in self.images.search(
+            image_hash, self.max_distance
+        ):
+            if stored_user_id == user_id:
+                if fingerprint is None or stored_fingerprint is None or stored_fingerprint == fingerprint:
+                    return {"receipt_id": receipt_id, "user_id": stored_user_id, "match": "image", "distance": distance}
+            elif fingerprint is not None and stored_fingerprint == fingerprint:
+                return {
+                    "receipt_id": receipt_id, "user_id": stored_user_id, "match": "fields_and_image", "distance": distance,
+                }
+        return None
@@ -0,0 +1,124 @@
+from contextlib import contextmanager
+import csv
+import io
+import json
+import os
+import zipfile
+
+
+class _Pipe(io.RawIOBase):
+    """
+    Write-only, unseekable sink that collects what zipfile writes until it
+    is drained. Being unseekable makes zipfile write sizes in data
+    descriptors after each entry instead of seeking back to the header.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ZipStream:
+    """
+    ZIP archive produced incrementally: add entries, then drain() the bytes
+    written so far and send them on. Only the entry being written and the
+    central directory (a few dozen bytes per entry) are held in memory.
+    """
+
+    def __init__(self):
+        self._pipe = _Pipe()
+        self._zip = zipfile.ZipFile(self._pipe, mode="w", allowZip64=True)
+
+    def write(self, name: str, data: bytes, compress: bool = True):
+        """Add a whole entry. Already-compressed data (e.g. JPEGs) is better stored as is."""
+        self._zip.writestr(name, data, compress_type=zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED)
+
+    @contextmanager
+    def open(self, name: str):
+        """
+        Add an entry written piece by piece through the returned file
+        object; drain() may be called between writes.
+        """
+        info = zipfile.ZipInfo(name)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        with self._zip.open(info, mode="w", force_zip64=True) as entry:
+            yield entry
+
+    def drain(self) -> bytes:
+        return self._pipe.drain()
+
+    def close(self) -> bytes:
+        """Write the central directory and return the remaining bytes."""
+        self._zip.close()
+        return self._pipe.drain()
+
+
+RECEIPT_CSV_COLUMNS = (
+    "receipt_id",
+    "transaction_datetime",
+    "merchant_name",
+    "total_amount",
+    "currency_code",
+    "expense_category",
+    "payment_method",
+    "tax_relief_amount",
+    "taxable_items_count",
+    "image_file",
+)
+
+# Receipt fields read for receipts.csv
+RECEIPT_CSV_FIELDS = [
+    "transaction_datetime", "merchant_name", "total_amount", "currency_code",
+    "expense_category", "payment_method", "tax_summary", "image_url",
+]
+
+
+def csv_rows(rows: list, header: bool = False) -> bytes:
+    """Encode rows (dicts keyed by RECEIPT_CSV_COLUMNS) as CSV."""
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=RECEIPT_CSV_COLUMNS, extrasaction="ignore")
+    if header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return output.getvalue().encode("utf-8")
+
+
+def receipt_csv_row(receipt_data: dict, has_image: bool = True) -> dict:
+    tax_summary = receipt_data.get("tax_summary") or {}
+    return dict(
+        receipt_data,
+        tax_relief_amount=tax_summary.get("total_tax_saved", 0.0),
+        taxable_items_count=tax_summary.get("taxable_items_count", 0),
+        image_file=image_file_name(receipt_data) if has_image and receipt_data.get("image_url") else "",
+    )
+
+
+def _entry_stem(receipt_data: dict) -> str:
+    date = str(receipt_data.get("transaction_datetime") or "")[:10] or "undated"
+    return f"{date}_{receipt_data['receipt_id']}"
+
+
+def image_file_name(receipt_data: dict) -> str:
+    extension = os.path.splitext(receipt_data.get("image_url") or "")[1].lower()
+    if extension not in (".jpg", ".jpeg", ".png", ".webp", ".heic", ".gif", ".pdf"):
+        extension = ".jpg"
+    return f"images/{_entry_stem(receipt_data)}{extension}"
+
+
+def receipt_json_name(receipt_data: dict) -> str:
+    return f"receipts/{_entry_stem(receipt_data)}.json"
+
+
+def receipt_json(receipt_data: dict) -> bytes:
+    return json.dumps(receipt_data, indent=2, default=str).encode("utf-8")
@@ -0,0 +1,133 @@
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps
+import asyncio
+import io
+import os
+import time
+
+
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1600"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+IMAGE_GRAYSCALE = os.getenv("IMAGE_GRAYSCALE", "true").lower() == "true"
+
+# Decoding and re-encoding is CPU bound, so it runs in worker processes
+# rather than on the event loop or a GIL-bound thread.
+image_executor = ProcessPoolExecutor(max_workers=int(os.getenv("IMAGE_WORKERS", "2")))
+
+
+def preprocess_receipt_image(image: bytes, max_side: int = IMAGE_MAX_SIDE, image_format: str = IMAGE_FORMAT,
+                             quality: int = IMAGE_QUALITY, grayscale: bool = IMAGE_GRAYSCALE):
+    """
+    Shrink a receipt photo for the vision model.
+
+    The image is auto-oriented from its EXIF data, optionally converted to
+    grayscale, downscaled so its longest side is at most max_side and
+    re-encoded.
+
+    Returns:
+        (image_bytes, mime_type, stats) where stats holds per-stage timings in
+        milliseconds and the byte sizes before and after.
+    """
+    timings = {}
+
+    start = time.perf_counter()
+    img = Image.open(io.BytesIO(image))
+    # JPEG decoders can scale down by 1/2-1/8 while decoding, which is far
+    # cheaper than decoding the full photo and resizing afterwards.
+    scale = min(max_side / max(img.size), 1.0)
+    img.draft("L" if grayscale else "RGB", (int(img.width * scale), int(img.height * scale)))
+    img.load()
+    timings["decode"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    img = ImageOps.exif_transpose(img)
+    timings["orient"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    img = img.convert("L") if grayscale else img.convert("RGB")
+    timings["convert"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS, reducing_gap=2.0)
+    timings["resize"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    output = io.BytesIO()
+    img.save(output, format=image_format, quality=quality, optimize=True)
+    processed = output.getvalue()
+    timings["encode"] = (time.perf_counter() - start) * 1000
+
+    stats = {
+        "timings_ms": timings,
+        "original_bytes": len(image),
+        "processed_bytes": len(processed),
+        "width": img.width,
+        "height": img.height,
+    }
+    return processed, f"image/{image_format.lower()}", stats
+
+
+async def preprocess_receipt_image_async(image: bytes, mime_type: str):
+    """
+    Run preprocess_receipt_image in the process pool.
+
+    Falls back to the original bytes when the image can't be decoded or the
+    re-encoded version isn't smaller.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        processed, processed_mime_type, stats = await loop.run_in_executor(
+            image_executor, preprocess_receipt_image, image
+        )
+    except Exception as e:
+        print(f"Image preprocessing skipped: {e}")
+        return image, mime_type, None
+
+    if stats["processed_bytes"] >= stats["original_bytes"]:
+        return image, mime_type, stats
+
+    return processed, processed_mime_type, stats
+
+
+def image_dhash(image: bytes, hash_size: int = 8) -> int:
+    """
+    Difference hash of an image: one bit per horizontally adjacent pixel
+    pair of a (hash_size + 1) x hash_size grayscale thumbnail. Re-encoded,
+    resized or slightly recompressed copies of a photo land within a few
+    bits of each other.
+
+    Returns:
+        The hash as a hash_size * hash_size bit integer.
+    """
+    img = Image.open(io.BytesIO(image))
+    img.draft("L", (hash_size * 8, hash_size * 8))
+    img = ImageOps.exif_transpose(img).convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+    pixels = img.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+async def image_dhash_async(image: bytes):
+    """
+    Run image_dhash in the process pool; None when the image can't be decoded.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(image_executor, image_dhash, image)
+    except Exception as e:
+        print(f"Image hashing skipped: {e}")
+        return None
+
+
+def server_timing_header(stats: dict) -> str:
+    """
+    Format preprocessing stats as a Server-Timing header value.
+    """
+    return ", ".join(
+        f"image-{stage};dur={duration:.1f}" for stage, duration in stats["timings_ms"].items()
+    )
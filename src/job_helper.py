@@ -0,0 +1,269 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+import uuid
+
+logger = logging.getLogger("tolaktax")
+
+
+class JobQueue(ABC):
+    """
+    Interface for background job storage. A backend persists jobs, hands
+    queued jobs to workers one at a time and records their outcome.
+
+    Job dicts have: job_id, user_id, kind, status ("queued", "running",
+    "succeeded" or "failed"), payload, result, error, created_at, updated_at.
+
+    A running job is leased to its worker for `lease_seconds`, renewed by
+    heartbeat; a job whose lease ran out (its process died) is claimed again.
+    """
+
+    lease_seconds = 120.0
+
+    @abstractmethod
+    async def enqueue(self, user_id: str, kind: str, payload: dict, blob: bytes = None, idempotency_key: str = None):
+        """
+        Add a job, or return the existing job for the same user and
+        idempotency key.
+
+        Returns:
+            (job, created)
+        """
+
+    @abstractmethod
+    async def claim(self):
+        """
+        Mark the oldest queued job, or job whose lease ran out, as running
+        and return it, or None.
+        """
+
+    @abstractmethod
+    async def heartbeat(self, job_id: str):
+        """Renew a running job's lease."""
+
+    @abstractmethod
+    async def complete(self, job_id: str, result: dict):
+        """Mark a job succeeded with its result."""
+
+    @abstractmethod
+    async def fail(self, job_id: str, error: str):
+        """Mark a job failed with its error message."""
+
+    @abstractmethod
+    async def get(self, job_id: str):
+        """Return the job (without its blob), or None."""
+
+
+class SQLiteJobQueue(JobQueue):
+    """
+    Job queue in a SQLite database. Use ":memory:" for a purely in-process
+    queue, or a file path to keep jobs across restarts.
+
+    All access goes through a single thread, which owns the connection.
+    """
+
+    def __init__(self, path: str = ":memory:", lease_seconds: float = 120.0):
+        self.lease_seconds = lease_seconds
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs")
+        self._conn = self._executor.submit(self._connect, path).result()
+
+    @staticmethod
+    def _connect(path):
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                idempotency_key TEXT,
+                payload TEXT NOT NULL,
+                blob BLOB,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS jobs_idempotency ON jobs (user_id, idempotency_key)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_queued ON jobs (status, created_at)")
+        conn.commit()
+        return conn
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    @staticmethod
+    def _to_job(row, with_blob=False):
+        if row is None:
+            return None
+        job = {
+            "job_id": row["job_id"],
+            "user_id": row["user_id"],
+            "kind": row["kind"],
+            "status": row["status"],
+            "payload": json.loads(row["payload"]),
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+        if with_blob:
+            job["blob"] = row["blob"]
+        return job
+
+    def _enqueue(self, user_id, kind, payload, blob, idempotency_key):
+        now = time.time()
+        job_id = str(uuid.uuid4())
+        # A single statement, so two processes sharing the file with the same key can't both insert
+        created = self._conn.execute(
+            "INSERT INTO jobs (job_id, user_id, kind, status, idempotency_key, payload, blob, created_at, updated_at)"
+            " VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?)"
+            " ON CONFLICT (user_id, idempotency_key) DO NOTHING",
+            (job_id, user_id, kind, idempotency_key, json.dumps(payload), blob, now, now),
+        ).rowcount
+        self._conn.commit()
+        if not created:
+            row = self._conn.execute(
+                "SELECT * FROM jobs WHERE user_id = ? AND idempotency_key = ?", (user_id, idempotency_key)
+            ).fetchone()
+            return self._to_job(row), False
+        return self._get(job_id), True
+
+    def _claim(self):
+        now = time.time()
+        # Jobs whose worker stopped renewing the lease (its process died) go first, being older
+        row = self._conn.execute(
+            "SELECT * FROM jobs WHERE status = 'running' AND updated_at < ? ORDER BY created_at LIMIT 1",
+            (now - self.lease_seconds,),
+        ).fetchone() or self._conn.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+        # Guard on status and updated_at so two processes sharing the file can't both claim it
+        claimed = self._conn.execute(
+            "UPDATE jobs SET status = 'running', updated_at = ? WHERE job_id = ? AND status = ? AND updated_at = ?",
+            (now, row["job_id"], row["status"], row["updated_at"]),
+        ).rowcount
+        self._conn.commit()
+        if not claimed:
+            return None
+        job = self._to_job(row, with_blob=True)
+        job["status"] = "running"
+        return job
+
+    def _finish(self, job_id, status, result, error):
+        # The blob (e.g. an uploaded image) is only needed until the job has run
+        self._conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, blob = NULL, updated_at = ? WHERE job_id = ?",
+            (status, json.dumps(result) if result is not None else None, error, time.time(), job_id),
+        )
+        self._conn.commit()
+
+    def _heartbeat(self, job_id):
+        self._conn.execute(
+            "UPDATE jobs SET updated_at = ? WHERE job_id = ? AND status = 'running'", (time.time(), job_id)
+        )
+        self._conn.commit()
+
+    def _get(self, job_id):
+        row = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self._to_job(row)
+
+    async def enqueue(self, user_id: str, kind: str, payload: dict, blob: bytes = None, idempotency_key: str = None):
+        return await self._run(self._enqueue, user_id, kind, payload, blob, idempotency_key)
+
+    async def claim(self):
+        return await self._run(self._claim)
+
+    async def heartbeat(self, job_id: str):
+        await self._run(self._heartbeat, job_id)
+
+    async def complete(self, job_id: str, result: dict):
+        await self._run(self._finish, job_id, "succeeded", result, None)
+
+    async def fail(self, job_id: str, error: str):
+        await self._run(self._finish, job_id, "failed", None, error)
+
+    async def get(self, job_id: str):
+        return await self._run(self._get, job_id)
+
+
+class JobWorkers:
+    """
+    Pool of asyncio workers draining a JobQueue.
+
+    Handlers are registered per job kind and return the job's result dict;
+    an exception marks the job failed. Workers wake immediately on local
+    enqueues and otherwise poll, so jobs added by other processes sharing a
+    SQLite file are picked up too. A running job's lease is renewed every
+    quarter of the queue's lease_seconds.
+    """
+
+    def __init__(self, queue: JobQueue, concurrency: int = 2, poll_interval: float = 1.0):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.handlers = {}
+        self._wakeup = None
+        self._tasks = []
+
+    def register(self, kind: str, handler):
+        self.handlers[kind] = handler
+
+    def notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _work(self):
+        while True:
+            # Clear before claiming so an enqueue that races the claim still wakes us
+            self._wakeup.clear()
+            job = await self.queue.claim()
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heartbeat = asyncio.create_task(self._heartbeat(job["job_id"]))
+            try:
+                result = await self.handlers[job["kind"]](job)
+                await self.queue.complete(job["job_id"], result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Job %s (%s) failed: %s - %s", job["job_id"], job["kind"], type(e).__name__, e)
+                error = getattr(e, "detail", None) or str(e)
+                await self.queue.fail(job["job_id"], error if isinstance(error, str) else json.dumps(error))
+            finally:
+                heartbeat.cancel()
+
+    async def _heartbeat(self, job_id: str):
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 4)
+            try:
+                await self.queue.heartbeat(job_id)
+            except Exception as e:
+                logger.warning("Job %s heartbeat failed: %s - %s", job_id, type(e).__name__, e)
@@ -0,0 +1,132 @@
+import json
+
+
+class ItemStreamParser:
+    """
+    Incremental parser that pulls complete objects out of a JSON array as
+    text arrives.
+
+    The array is either the top-level value or the "items" key of the
+    top-level object, matching the tax model's {"items": [...]} responses.
+    Text around the JSON (e.g. prose or a ```json fence) is ignored: the
+    JSON starts at a "{" followed by a key or "}", or a "[" followed by an
+    object or "]", so brackets and quotes in prose ("[2 items]") don't count.
+    A top-level object without the key is skipped and the search goes on.
+    """
+
+    def __init__(self, key: str = "items"):
+        self.key = key
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        self._last_key = None
+        self._started = False
+        self._array_depth = None
+        self._item_start = None
+        self.done = False
+
+    def feed(self, chunk: str) -> list:
+        """
+        Add more text and return the array elements completed by it.
+        Elements that aren't valid JSON objects are skipped.
+        """
+        items = []
+        self._text += chunk
+        text = self._text
+
+        while self._pos < len(text) and not self.done:
+            ch = text[self._pos]
+            if not self._started:
+                if ch not in "{[":
+                    self._pos += 1
+                    continue
+                following = text[self._pos + 1:].lstrip()
+                if not following:
+                    # Wait for the character that tells JSON from prose
+                    break
+                if following[0] not in ('"}' if ch == "{" else "{]"):
+                    self._pos += 1
+                    continue
+                self._started = True
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._last_string = text[self._string_start + 1:self._pos]
+            elif ch == '"':
+                self._in_string = True
+                self._string_start = self._pos
+            elif ch == ":":
+                self._last_key = self._last_string
+            elif ch == ",":
+                self._last_key = None
+            elif ch in "{[":
+                self._depth += 1
+                if ch == "[" and self._array_depth is None and (
+                    self._depth == 1 or (self._depth == 2 and self._last_key == self.key)
+                ):
+                    self._array_depth = self._depth
+                elif ch == "{" and self._array_depth is not None and self._depth == self._array_depth + 1:
+                    self._item_start = self._pos
+            elif ch in "}]":
+                if ch == "}" and self._item_start is not None and self._depth == self._array_depth + 1:
+                    try:
+                        items.append(json.loads(text[self._item_start:self._pos + 1]))
+                    except json.JSONDecodeError:
+                        pass
+                    self._item_start = None
+                elif ch == "]" and self._depth == self._array_depth:
+                    self.done = True
+                self._depth -= 1
+                if self._depth == 0 and not self.done:
+                    self._started = False
+                    self._last_key = None
+            self._pos += 1
+
+        # Drop text that can no longer be part of an element
+        keep_from = self._pos
+        if self._item_start is not None:
+            keep_from = self._item_start
+        if self._in_string:
+            keep_from = min(keep_from, self._string_start)
+        self._text = text[keep_from:]
+        self._pos -= keep_from
+        if self._item_start is not None:
+            self._item_start -= keep_from
+        if self._in_string:
+            self._string_start -= keep_from
+
+        return items
+
+
+def recover_items(text: str, key: str = "items"):
+    """
+    Tolerantly parse a model response holding {"items": [...]} (or a bare
+    array): every complete element is recovered even when the response is
+    wrapped in a ```json fence or prose, or cut off mid-element (e.g. at
+    max_completion_tokens).
+
+    Returns:
+        (items, complete): the recovered elements, and whether the array
+        was closed, i.e. nothing was lost to truncation.
+    """
+    try:
+        value = json.loads(text)
+    except json.JSONDecodeError:
+        value = None
+    if isinstance(value, dict) and isinstance(value.get(key), list):
+        return [item for item in value[key] if isinstance(item, dict)], True
+    if isinstance(value, list):
+        return [item for item in value if isinstance(item, dict)], True
+
+    parser = ItemStreamParser(key)
+    items = parser.feed(text or "")
+    return items, parser.done
@@ -0,0 +1,233 @@
+from groq import BadRequestError, RateLimitError
+from . import metrics_helper
+import asyncio
+import copy
+import logging
+import os
+import random
+import time
+
+logger = logging.getLogger("tolaktax")
+
+
+class TokenBucket:
+    """
+    Async token bucket limiting how fast requests are sent to a backend.
+
+    Holds up to `capacity` tokens and refills at `rate` tokens per second;
+    acquire() waits until a token is available.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, tokens: float = 1.0):
+        async with self._lock:
+            self._refill()
+            while self.tokens < tokens:
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= tokens
+
+
+class _Flight:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+        self.shared = False
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller starts the
+    call, later callers for that key await it instead of starting their own,
+    and all of them get its result or its exception. The key is forgotten
+    once the call finishes, so this is no cache.
+
+    The call runs as its own task, so a caller that is cancelled doesn't
+    cancel it for the others; it is cancelled only when every caller waiting
+    on it is gone. A result shared between callers is deep-copied for each
+    of them, as callers tend to modify what they get back.
+
+    When not `enabled`, every call is made on its own.
+    """
+
+    def __init__(self, name: str, enabled: bool = True):
+        self.name = name
+        self.enabled = enabled
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    def _finished(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def do(self, key: str, call):
+        """
+        Await `call()` (a coroutine function), or the call already in flight
+        for `key`.
+        """
+        if not self.enabled:
+            return await call()
+        flight = self._flights.get(key)
+        # A flight whose task is done or was cancelled (its last caller left)
+        # may still be listed until its done callback runs; don't join it
+        if flight is None or flight.task.done():
+            flight = self._flights[key] = _Flight(asyncio.ensure_future(call()))
+            flight.task.add_done_callback(lambda _: self._finished(key, flight))
+            self.calls += 1
+            metrics_helper.SINGLE_FLIGHT.inc(call=self.name, role="leader")
+        else:
+            flight.shared = True
+            self.coalesced += 1
+            metrics_helper.SINGLE_FLIGHT.inc(call=self.name, role="coalesced")
+
+        flight.waiters += 1
+        try:
+            result = await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.task.done():
+                flight.task.cancel()
+                self._finished(key, flight)
+        return copy.deepcopy(result) if flight.shared else result
+
+    def stats(self) -> dict:
+        requests = self.calls + self.coalesced
+        return {
+            "in_flight": len(self._flights),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "coalesced_rate": self.coalesced / requests if requests else 0.0,
+        }
+
+
+# Shared by every Groq call so all endpoints stay under the account's request rate
+groq_bucket = TokenBucket(rate=float(os.getenv("GROQ_REQUESTS_PER_MINUTE", "1000")) / 60)
+
+GROQ_MAX_RATE_LIMIT_RETRIES = int(os.getenv("GROQ_MAX_RATE_LIMIT_RETRIES", "4"))
+GROQ_BACKOFF_BASE_SECONDS = float(os.getenv("GROQ_BACKOFF_BASE_SECONDS", "1.0"))
+
+
+def _retry_after(error: RateLimitError, attempt: int) -> float:
+    """
+    Seconds to wait before retrying a 429: the server's retry-after header
+    when present, otherwise exponential backoff with jitter.
+    """
+    retry_after = error.response.headers.get("retry-after") if error.response is not None else None
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return GROQ_BACKOFF_BASE_SECONDS * (2 ** attempt) * (0.5 + random.random())
+
+
+def failed_generation(error: BadRequestError):
+    """
+    The model output Groq rejected in JSON mode (error code
+    json_validate_failed, e.g. output cut off at max_completion_tokens), or
+    None for any other bad request.
+    """
+    body = error.body if isinstance(error.body, dict) else {}
+    details = body.get("error", body)
+    if not isinstance(details, dict) or details.get("code") != "json_validate_failed":
+        return None
+    return details.get("failed_generation")
+
+
+async def call_groq(create, **kwargs):
+    """
+    Call a Groq (or instructor) `chat.completions.create` through the shared
+    rate limiter, backing off and retrying when Groq answers 429.
+
+    Each attempt is timed as a "groq:<model>" stage; token usage is recorded
+    for non-streamed results (instructor's create_with_completion returns a
+    (model, completion) pair).
+    """
+    model = kwargs.get("model", "")
+    for attempt in range(GROQ_MAX_RATE_LIMIT_RETRIES + 1):
+        await groq_bucket.acquire()
+        try:
+            with metrics_helper.stage(f"groq:{model}"):
+                result = await create(**kwargs)
+            if not kwargs.get("stream"):
+                completion = result[1] if isinstance(result, tuple) else result
+                metrics_helper.record_llm_usage(model, getattr(completion, "usage", None))
+            return result
+        except RateLimitError as e:
+            if attempt == GROQ_MAX_RATE_LIMIT_RETRIES:
+                raise
+            delay = _retry_after(e, attempt)
+            logger.warning("Groq rate limited, retrying in %.1fs (attempt %s)", delay, attempt + 1)
+            await asyncio.sleep(delay)
+
+
+async def hedged(calls: list, hedge_after: float = None, timeout: float = None):
+    """
+    Run `calls` (coroutine functions, preferred first) until one of them
+    succeeds.
+
+    The next call starts once the running ones have all failed, or as a
+    hedge when `hedge_after` seconds pass without an answer from the last
+    one started; the first result wins and calls still running are
+    cancelled. With hedge_after None the next call is only a fallback for
+    failures.
+
+    Returns:
+        (position in `calls` of the call that answered, its result).
+
+    Raises:
+        The last failure when every call fails, or TimeoutError when
+        `timeout` seconds pass first.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout if timeout is not None else None
+    running = {}
+    started = 0
+    started_at = None
+    error = None
+    try:
+        while True:
+            now = loop.time()
+            if started < len(calls) and (
+                not running or (hedge_after is not None and now >= started_at + hedge_after)
+            ):
+                running[asyncio.ensure_future(calls[started]())] = started
+                started += 1
+                started_at = now
+            if not running:
+                raise error
+
+            waits = []
+            if deadline is not None:
+                waits.append(deadline - now)
+            if started < len(calls) and hedge_after is not None:
+                waits.append(started_at + hedge_after - now)
+            done, _ = await asyncio.wait(
+                running, timeout=max(min(waits), 0.0) if waits else None, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done and deadline is not None and loop.time() >= deadline:
+                raise TimeoutError(f"No answer within {timeout:.1f}s")
+
+            finished = sorted((running.pop(task), task) for task in done)
+            answers = [(position, task) for position, task in finished if task.exception() is None]
+            if answers:
+                position, task = answers[0]
+                return position, task.result()
+            for _, task in finished:
+                error = task.exception()
+    finally:
+        for task in running:
+            task.cancel()
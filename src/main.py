@@ -1,23 +1,46 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from groq import Groq
+from fastapi import FastAPI, File, Form, Header, UploadFile, HTTPException, Response, Depends
+from fastapi import Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from groq import AsyncGroq, BadRequestError, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
 import uuid
 import os
 import uvicorn
+import httpx
 import base64
+import datetime
+import asyncio
+import functools
+import collections
+import io
 import json
+import logging
 import re
-from typing import Annotated
-from .classes.Reciept import Receipt 
+import time
+from typing import Annotated, List, Optional
+from .classes.Reciept import Receipt, LineTax
 from .classes.Achievement_progress import UserAchievementsData 
 from .classes.Budget import UserBudgetData 
 from . import db_helper as db
-import instructor
+from . import cache_helper
+from . import dedup_helper
+from . import export_helper
+from . import tax_helper
+from . import image_helper
+from . import llm_helper
+from . import job_helper
+from . import json_helper
+from . import metrics_helper
+from contextlib import asynccontextmanager
+import threading
 
 
 # Load environment variables from .env file
 load_dotenv()
 
+logger = logging.getLogger("tolaktax")
+request_logger = logging.getLogger("tolaktax.requests")
+
 # Load the receipt prompt from file
 prompt_path = os.path.join(os.path.dirname(__file__), "receipt_prompt.txt")
 with open(prompt_path, "r") as f:
@@ -28,15 +51,220 @@ prompt_path = os.path.join(os.path.dirname(__file__), "tax_prompt.txt")
 with open(prompt_path, "r") as f:
     TAX_PROMPT = f.read()
 
+RECEIPT_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+
+# Cached OCR results are keyed on the prompt text too, so editing receipt_prompt.txt
+# invalidates every stored entry without a manual flush.
+RECEIPT_PROMPT_VERSION = cache_helper.content_key(
+    RECEIPT_PROMPT,
+    f"{image_helper.IMAGE_MAX_SIDE}:{image_helper.IMAGE_FORMAT}:{image_helper.IMAGE_QUALITY}:{image_helper.IMAGE_GRAYSCALE}",
+)[:12]
+
+receipt_cache = cache_helper.build_cache(
+    "receipt_ocr",
+    backend=os.environ.get("OCR_CACHE_BACKEND", "memory"),
+    maxsize=int(os.environ.get("OCR_CACHE_MAX_ENTRIES", "2048")),
+    ttl=float(os.environ.get("OCR_CACHE_TTL_SECONDS", "604800")),
+    collection=lambda: db.get_db().collection("ocr_cache"),
+)
+
+TAX_MODEL = "llama-3.3-70b-versatile"
+
+# Per line-item classification cache; the version covers the model and prompt
+# text, and only TAX_MODEL's answers are cached
+TAX_PROMPT_VERSION = cache_helper.content_key(TAX_MODEL, TAX_PROMPT)[:12]
+RELIEF_CATEGORIES = tax_helper.parse_relief_categories(TAX_PROMPT)
+
+tax_cache = cache_helper.build_cache(
+    "line_tax",
+    backend=os.environ.get("TAX_CACHE_BACKEND", "memory"),
+    maxsize=int(os.environ.get("TAX_CACHE_MAX_ENTRIES", "50000")),
+    ttl=float(os.environ.get("TAX_CACHE_TTL_SECONDS", "2592000")),
+    collection=lambda: db.get_db().collection("tax_cache"),
+)
+
+# Keyword pre-classifier built from the category definitions in the tax prompt
+tax_rules = tax_helper.RuleClassifier(
+    TAX_PROMPT,
+    min_confidence=float(os.environ.get("TAX_RULES_MIN_CONFIDENCE", "0.85")),
+)
+
+# Per-receipt tax prompt with full definitions only for the relevant categories;
+# TAX_PROMPT_RETRIEVAL=0 sends the whole prompt instead
+TAX_PROMPT_RETRIEVAL = os.environ.get("TAX_PROMPT_RETRIEVAL", "1") != "0"
+tax_prompts = tax_helper.TaxPromptBuilder(
+    TAX_PROMPT,
+    max_categories=int(os.environ.get("TAX_PROMPT_MAX_CATEGORIES", "6")),
+)
+
+# Likely duplicates of stored receipts (any user's) are refused before the
+# upload and model calls; the index lives in process and is filled lazily: a
+# user's receipts on their first claim, others' by fingerprint on each claim
+DEDUP_ENABLED = os.environ.get("DEDUP_ENABLED", "1") != "0"
+duplicate_index = dedup_helper.DuplicateIndex(
+    max_distance=int(os.environ.get("DEDUP_IMAGE_MAX_DISTANCE", "6")),
+)
+# Loads of each user's stored receipts into duplicate_index, done or running
+duplicate_index_loads = {}
+
+# Identical model calls in flight at the same time (keyed by image, or by the
+# tax request built from the normalized receipt) are made once and shared;
+# LLM_SINGLE_FLIGHT=0 makes every call separately
+LLM_SINGLE_FLIGHT = os.environ.get("LLM_SINGLE_FLIGHT", "1") != "0"
+receipt_flight = llm_helper.SingleFlight("read_receipt", enabled=LLM_SINGLE_FLIGHT)
+tax_flight = llm_helper.SingleFlight("classify_tax", enabled=LLM_SINGLE_FLIGHT)
+
+# Line items a tax response didn't cover (e.g. it was cut off at
+# max_completion_tokens) are re-requested on their own, up to this many times
+TAX_FOLLOW_UP_REQUESTS = int(os.environ.get("TAX_FOLLOW_UP_REQUESTS", "2"))
+
+# Short, unambiguous tax requests go to TAX_SMALL_MODEL first and escalate to
+# TAX_MODEL when it fails, leaves items out or hasn't answered within
+# TAX_HEDGE_AFTER_SECONDS (the 70B request is then sent alongside it). The
+# model requests of one classification stop after TAX_LATENCY_BUDGET_SECONDS,
+# and a receipt with items left unclassified is refused with a 503 listing
+# them. TAX_SMALL_MODEL= sends everything to TAX_MODEL.
+TAX_SMALL_MODEL = os.environ.get("TAX_SMALL_MODEL", "llama-3.1-8b-instant")
+TAX_HEDGE_AFTER_SECONDS = float(os.environ.get("TAX_HEDGE_AFTER_SECONDS", "2.0"))
+TAX_LATENCY_BUDGET_SECONDS = float(os.environ.get("TAX_LATENCY_BUDGET_SECONDS", "20.0"))
+tax_router = tax_helper.TaxModelRouter(
+    [model for model in (TAX_SMALL_MODEL, TAX_MODEL) if model],
+    tax_rules,
+    small_max_items=int(os.environ.get("TAX_ROUTE_SMALL_MAX_ITEMS", "8")),
+    max_ambiguous=int(os.environ.get("TAX_ROUTE_MAX_AMBIGUOUS", "0")),
+    tokens_per_item=int(os.environ.get("TAX_TOKENS_PER_ITEM", "48")),
+    max_tokens=int(os.environ.get("TAX_MAX_COMPLETION_TOKENS", "4096")),
+)
 
+# Receipts with more than TAX_CHUNK_ITEMS line items for the model are split
+# into chunks of about that size, classified up to TAX_CHUNK_CONCURRENCY at a
+# time, so a long receipt takes about as long as a short one; 0 disables it
+TAX_CHUNK_ITEMS = int(os.environ.get("TAX_CHUNK_ITEMS", "10"))
+TAX_CHUNK_CONCURRENCY = int(os.environ.get("TAX_CHUNK_CONCURRENCY", "4"))
 
-client_groq = Groq(api_key=os.environ.get("GROQ_API_KEY"))
-client = instructor.from_groq(client_groq,mode=instructor.Mode.JSON)
 
-app = FastAPI()
 
+# Model clients are created on first use or by the startup warm-up, not at
+# import: building the instructor client imports the whole OpenAI SDK.
+_clients_lock = threading.Lock()
+_client_groq = None
+_client = None
+
+def get_groq_client():
+    """
+    Async Groq client; GROQ_MAX_CONNECTIONS bounds how many model calls can be in flight at once.
+    """
+    global _client_groq
+    if _client_groq is None:
+        with _clients_lock:
+            if _client_groq is None:
+                _client_groq = AsyncGroq(
+                    api_key=os.environ.get("GROQ_API_KEY"),
+                    http_client=DefaultAsyncHttpxClient(
+                        limits=httpx.Limits(max_connections=int(os.environ.get("GROQ_MAX_CONNECTIONS", "32")))
+                    ),
+                )
+    return _client_groq
+
+def get_instructor_client():
+    """
+    Instructor wrapper around the Groq client, for structured receipt extraction.
+    """
+    global _client
+    if _client is None:
+        groq_client = get_groq_client()
+        with _clients_lock:
+            if _client is None:
+                import instructor
+                _client = instructor.from_groq(groq_client, mode=instructor.Mode.JSON)
+    return _client
+
+
+readiness = {"ready": False, "error": None, "warm_up_seconds": None}
+WARM_UP_RETRY_SECONDS = float(os.environ.get("WARM_UP_RETRY_SECONDS", "5"))
+
+async def warm_up_clients():
+    """
+    Create the model and Google clients in the background so the server can
+    answer (and report not-ready) while they warm; retried until it succeeds.
+    """
+    while True:
+        start = time.perf_counter()
+        try:
+            await asyncio.to_thread(get_instructor_client)
+            await db.warm_up()
+        except Exception as e:
+            readiness["error"] = f"{type(e).__name__}: {e}"
+            logger.warning("Client warm-up failed, retrying in %ss: %s", WARM_UP_RETRY_SECONDS, readiness["error"])
+            await asyncio.sleep(WARM_UP_RETRY_SECONDS)
+            continue
+        readiness.update(ready=True, error=None, warm_up_seconds=round(time.perf_counter() - start, 3))
+        logger.info("Clients warm after %ss", readiness["warm_up_seconds"])
+        return
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    job_workers.start()
+    warm_up = asyncio.create_task(warm_up_clients())
+    yield
+    warm_up.cancel()
+    await job_workers.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """
+    Time every request: observe the latency histogram under the route
+    template, and log one JSON line with the per-stage breakdown.
+    """
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    stages = {}
+    token = metrics_helper.request_stages.set(stages)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics_helper.request_stages.reset(token)
+        route = request.scope.get("route")
+        route_path = route.path if route is not None else "unmatched"
+        metrics_helper.REQUEST_LATENCY.observe(elapsed, method=request.method, route=route_path, status=status)
+        request_logger.info(json.dumps({
+            "request_id": request_id,
+            "method": request.method,
+            "route": route_path,
+            "status": status,
+            "duration_ms": round(elapsed * 1000, 1),
+            "stages_ms": {name: round(ms, 1) for name, ms in stages.items()},
+        }))
+
+
+
+
+
+async def get_current_user(id_token: str):
+    """
+    Dependency resolving the `id_token` query parameter to a Firebase uid.
+    """
+    user_id = await db.get_uid_from_id_token(id_token)
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Invalid ID token")
+    return user_id
+
+
+def sse_event(event: str, data) -> str:
+    """
+    Format one Server-Sent Events message with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 
 @app.get("/")
@@ -44,20 +272,26 @@ async def root():
     return {"message": "Hello World?"}
 
 
+@app.get("/ready")
+async def ready(response: Response):
+    """
+    Readiness probe: 503 until the startup warm-up has created the model and
+    Google clients and reached Firestore.
+    """
+    if not readiness["ready"]:
+        response.status_code = 503
+    return readiness
+
+
 @app.post("/upload-reciept-image/")
 async def upload_reciept_image(file: Annotated[UploadFile, File()]):
     try:
-        # Create a temporary file to save the uploaded content
-        temp_file_path = f"temp_{file.filename}"
-        with open(temp_file_path, "wb") as temp_file:
-            content = await file.read()
-            temp_file.write(content)
-        
-        # Upload the temporary file to Minio
-        image_url = db.upload_to_bucket(
+        # Stream the spooled upload straight to GCS
+        image_url = await db.upload_to_bucket(
             blob_name=f"receipts/{uuid.uuid4()}_{file.filename}",
-            path_to_file=temp_file_path,
-            bucket_name=os.environ.get("GOOGLE_BUCKET_NAME")
+            file_obj=file.file,
+            content_type=file.content_type,
+            size=file.size,
         )
         
         
@@ -65,117 +299,771 @@ async def upload_reciept_image(file: Annotated[UploadFile, File()]):
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error uploading image: {str(e)}")
-    finally:
-        # Ensure the temporary file is removed
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+
+
+async def extract_receipt(image: bytes, mime_type: str, response: Response = None):
+    """
+    Run the vision model over a receipt image, using the OCR cache.
+
+    Returns:
+        The extracted receipt as a dict.
+    """
+    cache_key = cache_helper.content_key(RECEIPT_MODEL, RECEIPT_PROMPT_VERSION, image)
+    cached_receipt = await receipt_cache.get(cache_key)
+    if cached_receipt is not None:
+        return cached_receipt
+
+    # The same image arriving twice at once (a double tap, a client retry) makes one model call
+    return await receipt_flight.do(cache_key, lambda: read_receipt_with_model(image, mime_type, cache_key, response))
+
+
+async def read_receipt_with_model(image: bytes, mime_type: str, cache_key: str, response: Response = None):
+    """
+    Extract a receipt with the vision model and cache the result under
+    `cache_key`.
+    """
+    # Downscaled copy for the vision model only; the original is what gets uploaded
+    image, mime_type, image_stats = await image_helper.preprocess_receipt_image_async(image, mime_type)
+    if image_stats is not None and response is not None:
+        response.headers["Server-Timing"] = image_helper.server_timing_header(image_stats)
+        response.headers["X-Image-Bytes-Saved"] = str(image_stats["original_bytes"] - len(image))
+
+    base64_image = base64.b64encode(image).decode("utf-8")
+
+    receipt, _ = await llm_helper.call_groq(
+    get_instructor_client().chat.completions.create_with_completion,
+    model=RECEIPT_MODEL,
+    response_model =Receipt,
+    messages=[
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": RECEIPT_PROMPT,
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{mime_type};base64,{base64_image}",
+                    },
+                },
+            ],
+        }
+    ],
+    temperature=0.5,
+    max_completion_tokens=1024,
+    top_p=1,
+    stream=False,
+    stop=None,
+)
+    
+    logger.debug("Extracted receipt: %s", receipt.model_dump())
+    await receipt_cache.set(cache_key, receipt.model_dump())
+    return receipt.model_dump()
 
 
 @app.post("/read-receipt-image/")
-async def read_receipt_image(file: Annotated[UploadFile, File()]):
+async def read_receipt_image(file: Annotated[UploadFile, File()], response: Response):
     try:
         image = await file.read()
-        base64_image = base64.b64encode(image).decode("utf-8")
-        mime_type = file.content_type
-
-        receipt = client.chat.completions.create(
-        model="meta-llama/llama-4-scout-17b-16e-instruct",
-        response_model =Receipt,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": RECEIPT_PROMPT,
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:{mime_type};base64,{base64_image}",
-                        },
-                    },
-                ],
-            }
-        ],
-        temperature=0.5,
-        max_completion_tokens=1024,
-        top_p=1,
-        stream=False,
-        stop=None,
-    )
-        
-        print(receipt.model_dump())
-        return receipt.model_dump()
+        return await extract_receipt(image, file.content_type, response)
     
     except Exception as e:
         return {"error": f"Could not read image: {str(e)}"}
 
 
+async def index_stored_receipts(**filters):
+    """Add the stored receipts db.stream_receipt_fingerprints yields for `filters` to the duplicate index."""
+    async for receipt_id, user_id, image_hash, fingerprint in db.stream_receipt_fingerprints(**filters):
+        if receipt_id not in duplicate_index:
+            duplicate_index.add(receipt_id, user_id, int(image_hash, 16) if image_hash else None, fingerprint)
+
+
+async def load_duplicate_candidates(user_id: str, fingerprint: str = None):
+    """
+    Make sure the duplicate index holds every stored receipt a new receipt
+    could duplicate: all of the user's own (loaded once per process, on
+    their first claim) and any user's with the same fingerprint, since a
+    receipt is only another user's duplicate when its fields match.
+    A failed load is logged and retried on the next claim.
+    """
+    def forget_failed(task):
+        if task.cancelled() or task.exception() is not None:
+            duplicate_index_loads.pop(user_id, None)
+
+    load = duplicate_index_loads.get(user_id)
+    if load is None:
+        load = duplicate_index_loads[user_id] = asyncio.ensure_future(index_stored_receipts(user_id=user_id))
+        load.add_done_callback(forget_failed)
+    try:
+        await asyncio.shield(load)
+        if fingerprint is not None:
+            await index_stored_receipts(fingerprint=fingerprint)
+    except Exception as e:
+        logger.warning("Loading stored receipts for duplicate detection failed: %s", e)
+
+
+async def claim_receipt(user_id: str, image: bytes, receipt_data: dict, allow_duplicate: bool = False):
+    """
+    Refuse a likely duplicate of a stored receipt with a 409
+    before any upload or model call, and hold the new receipt's place in the
+    duplicate index so a concurrent copy is refused too.
+
+    Returns:
+        The claim to pass to settle_receipt_claim once the receipt is stored
+        (or has failed), or None when duplicate detection is off.
+    """
+    if not DEDUP_ENABLED:
+        return None
+    with metrics_helper.stage("dedup:hash"):
+        image_hash = await image_helper.image_dhash_async(image) if image else None
+    fingerprint = dedup_helper.receipt_fingerprint(receipt_data)
+    if not allow_duplicate:
+        with metrics_helper.stage("dedup:load"):
+            await load_duplicate_candidates(user_id, fingerprint)
+
+    with metrics_helper.stage("dedup:lookup"):
+        duplicate = None if allow_duplicate else duplicate_index.find(user_id, image_hash, fingerprint)
+    if duplicate is not None:
+        detail = {"message": "This receipt looks like one that was already added"}
+        # Nothing about other accounts' receipts is revealed
+        if duplicate["user_id"] == user_id:
+            detail.update(match=duplicate["match"], duplicate_of=duplicate["receipt_id"])
+        raise HTTPException(status_code=409, detail=detail)
+
+    claim = {"key": f"pending:{uuid.uuid4()}", "image_hash": image_hash, "fingerprint": fingerprint}
+    duplicate_index.add(claim["key"], user_id, image_hash, fingerprint)
+    return claim
+
+
+def claim_fields(claim) -> dict:
+    """Receipt fields recording the claim's image hash and fingerprint."""
+    if claim is None:
+        return {}
+    image_hash = claim["image_hash"]
+    return {
+        "image_hash": f"{image_hash:016x}" if image_hash is not None else None,
+        "receipt_fingerprint": claim["fingerprint"],
+    }
+
+
+def settle_receipt_claim(claim, user_id: str, receipt_id: str = None):
+    """Index the stored receipt under its id, or drop the claim when it wasn't stored."""
+    if claim is None:
+        return
+    duplicate_index.remove(claim["key"])
+    if receipt_id is not None:
+        duplicate_index.add(receipt_id, user_id, claim["image_hash"], claim["fingerprint"])
+
+
 @app.post("/add-receipt/")
-async def add_receipt(id_token: str,file: Annotated[UploadFile, File()],receipt: str):
-    print(receipt)
-    await file.seek(0)  
-    image_url = await upload_reciept_image(file)
-    print(f"Image URL: {image_url['image_url']}")
-
-    user_id = db.get_uid_from_id_token(id_token)
-    print(f"User ID: {user_id}")
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Invalid ID token")
-    
+async def add_receipt(
+    user_id: Annotated[str, Depends(get_current_user)],
+    file: Annotated[UploadFile, File()],
+    receipt: str,
+    response: Response,
+    background: bool = False,
+    allow_duplicate: bool = False,
+    idempotency_key: Annotated[Optional[str], Header()] = None,
+):
+    """
+    Classify and store a receipt with its image.
+
+    A likely duplicate of a stored receipt (same image, or same merchant,
+    time and total) is refused with HTTP 409; `duplicate_of` names the
+    receipt when it is the caller's own.
+
+    - **background**: Queue the work and return a job id right away
+      (HTTP 202); poll `/jobs/{job_id}` or stream `/jobs/{job_id}/events`.
+      Duplicates fail the job.
+    - **allow_duplicate**: Store the receipt even if it looks like a duplicate.
+    - **Idempotency-Key** (header): Retries with the same key return the
+      original job instead of adding the receipt again.
+    """
+    if background:
+        try:
+            receipt_payload = Receipt(**json.loads(receipt)).model_dump()
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Invalid receipt: {str(e)}")
+
+        job, created = await job_queue.enqueue(
+            user_id,
+            "add_receipt",
+            {
+                "receipt": receipt_payload,
+                "filename": file.filename,
+                "content_type": file.content_type,
+                "allow_duplicate": allow_duplicate,
+            },
+            blob=await file.read(),
+            idempotency_key=idempotency_key,
+        )
+        if created:
+            job_workers.notify()
+        response.status_code = 202
+        return {"job_id": job["job_id"], "status": job["status"]}
+
+    logger.debug("Receipt: %s", receipt)
     receipt_data = Receipt(**json.loads(receipt)).model_dump()
-    print(f"Receipt Data: {receipt_data}")
+    logger.debug("Receipt Data: %s", receipt_data)
 
-    #enrich with tax info
-    receipt_data_enriched = await classify_tax(receipt_data)
+    claim = await claim_receipt(user_id, await file.read(), receipt_data, allow_duplicate)
+    receipt_id = None
+    try:
+        await file.seek(0)
+        image_url = await upload_reciept_image(file)
+        logger.debug("Image URL: %s", image_url['image_url'])
 
-    if "error" in receipt_data:
-        raise HTTPException(status_code=400, detail=receipt_data["error"])
-    
+        #enrich with tax info
+        receipt_data_enriched = await classify_tax(receipt_data)
+
+        if "error" in receipt_data:
+            raise HTTPException(status_code=400, detail=receipt_data["error"])
+
+        try:
+            receipt_data = dict(receipt_data_enriched['tax_classification'], **claim_fields(claim))
+            doc_ref = await db.add_receipt(receipt_data, user_id, image_url['image_url'])
+            receipt_id = doc_ref[1].id
+            return {"message": "Receipt added successfully", "receipt_id": receipt_id}
+
+        except Exception as e:
+            logger.error("Error in add_receipt: %s - %s", type(e).__name__, e)
+            raise HTTPException(status_code=500, detail=f"Error adding receipt: {str(e)}")
+    finally:
+        settle_receipt_claim(claim, user_id, receipt_id)
+
+def receipt_blob_name(filename: str) -> str:
+    return f"receipts/{uuid.uuid4()}_{filename}"
+
+
+async def upload_and_extract_receipt(image: bytes, filename: str, content_type: str, response: Response = None,
+                                     blob_name: str = None):
+    """
+    Upload a receipt image to GCS (as `blob_name`, or a new name) while the
+    vision model reads it.
+
+    Returns:
+        (image_url, receipt_data) for the uploaded image and extracted receipt.
+    """
+    blob_name = blob_name or receipt_blob_name(filename)
+    upload_result, receipt_result = await asyncio.gather(
+        db.upload_to_bucket(
+            blob_name=blob_name,
+            file_obj=io.BytesIO(image),
+            content_type=content_type,
+            size=len(image),
+        ),
+        extract_receipt(image, content_type, response),
+        return_exceptions=True,
+    )
+
+    if isinstance(upload_result, Exception) or isinstance(receipt_result, Exception):
+        if not isinstance(upload_result, Exception):
+            # Don't leave an orphaned image behind when the receipt couldn't be read
+            await db.delete_from_bucket(blob_name)
+        if isinstance(upload_result, Exception):
+            raise HTTPException(status_code=500, detail=f"Error uploading image: {str(upload_result)}")
+        raise HTTPException(status_code=400, detail=f"Could not read image: {str(receipt_result)}")
+
+    return upload_result, receipt_result
+
+
+@app.post("/scan-and-add-receipt/")
+async def scan_and_add_receipt(
+    user_id: Annotated[str, Depends(get_current_user)],
+    file: Annotated[UploadFile, File()],
+    response: Response,
+    allow_duplicate: bool = False,
+):
+    """
+    Read, classify and store a receipt from a single image upload.
+
+    The GCS upload runs concurrently with the vision call, followed by tax
+    classification and the Firestore write. A likely duplicate of a stored
+    receipt is refused with HTTP 409 before classification (see
+    `/add-receipt/`).
+
+    - **id_token**: The Firebase Authentication ID token of the user.
+    - **file**: The receipt image.
+    - **allow_duplicate**: Store the receipt even if it looks like a duplicate.
+    """
+    image = await file.read()
+    blob_name = receipt_blob_name(file.filename)
+    image_url, receipt_result = await upload_and_extract_receipt(
+        image, file.filename, file.content_type, response, blob_name=blob_name
+    )
+
+    # The fingerprint needs the extracted fields; a re-sent image is an OCR cache hit anyway
     try:
-        doc_ref = db.add_receipt(receipt_data_enriched['tax_classification'], user_id, image_url['image_url'])
-        return {"message": "Receipt added successfully", "receipt_id": doc_ref[1].id}
-    
-    
-    except Exception as e:
-        print(f"Original error in add_receipt: {type(e).__name__} - {e}") # Print the original error
-        raise HTTPException(status_code=500, detail=f"Error adding receipt: {str(e)}")
+        claim = await claim_receipt(user_id, image, receipt_result, allow_duplicate)
+    except HTTPException:
+        await db.delete_from_bucket(blob_name)
+        raise
+    receipt_id = None
+    try:
+        receipt_data_enriched = await classify_tax(receipt_result)
+        receipt_data = receipt_data_enriched['tax_classification']
+
+        if "error" in receipt_data:
+            raise HTTPException(status_code=400, detail=receipt_data["error"])
+
+        try:
+            doc_ref = await db.add_receipt(dict(receipt_data, **claim_fields(claim)), user_id, image_url)
+            receipt_id = doc_ref[1].id
+            receipt_data["receipt_id"] = receipt_id
+            return {"message": "Receipt added successfully", "receipt_id": receipt_id, "receipt": receipt_data}
+
+        except Exception as e:
+            logger.error("Error in scan_and_add_receipt: %s - %s", type(e).__name__, e)
+            raise HTTPException(status_code=500, detail=f"Error adding receipt: {str(e)}")
+    finally:
+        settle_receipt_claim(claim, user_id, receipt_id)
+        if receipt_id is None:
+            # Classification or the write failed: don't leave the image orphaned
+            await db.delete_from_bucket(blob_name)
+
+
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "100"))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "4"))
+
+async def process_batch_item(user_id: str, item: dict, allow_duplicate: bool = False):
+    """
+    OCR (for image items), check against duplicates and tax-classify one
+    batch item. A likely duplicate (of a stored receipt or of an earlier item
+    of the batch) raises the 409 of claim_receipt.
+
+    Returns:
+        (receipt_data, image_url, claim); image_url is None for receipt JSON
+        items, and the claim is for settle_receipt_claim once the item has
+        been written (or dropped).
+    """
+    image = None
+    image_url = None
+    blob_name = None
+    if "file" in item:
+        # Read here, under the batch's concurrency limit, so only that many uploads are held in memory
+        file = item["file"]
+        image = await file.read()
+        blob_name = receipt_blob_name(file.filename)
+        image_url, receipt_data = await upload_and_extract_receipt(
+            image, file.filename, file.content_type, blob_name=blob_name
+        )
+    else:
+        receipt_data = item["receipt"]
+
+    try:
+        claim = await claim_receipt(user_id, image, receipt_data, allow_duplicate)
+    except HTTPException:
+        if blob_name is not None:
+            await db.delete_from_bucket(blob_name)
+        raise
+    try:
+        receipt_data = (await classify_tax(receipt_data))['tax_classification']
+        if "error" in receipt_data:
+            raise HTTPException(status_code=400, detail=receipt_data["error"])
+    except BaseException as e:
+        settle_receipt_claim(claim, user_id)
+        if blob_name is not None and isinstance(e, Exception):
+            await db.delete_from_bucket(blob_name)
+        raise
+    return dict(receipt_data, **claim_fields(claim)), image_url, claim
+
+
+async def run_receipt_batch(user_id: str, items: list, allow_duplicate: bool = False):
+    """
+    Process batch items on a bounded worker pool and store them. Likely
+    duplicates get a "duplicate" status with the 409 detail instead.
+
+    Finished items are written together in one Firestore batch each time the
+    writer catches up, so commits grow under load and items still land
+    promptly when they finish one by one.
+
+    Yields:
+        A status dict per item as soon as it is stored or has failed.
+    """
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    finished = asyncio.Queue()
+
+    async def worker(item):
+        async with semaphore:
+            try:
+                receipt_data, image_url, claim = await process_batch_item(user_id, item, allow_duplicate)
+                await finished.put((item["index"], receipt_data, image_url, claim, None))
+            except Exception as e:
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                status = "duplicate" if isinstance(e, HTTPException) and e.status_code == 409 else "error"
+                failure = {"index": item["index"], "status": status, "detail": detail}
+                await finished.put((item["index"], None, None, None, failure))
+
+    tasks = [asyncio.create_task(worker(item)) for item in items]
+    remaining = len(items)
+    try:
+        while remaining:
+            results = [await finished.get()]
+            while not finished.empty() and len(results) < db.BATCH_WRITE_LIMIT:
+                results.append(finished.get_nowait())
+            remaining -= len(results)
+
+            for *_, failure in results:
+                if failure is not None:
+                    yield failure
+
+            stored = [result[:4] for result in results if result[4] is None]
+            if not stored:
+                continue
+            receipt_ids = [None] * len(stored)
+            error = None
+            try:
+                receipt_ids = await db.add_receipts_batch(
+                    [(receipt_data, image_url) for _, receipt_data, image_url, _ in stored], user_id
+                )
+            except Exception as e:
+                logger.error("Error writing receipt batch: %s - %s", type(e).__name__, e)
+                error = f"Error adding receipt: {str(e)}"
+                for _, _, image_url, _ in stored:
+                    blob_name = db.blob_name_from_url(image_url)
+                    if blob_name is not None:
+                        await db.delete_from_bucket(blob_name)
+            finally:
+                for (_, _, _, claim), receipt_id in zip(stored, receipt_ids):
+                    settle_receipt_claim(claim, user_id, receipt_id)
+            for (index, _, _, _), receipt_id in zip(stored, receipt_ids):
+                if error is None:
+                    yield {"index": index, "status": "added", "receipt_id": receipt_id}
+                else:
+                    yield {"index": index, "status": "error", "detail": error}
+    finally:
+        # Stop outstanding work if the client goes away mid-stream, and drop
+        # the claims of items that finished but won't be written
+        for task in tasks:
+            task.cancel()
+        while not finished.empty():
+            settle_receipt_claim(finished.get_nowait()[3], user_id)
+
+
+@app.post("/add-receipts/batch")
+async def add_receipts_batch(
+    user_id: Annotated[str, Depends(get_current_user)],
+    files: Annotated[Optional[List[UploadFile]], File()] = None,
+    receipts: Annotated[Optional[str], Form()] = None,
+    stream: bool = False,
+    allow_duplicate: bool = False,
+):
+    """
+    Add many receipts in one request.
+
+    - **files**: Receipt images to read, classify and store.
+    - **receipts**: JSON array of already-extracted receipts to classify and store.
+    - **stream**: Stream one NDJSON status line per item as it completes
+      instead of returning all statuses at the end.
+    - **allow_duplicate**: Store items even if they look like duplicates.
+
+    Items are indexed images first, then receipts, in the order given. Likely
+    duplicates of stored receipts or of other items in the batch get a
+    "duplicate" status with the detail `/add-receipt/` would send with its 409.
+    """
+    items = []
+    for file in files or []:
+        items.append({"index": len(items), "file": file})
+    try:
+        for receipt in json.loads(receipts) if receipts else []:
+            items.append({"index": len(items), "receipt": receipt})
+    except (json.JSONDecodeError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid receipts JSON: {str(e)}")
+
+    if not items:
+        raise HTTPException(status_code=400, detail="No receipts provided")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} receipts per batch")
+
+    if stream:
+        async def status_lines():
+            async for status in run_receipt_batch(user_id, items, allow_duplicate):
+                yield json.dumps(status) + "\n"
+
+        return StreamingResponse(status_lines(), media_type="application/x-ndjson")
+
+    results = [status async for status in run_receipt_batch(user_id, items, allow_duplicate)]
+    return {"results": sorted(results, key=lambda status: status["index"])}
+
+async def run_add_receipt_job(job: dict):
+    """
+    Background handler for queued /add-receipt/ calls.
+    """
+    payload = job["payload"]
+    # Checked here rather than at enqueue so Idempotency-Key retries still return the original job
+    claim = await claim_receipt(job["user_id"], job["blob"], payload["receipt"], payload.get("allow_duplicate", False))
+    receipt_id = None
+    try:
+        image_url = await db.upload_to_bucket(
+            blob_name=receipt_blob_name(payload['filename']),
+            file_obj=io.BytesIO(job["blob"]),
+            content_type=payload["content_type"],
+            size=len(job["blob"]),
+        )
+
+        receipt_data = (await classify_tax(payload["receipt"]))['tax_classification']
+        if "error" in receipt_data:
+            raise HTTPException(status_code=400, detail=receipt_data["error"])
+
+        doc_ref = await db.add_receipt(dict(receipt_data, **claim_fields(claim)), job["user_id"], image_url)
+        receipt_id = doc_ref[1].id
+        return {"receipt_id": receipt_id}
+    finally:
+        settle_receipt_claim(claim, job["user_id"], receipt_id)
+
+
+job_queue = job_helper.SQLiteJobQueue(
+    os.environ.get("JOB_DB_PATH", ":memory:"),
+    lease_seconds=float(os.environ.get("JOB_LEASE_SECONDS", "120")),
+)
+job_workers = job_helper.JobWorkers(
+    job_queue,
+    concurrency=int(os.environ.get("JOB_WORKERS", "2")),
+    poll_interval=float(os.environ.get("JOB_POLL_INTERVAL_SECONDS", "1.0")),
+)
+job_workers.register("add_receipt", run_add_receipt_job)
+
+
+async def run_rebuild_aggregates_job(job: dict):
+    """
+    Background handler recomputing a user's aggregate documents.
+    """
+    return {"receipt_count": await db.rebuild_user_aggregates(job["user_id"])}
+
+job_workers.register("rebuild_aggregates", run_rebuild_aggregates_job)
+
+JOB_EVENTS_POLL_SECONDS = 0.5
+
+
+async def get_user_job(job_id: str, user_id: str):
+    job = await job_queue.get(job_id)
+    if job is None or job["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    job.pop("payload")
+    return job
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, user_id: Annotated[str, Depends(get_current_user)]):
+    return await get_user_job(job_id, user_id)
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, user_id: Annotated[str, Depends(get_current_user)]):
+    """
+    Server-Sent Events stream of a job's status, ending once it has
+    succeeded or failed.
+    """
+    job = await get_user_job(job_id, user_id)
+
+    async def events():
+        current = job
+        last_status = None
+        while True:
+            if current["status"] != last_status:
+                last_status = current["status"]
+                yield sse_event("status", current)
+            if current["status"] in ("succeeded", "failed"):
+                return
+            await asyncio.sleep(JOB_EVENTS_POLL_SECONDS)
+            current = await get_user_job(job_id, user_id)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+RECEIPT_FIELDS = set(Receipt.model_fields) | {"user_id", "image_url"}
+MAX_RECEIPTS_PAGE_SIZE = 500
 
 @app.get("/get-receipts-by-user/")
-async def get_receipts_by_user(id_token: str):
-    user_id = db.get_uid_from_id_token(id_token)
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Invalid ID token")
+async def get_receipts_by_user(
+    user_id: Annotated[str, Depends(get_current_user)],
+    limit: Optional[int] = None,
+    start_after: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    fields: Optional[str] = None,
+    format: str = "json",
+):
+    """
+    List a user's receipts, newest first.
+
+    - **limit**: Page size (max 500); all receipts when omitted.
+    - **start_after**: The `next_start_after` value from the previous page.
+    - **start_date** / **end_date**: ISO 8601 bounds on `transaction_datetime`, both
+      inclusive; a date-only `end_date` includes that whole day.
+    - **fields**: Comma-separated receipt fields to return, e.g. `merchant_name,total_amount`.
+    - **format**: `json` for a paged response, `ndjson` to stream one receipt per line.
+    """
+
+    if limit is not None and not 0 < limit <= MAX_RECEIPTS_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_RECEIPTS_PAGE_SIZE}")
+
+    selected_fields = None
+    if fields:
+        selected_fields = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown_fields = set(selected_fields) - RECEIPT_FIELDS
+        if unknown_fields:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown_fields))}")
+
+    query_args = dict(
+        limit=limit, start_after=start_after, start_date=start_date, end_date=end_date, fields=selected_fields
+    )
+
+    if format == "ndjson":
+        receipts = db.stream_user_receipts(user_id, **query_args)
+        # Start the query before the 200 goes out, so a bad cursor is a 400 as with format=json
+        try:
+            first = await anext(receipts, None)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error retrieving receipts: {str(e)}")
+
+        async def receipt_lines():
+            if first is None:
+                return
+            yield json.dumps(first, default=str) + "\n"
+            async for receipt_data in receipts:
+                yield json.dumps(receipt_data, default=str) + "\n"
+
+        return StreamingResponse(receipt_lines(), media_type="application/x-ndjson")
 
     try:
-        print(f"User ID: {user_id}")
          # Retrieve receipts for the user
-        receipts = db.get_user_receipts(user_id)
-        return {"receipts": receipts}   
+        receipts = await db.get_user_receipts(user_id, **query_args)
+        next_start_after = receipts[-1]["receipt_id"] if limit and len(receipts) == limit else None
+        return {"receipts": receipts, "next_start_after": next_start_after}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving receipts: {str(e)}")
 
+EXPORT_PAGE_SIZE = int(os.environ.get("EXPORT_PAGE_SIZE", "200"))
+EXPORT_CONCURRENCY = int(os.environ.get("EXPORT_CONCURRENCY", "8"))
+
+
+async def fetch_receipt_image(receipt_data: dict):
+    """
+    Returns:
+        (image bytes, None), or (None, reason) when the image can't be exported.
+    """
+    blob_name = db.blob_name_from_url(receipt_data.get("image_url"))
+    if blob_name is None:
+        return None, "image is not in the receipts bucket"
+    try:
+        return await db.download_from_bucket(blob_name), None
+    except Exception as e:
+        logger.warning("Export: error downloading %s: %s - %s", blob_name, type(e).__name__, e)
+        return None, "image could not be downloaded"
+
+
+async def export_archive(user_id: str, start_date: str = None, end_date: str = None):
+    """
+    Build a user's receipt archive on the fly: per receipt its full record
+    as JSON and its image, then receipts.csv with one row per receipt.
+
+    Receipts are read a page at a time and images downloaded up to
+    EXPORT_CONCURRENCY ahead of the one being written, so memory holds at
+    most that many images whatever the receipt count.
+
+    Yields:
+        Chunks of the ZIP archive.
+    """
+    archive = export_helper.ZipStream()
+    # Only receipts whose image couldn't be exported are remembered, for the CSV
+    missing_images = set()
+
+    # Downloads run ahead of the writer; entries are still written in receipt order
+    downloads = collections.deque()
+    receipts = db.page_user_receipts(user_id, EXPORT_PAGE_SIZE, start_date, end_date)
+    try:
+        while True:
+            receipt_data = await anext(receipts, None)
+            if receipt_data is not None:
+                downloads.append((receipt_data, asyncio.create_task(fetch_receipt_image(receipt_data))))
+                if len(downloads) < EXPORT_CONCURRENCY:
+                    continue
+            if not downloads:
+                break
+
+            receipt_data, download = downloads.popleft()
+            image, image_error = await download
+            if image is not None:
+                receipt_data["image_file"] = export_helper.image_file_name(receipt_data)
+                archive.write(receipt_data["image_file"], image, compress=False)
+            elif receipt_data.get("image_url"):
+                receipt_data["image_error"] = image_error
+                missing_images.add(receipt_data["receipt_id"])
+            archive.write(export_helper.receipt_json_name(receipt_data), export_helper.receipt_json(receipt_data))
+            yield archive.drain()
+    finally:
+        # Stop outstanding downloads if the client goes away mid-stream
+        for _, download in downloads:
+            download.cancel()
+        await receipts.aclose()
+
+    with archive.open("receipts.csv") as entry:
+        entry.write(export_helper.csv_rows([], header=True))
+        rows = []
+        async for receipt_data in db.page_user_receipts(
+            user_id, EXPORT_PAGE_SIZE, start_date, end_date, export_helper.RECEIPT_CSV_FIELDS
+        ):
+            rows.append(export_helper.receipt_csv_row(receipt_data, receipt_data["receipt_id"] not in missing_images))
+            if len(rows) == EXPORT_PAGE_SIZE:
+                entry.write(export_helper.csv_rows(rows))
+                rows = []
+                yield archive.drain()
+        entry.write(export_helper.csv_rows(rows))
+
+    yield archive.close()
+
+
+@app.get("/export")
+async def export_receipts(
+    user_id: Annotated[str, Depends(get_current_user)],
+    assessment_year: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+):
+    """
+    Download a ZIP of a user's receipts as evidence for LHDN:
+    `receipts/<date>_<id>.json` (each receipt with its tax classification),
+    `images/<date>_<id>.<ext>` (the receipt images) and `receipts.csv` (one
+    row per receipt).
+
+    The archive is streamed as it is built.
+
+    - **assessment_year**: Only receipts from this year, e.g. `2024`.
+    - **start_date** / **end_date**: ISO 8601 bounds on `transaction_datetime`
+      (instead of assessment_year).
+    """
+    if assessment_year:
+        if not re.fullmatch(r"\d{4}", assessment_year):
+            raise HTTPException(status_code=400, detail="assessment_year must be a year, e.g. 2024")
+        start_date, end_date = f"{assessment_year}-01-01", f"{assessment_year}-12-31T23:59:59"
+
+    filename = f"tolaktax-receipts-{assessment_year or 'all'}.zip"
+    return StreamingResponse(
+        export_archive(user_id, start_date, end_date),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 @app.get("/user/get-username/")
-async def get_username(id_token: str):
-    user_id = db.get_uid_from_id_token(id_token)
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Invalid ID token")
+async def get_username(user_id: Annotated[str, Depends(get_current_user)]):
 
     try:
-        print(f"User ID: {user_id}")
+        logger.debug("User ID: %s", user_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving username: {str(e)}")
     
 @app.get("/get-achievements-by-user")
-async def get_achievements(id_token: str):
+async def get_achievements(user_id: Annotated[str, Depends(get_current_user)]):
     
-    user_id = db.get_uid_from_id_token(id_token)
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Invalid ID token")
 
     try:
-        achievements_data = db.get_user_achievements(user_id)
+        achievements_data = await db.get_user_achievements(user_id)
 
         if achievements_data is None:
             raise HTTPException(status_code=404, detail="Achievement data not found for this user.")
@@ -192,17 +1080,14 @@ async def get_achievements(id_token: str):
 @app.post("/save-achievements-by-user")
 async def save_achievements(
     achievements_data: UserAchievementsData,
-    id_token: str
+    user_id: Annotated[str, Depends(get_current_user)]
 ):
 
-    user_id = db.get_uid_from_id_token(id_token)
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Invalid ID token")
 
     try:
         data_to_save = achievements_data.dict(by_alias=True)
         
-        db.save_user_achievements(user_id, data_to_save)
+        await db.save_user_achievements(user_id, data_to_save)
 
         return {"status": "success", "message": "Achievements saved successfully"}
         
@@ -213,10 +1098,10 @@ async def save_achievements(
 @app.get("/get-receipt-by-id/")
 async def get_receipt_by_id(receipt_id: str):
     try:
-        print(f"Receipt ID: {receipt_id}")
+        logger.debug("Receipt ID: %s", receipt_id)
         # Retrieve the receipt by its ID
-        receipt = db.get_receipt_by_id(receipt_id)
-        print(f"Retrieved Receipt: {receipt}")
+        receipt = await db.get_receipt_by_id(receipt_id)
+        logger.debug("Retrieved Receipt: %s", receipt)
         if not receipt:
             raise HTTPException(status_code=404, detail="Receipt not found")
         
@@ -227,55 +1112,438 @@ async def get_receipt_by_id(receipt_id: str):
 
 
 
+@app.get("/cache-stats/")
+async def cache_stats():
+    return {
+        "receipt_ocr": receipt_cache.stats(),
+        "line_tax": tax_cache.stats(),
+        "id_token": db.token_cache.stats(),
+        "single_flight": {
+            "read_receipt": receipt_flight.stats(),
+            "classify_tax": tax_flight.stats(),
+        },
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Request/stage latency histograms and LLM token usage in Prometheus text format.
+    """
+    return PlainTextResponse(metrics_helper.render(), media_type="text/plain; version=0.0.4")
+
 
 # Tax 
-@app.get("/classify-tax/")
-async def classify_tax(receipt_data:dict):
+def tax_classification_messages(receipt_data: dict, indexes: list = None):
+    """
+    Tax model prompt for the line items at `indexes` (all when None), with
+    the receipt in the compact encoding.
+    """
+    if indexes is None:
+        indexes = list(range(len(receipt_data["line_items"])))
+    if TAX_PROMPT_RETRIEVAL:
+        tax_prompt = tax_prompts.build(dict(receipt_data, line_items=[receipt_data["line_items"][i] for i in indexes]))
+    else:
+        tax_prompt = TAX_PROMPT
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": tax_helper.compact_receipt(receipt_data, indexes) + ";" + tax_prompt,
+                },
+            ],
+        }
+    ]
+
+
+async def request_tax_classification(receipt_data: dict, indexes: list = None, model: str = TAX_MODEL,
+                                     max_completion_tokens: int = 1024):
+    """
+    Ask a tax model to classify the line items of a receipt at `indexes`
+    (all when None). Identical requests made at the same time share one
+    model call.
+
+    Returns:
+        As run_tax_model.
+    """
+    messages = tax_classification_messages(receipt_data, indexes)
+    key = cache_helper.content_key(model, str(max_completion_tokens), json.dumps(messages, sort_keys=True))
+    return await tax_flight.do(
+        key, lambda: run_tax_model(receipt_data, indexes, messages, model, max_completion_tokens)
+    )
+
+
+async def run_tax_model(receipt_data: dict, indexes: list, messages: list, model: str, max_completion_tokens: int):
+    """
+    Send a tax classification request (see tax_classification_messages).
+
+    Malformed or truncated responses are parsed tolerantly: every complete
+    entry is kept. JSON mode makes Groq reject a response cut off at
+    max_completion_tokens; its failed_generation is parsed the same way.
+
+    Returns:
+        The recovered entries of the response's 'items' list, expected to
+        carry the index of the line item they classify.
+    """
     try:
-        receipt_data = Receipt(**receipt_data)
-        tax_classification = client_groq.chat.completions.create(
-        model="llama-3.3-70b-versatile",
+        tax_classification = await llm_helper.call_groq(
+        get_groq_client().chat.completions.create,
+        model=model,
         response_format={"type": "json_object"},
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": str(receipt_data.model_dump()) +";"+TAX_PROMPT,
-                    },
-                ],
-            }
-        ],
+        messages=messages,
         temperature=0.5,
-        max_completion_tokens=1024,
+        max_completion_tokens=max_completion_tokens,
         top_p=1,
         stream=False,
         stop=None,
         )
-
         response_content = tax_classification.choices[0].message.content
+    except BadRequestError as e:
+        response_content = llm_helper.failed_generation(e)
+        if response_content is None:
+            raise
+
+    items, complete = json_helper.recover_items(response_content)
+    outcome = "valid" if complete else "repaired" if items else "unparseable"
+    metrics_helper.LLM_RESPONSES.inc(model=model, outcome=outcome)
+    if not complete:
+        # One JSON line per malformed response, the corpus format of bench.bench_json_repair
+        logger.info("Malformed tax response: %s", json.dumps({
+            "line_items": len(receipt_data["line_items"]) if indexes is None else len(indexes),
+            "response": response_content,
+        }))
+    return items
+
+
+def log_tax_route(route: dict, **details):
+    # One JSON line per routed classification, for tuning the thresholds against bench.bench_tax_routing
+    logger.info("Tax route: %s", json.dumps(dict(route, **details)))
+
+
+async def classify_missing_line_taxes(receipt_data: dict, missing: list):
+    """
+    Classify the line items at `missing` with the tax models, in chunks of
+    at most TAX_CHUNK_ITEMS items classified concurrently. The models are
+    picked once for all of `missing`, so every chunk of a long receipt goes
+    to the model the whole receipt would; chunks share the latency budget,
+    and their answers are merged by line item index.
+
+    Returns:
+        (line_taxes, models): {line item index: LineTax dict} for the items
+        that were classified, and {line item index: model that answered}.
+    """
+    deadline = time.monotonic() + TAX_LATENCY_BUDGET_SECONDS
+    route = tax_router.route(receipt_data, missing)
+    chunks = tax_helper.chunk_indexes(missing, TAX_CHUNK_ITEMS)
+    if len(chunks) == 1:
+        return await classify_line_tax_chunk(receipt_data, missing, route, deadline)
+
+    semaphore = asyncio.Semaphore(TAX_CHUNK_CONCURRENCY)
+
+    async def classify_chunk(chunk):
+        async with semaphore:
+            return await classify_line_tax_chunk(receipt_data, chunk, route, deadline, chunks=len(chunks))
+
+    line_taxes = {}
+    models = {}
+    for chunk_line_taxes, chunk_models in await asyncio.gather(*(classify_chunk(chunk) for chunk in chunks)):
+        line_taxes.update(chunk_line_taxes)
+        models.update(chunk_models)
+    return line_taxes, models
+
+
+async def classify_line_tax_chunk(receipt_data: dict, missing: list, route: dict, deadline: float, chunks: int = 1):
+    """
+    Classify the line items at `missing` with the models of `route` (see
+    TaxModelRouter.route). Items the response didn't cover are re-requested
+    on their own from the next model up, up to TAX_FOLLOW_UP_REQUESTS times,
+    instead of reclassifying the receipt. Requests stop at `deadline`
+    (time.monotonic()).
+
+    Returns:
+        As classify_missing_line_taxes.
+    """
+    models = route["models"]
+    started_at = time.monotonic()
+    answered_by = []
+    line_taxes = {}
+    line_tax_models = {}
+    pending = list(missing)
+    for attempt in range(TAX_FOLLOW_UP_REQUESTS + 1):
+        tiers = models[min(attempt, len(models) - 1):]
+        max_completion_tokens = tax_router.max_completion_tokens(len(pending))
+        calls = [
+            functools.partial(request_tax_classification, receipt_data, pending, model, max_completion_tokens)
+            for model in tiers
+        ]
         try:
-            tax_classification = json.loads(response_content)
-        except json.JSONDecodeError:
-            tax_classification = db.clean_bad_json_response(response_content)
+            position, items = await llm_helper.hedged(
+                calls, hedge_after=TAX_HEDGE_AFTER_SECONDS, timeout=deadline - time.monotonic()
+            )
+        except TimeoutError:
+            answered_by.append("timeout")
+            metrics_helper.TAX_ROUTES.inc(reason=route["reason"], model="timeout")
+            break
+        answered_by.append(tiers[position])
+        metrics_helper.TAX_ROUTES.inc(reason=route["reason"], model=tiers[position])
+        for i, line_tax in tax_helper.items_by_index(items, pending).items():
+            line_taxes[i] = dict(line_tax, index=i)
+            line_tax_models[i] = tiers[position]
+        pending = [i for i in pending if i not in line_taxes]
+        if not pending:
+            break
+    log_tax_route(
+        route,
+        answered_by=answered_by,
+        unclassified=len(pending),
+        chunks=chunks,
+        seconds=round(time.monotonic() - started_at, 3),
+    )
+    return line_taxes, line_tax_models
+
+
+async def stream_tax_classification(receipt_data: dict, indexes: list = None, model: str = TAX_MODEL,
+                                    max_completion_tokens: int = 1024):
+    """
+    Stream a tax model's classification of a receipt's line items at
+    `indexes` (all when None).
+
+    Groq doesn't combine JSON mode with streaming, so the prompt's output
+    format is relied on and the response is parsed incrementally.
+
+    Yields:
+        Each item of the response's 'items' list as soon as it is complete.
+    """
+    stream = await llm_helper.call_groq(
+    get_groq_client().chat.completions.create,
+    model=model,
+    messages=tax_classification_messages(receipt_data, indexes),
+    temperature=0.5,
+    max_completion_tokens=max_completion_tokens,
+    top_p=1,
+    stream=True,
+    stop=None,
+    )
+
+    parser = json_helper.ItemStreamParser()
+    recovered = False
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            for item in parser.feed(chunk.choices[0].delta.content):
+                recovered = True
+                yield item
+        # Groq reports token usage on the final chunk
+        x_groq = getattr(chunk, "x_groq", None)
+        usage = x_groq.get("usage") if isinstance(x_groq, dict) else getattr(x_groq, "usage", None)
+        if usage is not None:
+            metrics_helper.record_llm_usage(model, usage)
+    outcome = "valid" if parser.done else "repaired" if recovered else "unparseable"
+    metrics_helper.LLM_RESPONSES.inc(model=model, outcome=outcome)
 
-        receipt_data = db.enrich_receipt_tax_info(receipt_data.model_dump(), tax_classification)
+
+async def prefill_line_taxes(receipt_data: dict):
+    """
+    Classify what can be classified without the model: cached line items
+    first, then confident keyword-rule matches.
+
+    Returns:
+        (keys, line_taxes, missing): cache keys and LineTax dicts per line
+        item, and the indexes of items that still need the model.
+    """
+    keys, line_taxes = await tax_helper.lookup_line_taxes(receipt_data, tax_cache, TAX_PROMPT_VERSION, RELIEF_CATEGORIES)
+
+    for i, line_tax in enumerate(line_taxes):
+        if line_tax is None:
+            line_taxes[i] = tax_rules.classify_confident(receipt_data["line_items"][i])
+
+    missing = [i for i, line_tax in enumerate(line_taxes) if line_tax is None]
+    return keys, line_taxes, missing
+
+
+def cacheable_line_taxes(models: dict) -> list:
+    """Indexes of the line items TAX_MODEL classified; the small model's answers aren't cached under its version."""
+    return [i for i, model in models.items() if model == TAX_MODEL]
+
+
+def unclassified_error(unclassified: list) -> dict:
+    return {
+        "message": "Some line items couldn't be classified; retry the request",
+        "unclassified": unclassified,
+    }
+
+
+@app.get("/classify-tax/")
+async def classify_tax(receipt_data:dict):
+    """
+    Classify a receipt's line items and add its TaxSummary. When the models
+    leave items unclassified (e.g. the latency budget ran out) it fails with
+    a 503 listing their indexes rather than count them as not claimable;
+    what was classified is cached, so a retry only asks for the rest.
+    """
+    try:
+        receipt_data = Receipt(**receipt_data).model_dump()
+
+        # Only line items without a cached or rule-based classification are sent to the model
+        keys, line_taxes, missing = await prefill_line_taxes(receipt_data)
+
+        if missing:
+            classified, models = await classify_missing_line_taxes(receipt_data, missing)
+            for i, line_tax in classified.items():
+                line_taxes[i] = line_tax
+            await tax_helper.store_line_taxes(
+                receipt_data, tax_cache, keys, line_taxes, cacheable_line_taxes(models), RELIEF_CATEGORIES
+            )
+            unclassified = [i for i in missing if i not in classified]
+            if unclassified:
+                raise HTTPException(status_code=503, detail=unclassified_error(unclassified))
+
+        receipt_data = db.enrich_receipt_tax_info(receipt_data, {"items": line_taxes})
 
         return {"tax_classification": receipt_data}
-    
+
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error in classify_tax: {e}")
         raise HTTPException(status_code=500, detail=f"Error classifying tax: {str(e)}")
 
+
+@app.post("/classify-tax/stream")
+async def classify_tax_stream(receipt_data: dict):
+    """
+    Classify a receipt's line items over Server-Sent Events.
+
+    Emits an `item` event (`{"index", "line_tax"}`) per line item as soon as
+    it is classified, then a `summary` event with the TaxSummary computed by
+    enrich_receipt_tax_info. Errors end the stream with an `error` event,
+    as do items left unclassified (its detail lists their indexes).
+    """
+    try:
+        receipt_data = Receipt(**receipt_data).model_dump()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid receipt: {str(e)}")
+
+    async def events():
+        try:
+            keys, line_taxes, missing = await prefill_line_taxes(receipt_data)
+            for i, line_tax in enumerate(line_taxes):
+                if line_tax is not None:
+                    yield sse_event("item", {"index": i, "line_tax": line_tax})
+
+            if missing:
+                # Items still waiting for an answer, in order, for answers without an index;
+                # whatever a (e.g. truncated) response leaves out is streamed again on its own,
+                # from the next model up. Streams aren't hedged: items arrive as they're ready.
+                route = tax_router.route(receipt_data, missing)
+                models = route["models"]
+                answered_by = []
+                line_tax_models = {}
+                pending = dict.fromkeys(missing)
+                for attempt in range(TAX_FOLLOW_UP_REQUESTS + 1):
+                    model = models[min(attempt, len(models) - 1)]
+                    answered_by.append(model)
+                    metrics_helper.TAX_ROUTES.inc(reason=route["reason"], model=model)
+                    async for item in stream_tax_classification(
+                        receipt_data, list(pending), model, tax_router.max_completion_tokens(len(pending))
+                    ):
+                        if not pending:
+                            break
+                        if not isinstance(item, dict):
+                            continue
+                        if "index" not in item:
+                            i = next(iter(pending))
+                        elif tax_helper.valid_index(item["index"], pending):
+                            i = item["index"]
+                        else:
+                            # Repeated or unknown index: left for the follow-up request
+                            continue
+                        try:
+                            line_taxes[i] = LineTax(**item).model_dump()
+                        except Exception as e:
+                            logger.warning("Invalid streamed tax item %s: %s", i, e)
+                            continue
+                        del pending[i]
+                        line_tax_models[i] = model
+                        yield sse_event("item", {"index": i, "line_tax": line_taxes[i]})
+                    if not pending:
+                        break
+                log_tax_route(route, answered_by=answered_by, unclassified=len(pending), stream=True)
+                await tax_helper.store_line_taxes(
+                    receipt_data, tax_cache, keys, line_taxes, cacheable_line_taxes(line_tax_models), RELIEF_CATEGORIES
+                )
+                if pending:
+                    yield sse_event("error", {"detail": unclassified_error(list(pending))})
+                    return
+
+            enriched = db.enrich_receipt_tax_info(receipt_data, {"items": line_taxes})
+            if "error" in enriched:
+                yield sse_event("error", {"detail": enriched["error"]})
+                return
+            yield sse_event("summary", enriched["tax_summary"])
+
+        except Exception as e:
+            logger.error("Error in classify_tax_stream: %s", e)
+            yield sse_event("error", {"detail": f"Error classifying tax: {str(e)}"})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/tax-summary")
+async def get_tax_summary(user_id: Annotated[str, Depends(get_current_user)], assessment_year: Optional[str] = None):
+    """
+    Tax relief claimed per category for one assessment year, with the
+    remaining headroom against each category's RM limit.
+
+    - **assessment_year**: e.g. `2024`; defaults to the current year.
+    """
+    assessment_year = assessment_year or str(datetime.date.today().year)
+    try:
+        summary = await db.get_tax_summary(user_id, assessment_year) or {}
+    except Exception as e:
+        logger.error("API Error on GET /tax-summary: %s", e)
+        raise HTTPException(status_code=500, detail="An error occurred while retrieving the tax summary.")
+
+    classes = {}
+    for tax_class, totals in (summary.get("classes") or {}).items():
+        if not totals.get("items"):
+            continue
+        category = RELIEF_CATEGORIES.get(tax_class, {})
+        claimed = round(totals.get("claimed", 0.0), 2)
+        limit = category.get("limit")
+        classes[tax_class] = {
+            "title": category.get("title"),
+            "claimed": claimed,
+            "items": totals["items"],
+            "limit": limit,
+            "headroom": round(max(limit - claimed, 0.0), 2) if limit is not None else None,
+        }
+
+    return {
+        "assessment_year": assessment_year,
+        "receipt_count": summary.get("receipt_count", 0),
+        "total_claimed": round(summary.get("total_claimed", 0.0), 2),
+        "classes": classes,
+    }
+
+
+@app.post("/tax-summary/rebuild")
+async def rebuild_tax_summary(user_id: Annotated[str, Depends(get_current_user)], response: Response):
+    """
+    Queue a rebuild of the user's aggregates from their receipts.
+    """
+    job, _ = await job_queue.enqueue(user_id, "rebuild_aggregates", {})
+    job_workers.notify()
+    response.status_code = 202
+    return {"job_id": job["job_id"], "status": job["status"]}
+
+
 @app.get("/get-budgets-by-user")
-async def get_budgets(id_token: str):
-    user_id = db.get_uid_from_id_token(id_token)
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Invalid ID token")
+async def get_budgets(user_id: Annotated[str, Depends(get_current_user)]):
 
     try:
-        budgets_data = db.get_user_budgets(user_id)
+        budgets_data = await db.get_user_budgets(user_id)
 
         if budgets_data is None:
             raise HTTPException(status_code=404, detail="Budget data not found for this user.")
@@ -294,14 +1562,56 @@ async def get_budgets(id_token: str):
         raise HTTPException(status_code=500, detail="An error occurred while retrieving budgets.")
 
 
+@app.get("/budget-status")
+async def get_budget_status(user_id: Annotated[str, Depends(get_current_user)], date: Optional[str] = None):
+    """
+    Budget vs. spend per expense category for the user's current budget
+    period, read from the budget settings and one spend rollup document.
+
+    - **date**: ISO 8601 date inside the period to report; defaults to today.
+    """
+    try:
+        on_date = datetime.date.fromisoformat(date[:10]) if date else datetime.date.today()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="date must be an ISO 8601 date")
+
+    try:
+        budgets_data = await db.get_user_budgets(user_id) or {}
+        budget_period = str(budgets_data.get("budget_period") or "").lower()
+        if budget_period not in db.BUDGET_PERIODS:
+            budget_period = db.DEFAULT_BUDGET_PERIOD
+        period_key = db.budget_period_key(budget_period, on_date)
+        rollup = await db.get_spend_rollup(user_id, period_key) or {}
+    except Exception as e:
+        logger.error("API Error on GET /budget-status: %s", e)
+        raise HTTPException(status_code=500, detail="An error occurred while retrieving budget status.")
+
+    budgets = budgets_data.get("budgets", {})
+    spend = {
+        category: totals for category, totals in (rollup.get("categories") or {}).items() if totals.get("receipts")
+    }
+    categories = {
+        category: {
+            "budget": budgets.get(category),
+            "spent": round(spend.get(category, {}).get("spent", 0.0), 2),
+            "receipts": spend.get(category, {}).get("receipts", 0),
+        }
+        for category in sorted(set(budgets) | set(spend))
+    }
+
+    return {
+        "budgetPeriod": budget_period,
+        "period": period_key,
+        "total_spent": round(rollup.get("total_spent", 0.0), 2),
+        "categories": categories,
+    }
+
+
 @app.post("/save-budgets-by-user")
 async def save_budgets(
     budgets_data: UserBudgetData,
-    id_token: str
+    user_id: Annotated[str, Depends(get_current_user)]
 ):
-    user_id = db.get_uid_from_id_token(id_token)
-    if not user_id:
-        raise HTTPException(status_code=401, detail="Invalid ID token")
 
     try:
         data_for_db = {"budgets": budgets_data.budgets}
@@ -309,9 +1619,9 @@ async def save_budgets(
             data_for_db["budget_period"] = budgets_data.budget_period
 
         
-        print(data_for_db)
+        logger.debug("Budgets: %s", data_for_db)
 
-        db.save_user_budgets(user_id, data_for_db)
+        await db.save_user_budgets(user_id, data_for_db)
 
         return {"status": "success", "message": "Budgets saved successfully"}
 
@@ -321,22 +1631,17 @@ async def save_budgets(
 
 
 @app.delete("/delete-receipt-by-id")
-async def delete_receipt(receipt_id: str, id_token: str):
+async def delete_receipt(receipt_id: str, user_id: Annotated[str, Depends(get_current_user)]):
     """
     Deletes a specific receipt after verifying ownership via ID token.
 
     - **receipt_id**: The unique ID of the receipt to delete.
     - **id_token**: The Firebase Authentication ID token of the user.
     """
-    user_id = db.get_uid_from_id_token(id_token)
-    if not user_id:
-        raise HTTPException(
-            status_code=401, 
-            detail="Invalid ID token"
-        )
 
     try:
-        db.delete_receipt(receipt_id)
+        await db.delete_receipt(receipt_id)
+        duplicate_index.remove(receipt_id)
         
         return {"message": "Receipt deleted successfully", "receipt_id": receipt_id}
 
@@ -0,0 +1,188 @@
+from contextlib import contextmanager, nullcontext
+import bisect
+import contextvars
+import functools
+import inspect
+import time
+
+try:
+    from opentelemetry import trace
+    tracer = trace.get_tracer("tolaktax")
+except ImportError:
+    # Spans are only exported when opentelemetry (plus an SDK/exporter) is installed
+    tracer = None
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_string(labelnames, values) -> str:
+    if not labelnames:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(labelnames, values)
+    )
+    return "{" + pairs + "}"
+
+
+class Counter:
+    """
+    Monotonic counter in Prometheus text exposition format.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_label_string(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram in Prometheus text exposition format.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+        series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series["counts"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _label_string(self.labelnames + ("le",), key + (le,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _label_string(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {series['sum']}")
+            lines.append(f"{self.name}_count{labels} {series['count']}")
+        return lines
+
+
+REQUEST_LATENCY = Histogram(
+    "tolaktax_request_duration_seconds", "HTTP request latency.", ("method", "route", "status")
+)
+STAGE_LATENCY = Histogram(
+    "tolaktax_stage_duration_seconds", "Latency of instrumented hot-path stages.", ("stage", "outcome")
+)
+LLM_TOKENS = Counter(
+    "tolaktax_llm_tokens_total", "LLM tokens used, by model and token type.", ("model", "type")
+)
+LLM_REQUESTS = Counter(
+    "tolaktax_llm_requests_total", "LLM completions requested, by model.", ("model",)
+)
+
+LLM_RESPONSES = Counter(
+    "tolaktax_llm_responses_total",
+    "Structured LLM responses by parse outcome (valid, repaired, unparseable).",
+    ("model", "outcome"),
+)
+
+SINGLE_FLIGHT = Counter(
+    "tolaktax_single_flight_total",
+    "Model calls by single-flight role: leader (made the call) or coalesced (awaited one in flight).",
+    ("call", "role"),
+)
+
+TAX_ROUTES = Counter(
+    "tolaktax_tax_routes_total",
+    "Tax model requests by routing reason and the model that answered (timeout when the latency budget ran out).",
+    ("reason", "model"),
+)
+
+REGISTRY = [REQUEST_LATENCY, STAGE_LATENCY, LLM_TOKENS, LLM_REQUESTS, LLM_RESPONSES, SINGLE_FLIGHT, TAX_ROUTES]
+
+# Stage timings of the request being handled, for the per-request log line
+request_stages = contextvars.ContextVar("request_stages", default=None)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a block as a named stage: feeds the stage histogram, the current
+    request's stage breakdown and, when available, an OpenTelemetry span.
+    """
+    span = tracer.start_as_current_span(name) if tracer is not None else nullcontext()
+    outcome = "ok"
+    start = time.perf_counter()
+    with span:
+        try:
+            yield
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            STAGE_LATENCY.observe(elapsed, stage=name, outcome=outcome)
+            stages = request_stages.get()
+            if stages is not None:
+                stages[name] = stages.get(name, 0.0) + elapsed * 1000
+
+
+def timed(name: str):
+    """
+    Decorator timing every call of a sync or async function as a stage.
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_llm_usage(model: str, usage):
+    """
+    Count a completion and its token usage (an OpenAI-style usage object or
+    dict; None when the response didn't include one).
+    """
+    LLM_REQUESTS.inc(model=model)
+    if usage is None:
+        return
+    for token_type in ("prompt_tokens", "completion_tokens"):
+        value = usage.get(token_type) if isinstance(usage, dict) else getattr(usage, token_type, None)
+        if value:
+            LLM_TOKENS.inc(value, model=model, type=token_type.replace("_tokens", ""))
+
+
+def render() -> str:
+    """
+    All metrics in Prometheus text exposition format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
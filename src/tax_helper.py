@@ -0,0 +1,572 @@
+from .classes.Reciept import LineTax
+from . import cache_helper
+import asyncio
+import json
+import logging
+import math
+import re
+
+logger = logging.getLogger("tolaktax")
+
+
+def normalize_text(text) -> str:
+    """
+    Lowercase, drop punctuation and collapse whitespace so that
+    "PANADOL  10's" and "panadol 10s" share a cache entry.
+    """
+    if not text:
+        return ""
+    text = re.sub(r"[^\w\s]", "", str(text).lower())
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def line_tax_key(item: dict, receipt_data: dict, version: str) -> str:
+    """
+    Cache key for one line item's tax classification, scoped by merchant and
+    expense category context and by the prompt/model version.
+    """
+    return cache_helper.content_key(
+        version,
+        normalize_text(item.get("description")),
+        normalize_text(receipt_data.get("merchant_name")),
+        normalize_text(receipt_data.get("expense_category")),
+    )
+
+
+def category_limit(tax_class, categories: dict = None):
+    """RM cap of the relief category of `tax_class` in `categories` (see parse_relief_categories), or None."""
+    return (categories or {}).get(relief_category(tax_class), {}).get("limit")
+
+
+def line_tax_to_cache(line_tax: dict, item: dict, categories: dict = None) -> dict:
+    """
+    Convert a classified LineTax into a price-independent cache entry.
+
+    The claimable amount is stored as a fraction of the item's total price so
+    the same entry is reusable for a different quantity or price. An amount
+    capped at its category's limit (`categories`, see
+    parse_relief_categories) says nothing about the fraction of a cheaper
+    item, so such answers aren't cached.
+
+    Returns:
+        The cache entry, or None when the answer shouldn't be cached.
+    """
+    line_tax = LineTax(**line_tax).model_dump()
+    total_price = item.get("total_price") or 0.0
+    if line_tax["tax_eligible"] and total_price > 0:
+        limit = category_limit(line_tax["tax_class"], categories)
+        if limit is not None and line_tax["tax_amount"] < total_price and line_tax["tax_amount"] >= limit - 0.01:
+            return None
+        tax_ratio = min(line_tax["tax_amount"] / total_price, 1.0)
+    else:
+        tax_ratio = 0.0
+
+    return {
+        "tax_eligible": line_tax["tax_eligible"],
+        "tax_class": line_tax["tax_class"],
+        "tax_class_description": line_tax["tax_class_description"],
+        "tax_ratio": tax_ratio,
+    }
+
+
+def line_tax_from_cache(entry: dict, item: dict, categories: dict = None) -> dict:
+    """
+    Rebuild a LineTax for the given item from a cache entry, capping the
+    amount at its category's limit in `categories`.
+    """
+    total_price = item.get("total_price") or 0.0
+    tax_amount = 0.0
+    if entry["tax_eligible"]:
+        tax_amount = total_price * entry.get("tax_ratio", 0.0)
+        limit = category_limit(entry.get("tax_class"), categories)
+        if limit is not None:
+            tax_amount = min(tax_amount, limit)
+    return LineTax(
+        tax_eligible=entry["tax_eligible"],
+        tax_class=entry.get("tax_class"),
+        tax_class_description=entry.get("tax_class_description"),
+        tax_amount=round(tax_amount, 2),
+    ).model_dump()
+
+
+# Line item fields the tax model sees, in row order
+COMPACT_ITEM_COLUMNS = ("index", "description", "quantity", "total_price")
+
+
+def compact_receipt(receipt_data: dict, indexes=None) -> str:
+    """
+    Minimal JSON encoding of a receipt for the tax model: merchant, expense
+    category and one row per line item under COMPACT_ITEM_COLUMNS. Rows
+    carry the item's index in receipt_data['line_items'], so answers map
+    back to the right item when only some items (`indexes`) are sent.
+    """
+    line_items = receipt_data.get("line_items") or []
+    if indexes is None:
+        indexes = range(len(line_items))
+    payload = {}
+    if receipt_data.get("merchant_name"):
+        payload["merchant"] = receipt_data["merchant_name"]
+    if receipt_data.get("expense_category"):
+        payload["category"] = receipt_data["expense_category"]
+    payload["columns"] = COMPACT_ITEM_COLUMNS
+    payload["items"] = [
+        [i, line_items[i].get("description"), line_items[i].get("quantity"), line_items[i].get("total_price")]
+        for i in indexes
+    ]
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+
+def items_by_index(items: list, indexes) -> dict:
+    """
+    Map the tax model's answers back to line item indexes. Answers carrying
+    one of `indexes` as their "index" go to that item; answers with no
+    "index" at all fill the remaining indexes in order. Answers with an
+    index that is repeated or not one of `indexes` are dropped, leaving
+    their items unanswered rather than attached to the wrong item.
+
+    Returns:
+        {line item index: answer}
+    """
+    indexes = list(indexes)
+    wanted = set(indexes)
+    mapped = {}
+    unindexed = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        if "index" not in item:
+            unindexed.append(item)
+            continue
+        index = item["index"]
+        if valid_index(index, wanted) and index not in mapped:
+            mapped[index] = item
+
+    remaining = [i for i in indexes if i not in mapped]
+    for i, item in zip(remaining, unindexed):
+        mapped[i] = item
+    return mapped
+
+
+def valid_index(index, wanted) -> bool:
+    """Whether an answer's "index" is one of the line item indexes `wanted` (booleans aren't indexes)."""
+    return isinstance(index, int) and not isinstance(index, bool) and index in wanted
+
+
+def chunk_indexes(indexes: list, max_items: int) -> list:
+    """
+    Split line item indexes into the fewest chunks of at most `max_items`,
+    as even as possible (41 items by 10 give 9, 8, 8, 8, 8 rather than a
+    last chunk of one). max_items of 0 or less keeps a single chunk.
+    """
+    indexes = list(indexes)
+    if max_items <= 0 or len(indexes) <= max_items:
+        return [indexes]
+    count = math.ceil(len(indexes) / max_items)
+    size, extra = divmod(len(indexes), count)
+    chunks = []
+    start = 0
+    for chunk in range(count):
+        end = start + size + (chunk < extra)
+        chunks.append(indexes[start:end])
+        start = end
+    return chunks
+
+
+async def lookup_line_taxes(receipt_data: dict, cache, version: str, categories: dict = None):
+    """
+    Look up every line item of a receipt in the classification cache, all
+    at once (one round trip's latency with a Firestore-backed cache);
+    amounts are capped at the category limits in `categories`.
+
+    Returns:
+        (keys, items): the cache key per line item and the cached LineTax
+        dict per line item, or None where the item still needs classifying.
+    """
+    line_items = receipt_data["line_items"]
+    keys = [line_tax_key(item, receipt_data, version) for item in line_items]
+    entries = await asyncio.gather(*(cache.get(key) for key in keys))
+    items = [
+        line_tax_from_cache(entry, item, categories) if entry is not None else None
+        for entry, item in zip(entries, line_items)
+    ]
+    return keys, items
+
+
+async def store_line_taxes(receipt_data: dict, cache, keys: list, items: list, indexes: list,
+                           categories: dict = None):
+    """
+    Write freshly classified line items back to the cache, all at once.
+    Entries that do not validate as a LineTax, or whose amount was capped at
+    the category limit in `categories`, are skipped rather than cached.
+    """
+    writes = {}
+    for i in indexes:
+        if items[i] is None:
+            continue
+        try:
+            entry = line_tax_to_cache(items[i], receipt_data["line_items"][i], categories)
+        except Exception as e:
+            logger.warning("Skipping tax cache write for item %s: %s", i, e)
+            continue
+        if entry is not None:
+            writes[keys[i]] = entry
+    await asyncio.gather(*(cache.set(key, entry) for key, entry in writes.items()))
+
+
+# Keywords from tax_prompt.txt that describe who benefits or a generic kind of
+# spend rather than an item. They only nudge a category and never make a match
+# confident on their own ("hair care", "Panadol tablet", "gift for mother").
+CONTEXT_KEYWORDS = {
+    "parent", "mother", "father", "care", "medical", "dental", "examination",
+    "child", "son", "daughter", "student", "education", "disabled", "spouse",
+    "wife", "husband", "equipment", "facility", "training", "treatment",
+    "course", "tablet", "deposit", "withdrawal", "maintenance", "policy",
+    "premium", "contribution", "investment", "installation", "charging",
+}
+CONTEXT_KEYWORD_WEIGHT = 0.25
+
+# Keywords naming a kind of spend that non-claimable purchases share ("Netflix
+# membership", "Car insurance renewal", "Hospital parking"). A match is only
+# confident with a second keyword of the category ("Gym membership").
+GENERIC_KEYWORDS = {
+    "sports", "membership", "insurance", "internet", "hospital", "clinic",
+    "fitness", "consultation", "skills", "competition",
+}
+GENERIC_KEYWORD_WEIGHT = 0.5
+
+# Words marking a purchase as something no relief category covers, whatever
+# keyword it also matches ("100PLUS Sports Drink", "Internet cafe"). They halve
+# a match's confidence, leaving the item to the model.
+NEGATIVE_TERMS = {
+    "drink", "beverage", "food", "snack", "meal", "cafe", "coffee", "restaurant",
+    "parking", "car", "motor", "motorcycle", "petrol", "fuel", "toll",
+    "netflix", "spotify", "disney", "costco", "hotel", "flight", "travel",
+}
+NEGATIVE_TERM_FACTOR = 0.5
+NEGATIVE_TERMS_PATTERN = re.compile(
+    r"\b(" + "|".join(sorted(NEGATIVE_TERMS, key=len, reverse=True)) + r")(?:s|es)?\b", re.IGNORECASE
+)
+
+# Accessories and services for the lifestyle categories' items, which only
+# the items themselves qualify for ("Gym towel", "Smartphone case", "Computer
+# repair"). Elsewhere they can be the claimable item ("Cooler bag" for
+# breastfeeding, "EV charger"), so they only count against these categories.
+ACCESSORY_TERMS = {
+    "towel", "case", "casing", "cover", "sleeve", "bag", "strap", "stand", "protector",
+    "mouse", "charger", "cable", "adapter", "accessory", "accessories", "repair", "servicing",
+}
+ACCESSORY_CATEGORIES = {"9", "10"}
+ACCESSORY_TERMS_PATTERN = re.compile(
+    r"\b(" + "|".join(sorted(ACCESSORY_TERMS, key=len, reverse=True)) + r")(?:s|es)?\b", re.IGNORECASE
+)
+
+
+CATEGORY_PATTERN = re.compile(r"^####\s+(\d+)\.\s+(.+?)\s+-\s+(.+)$", re.MULTILINE)
+KEYWORDS_PATTERN = re.compile(r"^\*\*Key Keywords\*\*:\s*(.+?)\.?\s*$", re.MULTILINE)
+
+
+def parse_relief_categories(tax_prompt: str) -> dict:
+    """
+    Read the relief categories out of the tax prompt.
+
+    Returns:
+        {tax_class: {"title", "limit", "keywords"}} where limit is the RM cap
+        (None for "Various amounts") and keywords the "Key Keywords" list.
+    """
+    categories = {}
+    headers = list(CATEGORY_PATTERN.finditer(tax_prompt))
+    for position, header in enumerate(headers):
+        end = headers[position + 1].start() if position + 1 < len(headers) else len(tax_prompt)
+        section = tax_prompt[header.end():end]
+        keywords_line = KEYWORDS_PATTERN.search(section)
+        limit = re.search(r"RM([\d,]+)", header.group(3))
+        categories[header.group(1)] = {
+            "title": header.group(2).title(),
+            "limit": float(limit.group(1).replace(",", "")) if limit else None,
+            "keywords": [
+                keyword.strip().lower() for keyword in keywords_line.group(1).split(",") if keyword.strip()
+            ] if keywords_line else [],
+        }
+    return categories
+
+
+def relief_category(tax_class) -> str:
+    """
+    Top-level relief category of a tax_class ("10a" -> "10"), or None for
+    "NA" and other non-category values.
+    """
+    match = re.match(r"\s*(\d+)", str(tax_class or ""))
+    return match.group(1) if match else None
+
+
+class RuleClassifier:
+    """
+    Deterministic keyword classifier for the LHDN relief categories.
+
+    Keywords are read from the "Key Keywords" lines of the tax prompt and
+    compiled into a single case-insensitive alternation (longest keyword
+    first), so one scan of a description finds every non-overlapping match.
+    """
+
+    def __init__(self, tax_prompt: str, min_confidence: float = 0.85):
+        self.min_confidence = min_confidence
+        self.categories = {}
+        self.keyword_categories = {}
+
+        for tax_class, category in parse_relief_categories(tax_prompt).items():
+            if not category["keywords"]:
+                continue
+            self.categories[tax_class] = category
+            for keyword in category["keywords"]:
+                self.keyword_categories.setdefault(keyword, set()).add(tax_class)
+
+        alternatives = sorted(self.keyword_categories, key=len, reverse=True)
+        self.pattern = re.compile(
+            r"\b(" + "|".join(re.escape(keyword) for keyword in alternatives) + r")(?:s|es)?\b",
+            re.IGNORECASE,
+        )
+
+    def score(self, description: str) -> dict:
+        """
+        Score each category for a description. Keywords shared by several
+        categories split their weight between them.
+        """
+        scores = {}
+        for match in self.pattern.finditer(description or ""):
+            keyword = match.group(1).lower()
+            tax_classes = self.keyword_categories[keyword]
+            if keyword in CONTEXT_KEYWORDS:
+                weight = CONTEXT_KEYWORD_WEIGHT
+            elif keyword in GENERIC_KEYWORDS:
+                weight = GENERIC_KEYWORD_WEIGHT
+            else:
+                weight = 1.0
+            for tax_class in tax_classes:
+                scores[tax_class] = scores.get(tax_class, 0.0) + weight / len(tax_classes)
+        return scores
+
+    def classify(self, item: dict):
+        """
+        Classify one line item.
+
+        Returns:
+            (line_tax, confidence): a LineTax dict, or None when no category
+            matched, and the confidence of the best category in [0, 1].
+        """
+        scores = self.score(item.get("description"))
+        if not scores:
+            return None, 0.0
+
+        tax_class, best = max(scores.items(), key=lambda entry: entry[1])
+        confidence = min(best, 1.0) * best / sum(scores.values())
+        description = item.get("description") or ""
+        if NEGATIVE_TERMS_PATTERN.search(description) or (
+            tax_class in ACCESSORY_CATEGORIES and ACCESSORY_TERMS_PATTERN.search(description)
+        ):
+            confidence *= NEGATIVE_TERM_FACTOR
+
+        category = self.categories[tax_class]
+        total_price = item.get("total_price") or 0.0
+        tax_amount = min(total_price, category["limit"]) if category["limit"] is not None else total_price
+        line_tax = LineTax(
+            tax_eligible=True,
+            tax_class=tax_class,
+            tax_class_description=category["title"],
+            tax_amount=round(tax_amount, 2),
+        ).model_dump()
+        return line_tax, confidence
+
+    def classify_confident(self, item: dict):
+        """
+        Return the LineTax dict for an item if the match clears the
+        confidence threshold, otherwise None.
+        """
+        line_tax, confidence = self.classify(item)
+        if line_tax is not None and confidence >= self.min_confidence:
+            return line_tax
+        return None
+
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = {
+    "a", "an", "and", "or", "the", "of", "for", "to", "in", "on", "with", "by", "as", "at", "is", "are",
+    "be", "no", "not", "e", "g", "eg", "etc", "rm", "any", "including", "other", "per", "s",
+}
+
+
+def index_tokens(text) -> list:
+    """
+    Words of a text for the category index: normalized, without stopwords,
+    and with a plural "s"/"es" dropped so "books" matches "book".
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(normalize_text(text)):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 4 and token.endswith("es") and not token.endswith("ses"):
+            token = token[:-2]
+        elif len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class TaxPromptBuilder:
+    """
+    Builds the tax prompt for one receipt from the sections of the full tax
+    prompt, sending full definitions only for the categories that matter.
+
+    The prompt keeps the instructions before and after the category list, a
+    one-line directory entry per category (so the model can still name any
+    category), and the full definition of the categories a TF-IDF index over
+    the definitions ranks relevant to the receipt's line items and
+    expense_category.
+    """
+
+    # How much a word counts in its category's document, by where it appears
+    TITLE_WEIGHT = 2.0
+    KEYWORD_WEIGHT = 3.0
+
+    def __init__(self, tax_prompt: str, max_categories: int = 6, min_score: float = 0.1, per_query: int = 2):
+        self.max_categories = max_categories
+        self.min_score = min_score
+        self.per_query = per_query
+
+        headers = list(CATEGORY_PATTERN.finditer(tax_prompt))
+        footer_start = tax_prompt.find("\n## ", headers[-1].end()) if headers else -1
+        if footer_start == -1:
+            footer_start = len(tax_prompt)
+        self.header = tax_prompt[:headers[0].start()] if headers else tax_prompt
+        self.footer = tax_prompt[footer_start:]
+        self.sections = {}
+        self.directory = []
+        for position, header in enumerate(headers):
+            end = headers[position + 1].start() if position + 1 < len(headers) else footer_start
+            self.sections[header.group(1)] = tax_prompt[header.start():end].rstrip() + "\n\n"
+            self.directory.append(f"- {header.group(1)}. {header.group(2)} - {header.group(3)}")
+
+        categories = parse_relief_categories(tax_prompt)
+        weights = {}
+        for tax_class, section in self.sections.items():
+            counts = {}
+            category = categories[tax_class]
+            for token, weight in (
+                [(token, self.TITLE_WEIGHT) for token in index_tokens(category["title"])]
+                + [(token, self.KEYWORD_WEIGHT) for token in index_tokens(" ".join(category["keywords"]))]
+                + [(token, 1.0) for token in index_tokens(section.split("\n", 1)[-1])]
+            ):
+                counts[token] = counts.get(token, 0.0) + weight
+            weights[tax_class] = counts
+
+        document_frequency = {}
+        for counts in weights.values():
+            for token in counts:
+                document_frequency[token] = document_frequency.get(token, 0) + 1
+        documents = len(weights)
+        self.vectors = {}
+        for tax_class, counts in weights.items():
+            vector = {
+                token: count * math.log(1 + documents / document_frequency[token])
+                for token, count in counts.items()
+            }
+            norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+            self.vectors[tax_class] = {token: value / norm for token, value in vector.items()}
+
+    def score(self, text) -> dict:
+        """
+        Relevance of each category to a text: the summed weights of its words
+        in the category's normalized TF-IDF vector.
+        """
+        scores = {}
+        for token in set(index_tokens(text)):
+            for tax_class, vector in self.vectors.items():
+                if token in vector:
+                    scores[tax_class] = scores.get(tax_class, 0.0) + vector[token]
+        return scores
+
+    def relevant_categories(self, receipt_data: dict) -> list:
+        """
+        Categories worth defining in full for a receipt: the best matches of
+        each line item and of the expense category, strongest first, capped
+        at max_categories.
+        """
+        queries = [item.get("description") for item in receipt_data.get("line_items") or []]
+        queries.append(receipt_data.get("expense_category"))
+
+        best = {}
+        for query in queries:
+            scores = self.score(query)
+            ranked = sorted(scores.items(), key=lambda entry: entry[1], reverse=True)[:self.per_query]
+            for tax_class, score in ranked:
+                if score >= self.min_score:
+                    best[tax_class] = max(best.get(tax_class, 0.0), score)
+
+        ranked = sorted(best.items(), key=lambda entry: entry[1], reverse=True)[:self.max_categories]
+        return [tax_class for tax_class, _ in ranked]
+
+    def build(self, receipt_data: dict) -> str:
+        """
+        The tax prompt for this receipt.
+        """
+        selected = set(self.relevant_categories(receipt_data))
+        parts = [self.header, "#### CATEGORY DIRECTORY\n", "\n".join(self.directory), "\n\n"]
+        if selected:
+            parts.append("Full definitions of the categories most relevant to this receipt:\n\n")
+            parts.extend(section for tax_class, section in self.sections.items() if tax_class in selected)
+        parts.append(self.footer)
+        return "".join(parts)
+
+
+class TaxModelRouter:
+    """
+    Picks the models for a tax classification request, cheapest first.
+
+    Short requests whose line items the keyword rules find unambiguous start
+    on the first (smallest) model and escalate to the next ones only when it
+    fails, is too slow or leaves items out; anything else goes straight to
+    the last (largest) model. An item is ambiguous when some keywords match
+    it but the rules aren't confident of the category, e.g. "vitamin C
+    supplement for mum"; items with no keyword match at all are mostly
+    plain groceries and meals.
+
+    max_completion_tokens is sized from the item count instead of fixed.
+    """
+
+    def __init__(self, models: list, rules: RuleClassifier, small_max_items: int = 8, max_ambiguous: int = 0,
+                 tokens_per_item: int = 48, base_tokens: int = 32, max_tokens: int = 4096):
+        self.models = list(models)
+        self.rules = rules
+        self.small_max_items = small_max_items
+        self.max_ambiguous = max_ambiguous
+        self.tokens_per_item = tokens_per_item
+        self.base_tokens = base_tokens
+        self.max_tokens = max_tokens
+
+    def ambiguous_items(self, line_items: list) -> int:
+        ambiguous = 0
+        for item in line_items:
+            _, confidence = self.rules.classify(item)
+            ambiguous += 0.0 < confidence < self.rules.min_confidence
+        return ambiguous
+
+    def max_completion_tokens(self, item_count: int) -> int:
+        return min(self.base_tokens + self.tokens_per_item * max(item_count, 1), self.max_tokens)
+
+    def route(self, receipt_data: dict, indexes: list) -> dict:
+        """
+        Returns:
+            {"models", "reason", "items", "ambiguous"}: the models to try in
+            order, why the first one was chosen, and the request's item and
+            ambiguous item counts.
+        """
+        line_items = [receipt_data["line_items"][i] for i in indexes]
+        ambiguous = self.ambiguous_items(line_items)
+        if len(self.models) == 1:
+            reason, models = "single_model", self.models
+        elif len(line_items) > self.small_max_items:
+            reason, models = "items", self.models[-1:]
+        elif ambiguous > self.max_ambiguous:
+            reason, models = "ambiguous", self.models[-1:]
+        else:
+            reason, models = "small", self.models
+        return {"models": models, "reason": reason, "items": len(line_items), "ambiguous": ambiguous}